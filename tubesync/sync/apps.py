@@ -1,6 +1,16 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
+
+
+def schedule_housekeeping(sender, **kwargs):
+    # Make sure the housekeeping task is scheduled, migrations run at every start
+    from .tasks import schedule_housekeeping_task
+    schedule_housekeeping_task()
 
 
 class SyncConfig(AppConfig):
 
     name = 'sync'
+
+    def ready(self):
+        post_migrate.connect(schedule_housekeeping, sender=self)
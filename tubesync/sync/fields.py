@@ -1,3 +1,5 @@
+import zlib
+from base64 import b64encode, b64decode
 from django.forms import MultipleChoiceField,  CheckboxSelectMultiple, Field, TypedMultipleChoiceField
 from django.db import models
 from typing import Any, Optional, Dict
@@ -107,3 +109,42 @@ class CommaSepChoiceField(models.Field):
             return []
         else:
             return fval[0][1]
+
+
+# this is a database field!
+class CompressedTextField(models.TextField):
+    '''
+        A TextField which transparently compresses its value in the database. Values
+        are stored as zlib compressed, base64 encoded text with a format marker
+        prefix so the column type is unchanged and uncompressed values written
+        before compression was enabled are still read as-is.
+    '''
+
+    COMPRESSED_PREFIX = 'zlib+b64:'
+
+    @classmethod
+    def compress(cls, value):
+        if not value or value.startswith(cls.COMPRESSED_PREFIX):
+            return value
+        compressed = b64encode(zlib.compress(value.encode('utf-8'))).decode('ascii')
+        return f'{cls.COMPRESSED_PREFIX}{compressed}'
+
+    @classmethod
+    def decompress(cls, value):
+        if not value or not value.startswith(cls.COMPRESSED_PREFIX):
+            return value
+        compressed = b64decode(value[len(cls.COMPRESSED_PREFIX):])
+        return zlib.decompress(compressed).decode('utf-8')
+
+    @classmethod
+    def is_compressed(cls, value):
+        return bool(value) and value.startswith(cls.COMPRESSED_PREFIX)
+
+    def from_db_value(self, value, expr, conn):
+        return self.decompress(value)
+
+    def to_python(self, value):
+        return self.decompress(super().to_python(value))
+
+    def get_db_prep_save(self, value, connection):
+        return self.compress(super().get_db_prep_save(value, connection))
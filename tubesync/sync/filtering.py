@@ -50,6 +50,38 @@ def filter_media(instance: Media):
     return False
 
 
+# Check the filter conditions which can use the fields saved when the media was indexed,
+# before the metadata is downloaded. Returns if the Skip property has changed
+def filter_indexed_media(instance: Media):
+    skip = False
+
+    # Check if we have filter_text and filter text matches
+    if instance.title and filter_filter_text(instance):
+        skip = True
+
+    # Check if the video is longer than the max, or shorter than the min
+    if instance.duration and filter_duration(instance):
+        skip = True
+
+    # Check the published date limits if the index included a date
+    if isinstance(instance.published, datetime):
+        if filter_max_cap(instance):
+            skip = True
+        if filter_source_cutoff(instance):
+            skip = True
+
+    # Check if skipping
+    if instance.skip != skip:
+        instance.skip = skip
+        log.info(
+            f"Media: {instance.source} / {instance} has changed skip setting to {skip} "
+            f"before downloading metadata"
+        )
+        return True
+
+    return False
+
+
 def filter_published(instance: Media):
     # Check if the instance is not published, we have to skip then
     if not isinstance(instance.published, datetime):
@@ -0,0 +1,233 @@
+import os
+import re
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from tempfile import TemporaryDirectory
+import yt_dlp
+from django.core.management.base import BaseCommand, CommandError
+from common.logger import log
+from sync.youtube import get_external_downloader
+
+
+class BenchmarkRequestHandler(BaseHTTPRequestHandler):
+    '''
+        Serves /fragment/<n> as fragment_size bytes, as a stand-in for the fragments
+        of a DASH stream, and /file as file_size bytes with support for range
+        requests. Each request waits latency seconds and is sent at up to rate
+        bytes per second per connection.
+    '''
+
+    fragment_size = 0
+    file_size = 0
+    latency = 0
+    rate = 0
+    chunk_size = 64 * 1024
+    range_re = re.compile(r'^bytes=(\d+)-(\d*)$')
+
+    def get_range(self):
+        if self.path.startswith('/fragment/'):
+            return 200, 0, self.fragment_size
+        if self.path != '/file':
+            return 404, 0, 0
+        match = self.range_re.match(self.headers.get('Range', ''))
+        if not match:
+            return 200, 0, self.file_size
+        start = int(match.group(1))
+        end = int(match.group(2)) + 1 if match.group(2) else self.file_size
+        end = min(end, self.file_size)
+        if start >= end:
+            return 416, 0, 0
+        return 206, start, end
+
+    def send_range_headers(self, status, start, end):
+        self.send_response(status)
+        self.send_header('Content-Type', 'video/mp4')
+        self.send_header('Content-Length', str(end - start))
+        if self.path == '/file':
+            self.send_header('Accept-Ranges', 'bytes')
+        if status == 206:
+            self.send_header('Content-Range', f'bytes {start}-{end - 1}/{self.file_size}')
+        self.end_headers()
+
+    def do_HEAD(self):
+        status, start, end = self.get_range()
+        if status >= 400:
+            self.send_error(status)
+            return
+        self.send_range_headers(status, start, end)
+
+    def do_GET(self):
+        status, start, end = self.get_range()
+        if status >= 400:
+            self.send_error(status)
+            return
+        time.sleep(self.latency)
+        self.send_range_headers(status, start, end)
+        chunk = b'\0' * self.chunk_size
+        sent = 0
+        started = time.monotonic()
+        try:
+            while sent < end - start:
+                size = min(self.chunk_size, end - start - sent)
+                self.wfile.write(chunk[:size])
+                sent += size
+                if self.rate > 0:
+                    wait = sent / self.rate - (time.monotonic() - started)
+                    if wait > 0:
+                        time.sleep(wait)
+        except (BrokenPipeError, ConnectionResetError):
+            # Downloaders close connections they no longer need
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+class Command(BaseCommand):
+
+    help = ('Benchmarks media download throughput with different numbers of '
+            'concurrent fragments and with each downloader against a local server')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrent-fragments', action='store', type=str,
+                            default='1,2,4,8',
+                            help='Comma separated numbers of concurrent fragments to test')
+        parser.add_argument('--fragments', action='store', type=int, default=40,
+                            help='Number of fragments in the stream')
+        parser.add_argument('--fragment-size', action='store', type=int,
+                            default=512 * 1024, help='Size of each fragment in bytes')
+        parser.add_argument('--downloaders', action='store', type=str,
+                            default='native,aria2c',
+                            help='Comma separated downloaders to test with a single file')
+        parser.add_argument('--connections', action='store', type=int, default=8,
+                            help='Connections per file for external downloaders')
+        parser.add_argument('--file-size', action='store', type=int,
+                            default=32 * 1024 * 1024, help='Size of the single file in bytes')
+        parser.add_argument('--latency', action='store', type=float, default=0.1,
+                            help='Seconds the server waits before answering each request')
+        parser.add_argument('--rate', action='store', type=int, default=4 * 1024 * 1024,
+                            help='Maximum bytes per second of each connection, 0 for no limit')
+
+    def download(self, info, opts, output_dir):
+        opts = dict(opts, **{
+            'quiet': True,
+            'no_warnings': True,
+            'noprogress': True,
+            'fixup': 'never',
+            'outtmpl': os.path.join(output_dir, '%(id)s.%(ext)s'),
+        })
+        start = time.monotonic()
+        with yt_dlp.YoutubeDL(opts) as y:
+            y.process_ie_result(info, download=True)
+        elapsed = time.monotonic() - start
+        filepath = os.path.join(output_dir, f'{info["id"]}.mp4')
+        size = os.path.getsize(filepath)
+        os.remove(filepath)
+        return size, elapsed
+
+    def benchmark_fragments(self, url, fragments, concurrent_fragments, output_dir):
+        info = {
+            'id': f'fragments-{concurrent_fragments}',
+            'title': 'benchmark',
+            'formats': [{
+                'format_id': 'dash',
+                'ext': 'mp4',
+                'protocol': 'http_dash_segments',
+                'url': url,
+                'fragment_base_url': url,
+                'fragments': [{'path': f'fragment/{i}'} for i in range(fragments)],
+            }],
+        }
+        opts = {'concurrent_fragment_downloads': concurrent_fragments}
+        return self.download(info, opts, output_dir)
+
+    def benchmark_downloader(self, url, file_size, downloader, connections, output_dir):
+        info = {
+            'id': f'file-{downloader}',
+            'title': 'benchmark',
+            'formats': [{
+                'format_id': 'http',
+                'ext': 'mp4',
+                'protocol': 'http',
+                'url': f'{url}file',
+                'filesize': file_size,
+            }],
+        }
+        opts = {}
+        external_downloader = get_external_downloader(downloader)
+        if external_downloader:
+            opts['external_downloader'] = {'http': external_downloader}
+            opts['external_downloader_args'] = {'aria2c': [
+                f'--max-connection-per-server={connections}',
+                f'--split={connections}',
+            ]}
+        return self.download(info, opts, output_dir)
+
+    def parse_list(self, name, value, cast=str):
+        try:
+            values = [cast(v.strip()) for v in value.split(',') if v.strip()]
+        except ValueError:
+            raise CommandError(f'{name} must be a comma separated list, got {value}')
+        if not values:
+            raise CommandError(f'{name} must not be empty')
+        return values
+
+    def report(self, label, results):
+        baseline = results[0][1] / results[0][2]
+        for name, size, elapsed in results:
+            self.stdout.write(f'{label} {name:>8}: '
+                              f'{size / elapsed / 1024 / 1024:8.2f} MiB/s '
+                              f'({size / elapsed / baseline:.2f}x)')
+
+    def handle(self, *args, **options):
+        concurrent_fragments = self.parse_list(
+            'Concurrent fragments', options['concurrent_fragments'], int)
+        if min(concurrent_fragments) < 1:
+            raise CommandError('Concurrent fragments must be at least 1')
+        downloaders = self.parse_list('Downloaders', options['downloaders'])
+        fragments = options['fragments']
+        if fragments < 1:
+            raise CommandError(f'Fragments must be at least 1, got {fragments}')
+        handler = type('Handler', (BenchmarkRequestHandler,), {
+            'fragment_size': options['fragment_size'],
+            'file_size': options['file_size'],
+            'latency': options['latency'],
+            'rate': options['rate'],
+        })
+        server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        server.daemon_threads = True
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        url = f'http://127.0.0.1:{server.server_address[1]}/'
+        log.info(f'Serving {fragments} fragments of {options["fragment_size"]} bytes '
+                 f'and a file of {options["file_size"]} bytes at {url} with '
+                 f'{options["latency"]}s latency and {options["rate"]} bytes/s per '
+                 f'connection')
+        fragment_results = []
+        downloader_results = []
+        try:
+            with TemporaryDirectory() as output_dir:
+                for count in concurrent_fragments:
+                    size, elapsed = self.benchmark_fragments(url, fragments, count,
+                                                             output_dir)
+                    fragment_results.append((count, size, elapsed))
+                    log.info(f'{count} concurrent fragments: {size} bytes in '
+                             f'{elapsed:.2f} seconds ({size / elapsed:.0f} bytes/s)')
+                for downloader in downloaders:
+                    if downloader != 'native' and not get_external_downloader(downloader):
+                        log.info(f'Skipping the {downloader} downloader')
+                        continue
+                    size, elapsed = self.benchmark_downloader(
+                        url, options['file_size'], downloader, options['connections'],
+                        output_dir)
+                    downloader_results.append((downloader, size, elapsed))
+                    log.info(f'{downloader} downloader: {size} bytes in '
+                             f'{elapsed:.2f} seconds ({size / elapsed:.0f} bytes/s)')
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.report('Concurrent fragments', fragment_results)
+        if downloader_results:
+            self.report('Downloader', downloader_results)
+        log.info('Done')
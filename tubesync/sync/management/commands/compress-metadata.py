@@ -0,0 +1,57 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Sum
+from django.db.models.functions import Length
+from common.logger import log
+from sync.fields import CompressedTextField
+from sync.models import Media
+
+
+class Command(BaseCommand):
+
+    help = 'Compresses media metadata stored before metadata compression was added'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', action='store', type=int, default=500,
+                            help='Number of media items to convert per transaction')
+
+    def get_size(self):
+        size = Media.objects.aggregate(size=Sum(Length('metadata')))['size']
+        return size if size else 0
+
+    def handle(self, *args, **options):
+        batch_size = options.get('batch_size', 500)
+        if batch_size < 1:
+            raise CommandError(f'Batch size must be at least 1, got {batch_size}')
+        size_before = self.get_size()
+        log.info(f'Metadata size before compression: {size_before} bytes')
+        # Only uncompressed rows, the prefix lookup is not passed through the field
+        uncompressed = Media.objects.exclude(
+            metadata__isnull=True
+        ).exclude(
+            metadata__startswith=CompressedTextField.COMPRESSED_PREFIX
+        ).order_by('pk')
+        log.info(f'Compressing metadata for {uncompressed.count()} media items in '
+                 f'batches of {batch_size}...')
+        converted = 0
+        last_pk = None
+        while True:
+            batch = uncompressed
+            if last_pk is not None:
+                batch = batch.filter(pk__gt=last_pk)
+            batch = list(batch.values_list('pk', 'metadata')[:batch_size])
+            if not batch:
+                break
+            with transaction.atomic():
+                for pk, metadata in batch:
+                    # .update() writes through the field so the value is compressed
+                    # without triggering any media save signals
+                    Media.objects.filter(pk=pk).update(metadata=metadata)
+            converted += len(batch)
+            last_pk = batch[-1][0]
+            log.info(f'Compressed metadata for {converted} media items')
+        size_after = self.get_size()
+        saved = size_before - size_after
+        log.info(f'Metadata size after compression: {size_after} bytes '
+                 f'(saved {saved} bytes)')
+        log.info('Done')
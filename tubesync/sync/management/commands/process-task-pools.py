@@ -0,0 +1,59 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+from background_task.tasks import autodiscover
+from background_task.utils import SignalManager
+from common.logger import log
+from sync.pools import TaskPoolScheduler, get_pool_workers, get_pool_status
+
+
+class Command(BaseCommand):
+
+    help = ('Runs background tasks on a separate worker pool for each class of task, '
+            'in place of process_tasks')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sleep', action='store', type=float, default=5.0,
+                            help='Seconds to wait between checks when no tasks are ready')
+        parser.add_argument('--status-interval', action='store', type=int, default=300,
+                            help='Seconds between logging the queue depth of each pool')
+        parser.add_argument('--duration', action='store', type=int, default=0,
+                            help='Stop after this many seconds (0 to run forever)')
+
+    def log_status(self):
+        for pool in get_pool_status():
+            log.info(f'Task pool "{pool["name"]}": {pool["running"]} of '
+                     f'{pool["workers"]} workers busy, {pool["ready"]} tasks ready, '
+                     f'{pool["scheduled"]} tasks scheduled')
+
+    def handle(self, *args, **options):
+        sleep = options.get('sleep', 5.0)
+        status_interval = options.get('status_interval', 300)
+        duration = options.get('duration', 0)
+        if sleep <= 0:
+            raise CommandError(f'Sleep must be greater than 0, got {sleep}')
+        sig_manager = SignalManager()
+        autodiscover()
+        workers = get_pool_workers()
+        log.info('Running tasks with worker pools: ' + ', '.join(
+            f'{pool}={count}' for pool, count in workers.items()))
+        scheduler = TaskPoolScheduler(workers)
+        start = time.monotonic()
+        last_status = 0
+        try:
+            while not sig_manager.kill_now:
+                if duration > 0 and time.monotonic() - start > duration:
+                    break
+                if time.monotonic() - last_status >= status_interval:
+                    self.log_status()
+                    last_status = time.monotonic()
+                if not scheduler.run_pending():
+                    close_old_connections()
+                    time.sleep(sleep)
+                else:
+                    time.sleep(0.1)
+        finally:
+            # Running tasks are unlocked for retrying after MAX_RUN_TIME if they
+            # don't finish
+            scheduler.shutdown(wait=False)
+        log.info('Done')
@@ -0,0 +1,65 @@
+import json
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Sum
+from django.db.models.functions import Length
+from common.logger import log
+from common.utils import json_serial
+from sync.models import Media
+
+
+class Command(BaseCommand):
+
+    help = 'Removes unused keys from all stored media metadata'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', action='store', type=int, default=500,
+                            help='Number of media items to prune per transaction')
+
+    def get_size(self):
+        size = Media.objects.aggregate(size=Sum(Length('metadata')))['size']
+        return size if size else 0
+
+    def handle(self, *args, **options):
+        batch_size = options.get('batch_size', 500)
+        if batch_size < 1:
+            raise CommandError(f'Batch size must be at least 1, got {batch_size}')
+        size_before = self.get_size()
+        log.info(f'Metadata size before pruning: {size_before} bytes')
+        media = Media.objects.exclude(metadata__isnull=True).order_by('pk')
+        log.info(f'Pruning metadata for {media.count()} media items in batches '
+                 f'of {batch_size}...')
+        checked, pruned = 0, 0
+        last_pk = None
+        while True:
+            batch = media
+            if last_pk is not None:
+                batch = batch.filter(pk__gt=last_pk)
+            batch = list(batch.values_list('pk', 'source__source_type',
+                                           'metadata')[:batch_size])
+            if not batch:
+                break
+            with transaction.atomic():
+                for pk, source_type, metadata in batch:
+                    try:
+                        data = json.loads(metadata)
+                    except ValueError:
+                        continue
+                    if not isinstance(data, dict):
+                        continue
+                    pruned_data = Media.prune_source_metadata(source_type, data)
+                    if pruned_data == data:
+                        continue
+                    # .update() avoids triggering any media save signals
+                    Media.objects.filter(pk=pk).update(
+                        metadata=json.dumps(pruned_data, default=json_serial)
+                    )
+                    pruned += 1
+            checked += len(batch)
+            last_pk = batch[-1][0]
+            log.info(f'Checked {checked} media items, pruned {pruned}')
+        size_after = self.get_size()
+        saved = size_before - size_after
+        log.info(f'Metadata size after pruning: {size_after} bytes '
+                 f'(saved {saved} bytes)')
+        log.info('Done')
@@ -2,7 +2,7 @@ from django.core.management.base import BaseCommand, CommandError
 from django.utils.translation import gettext_lazy as _
 from background_task.models import Task
 from sync.models import Source
-from sync.tasks import index_source_task
+from sync.tasks import index_source_task, schedule_housekeeping_task
 
 
 from common.logger import log
@@ -30,4 +30,6 @@ class Command(BaseCommand):
             )
             # This also chains down to call each Media objects .save() as well
             source.save()
+        # Recreate the housekeeping task
+        schedule_housekeeping_task()
         log.info('Done')
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand, CommandError
+from common.logger import log
+from sync.models import Media
+
+
+class Command(BaseCommand):
+
+    help = ('Copies title, duration, upload date, thumbnail, uploader and playlist '
+            'title from media metadata into their own database columns')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', action='store', type=int, default=500,
+                            help='Number of media items to update per query')
+
+    def handle(self, *args, **options):
+        batch_size = options.get('batch_size', 500)
+        if batch_size < 1:
+            raise CommandError(f'Batch size must be at least 1, got {batch_size}')
+        media = Media.objects.exclude(metadata__isnull=True).select_related('source')
+        log.info(f'Updating metadata fields for {media.count()} media items...')
+        updated = 0
+        last_pk = None
+        while True:
+            batch = media.order_by('pk')
+            if last_pk is not None:
+                batch = batch.filter(pk__gt=last_pk)
+            batch = list(batch[:batch_size])
+            if not batch:
+                break
+            for item in batch:
+                item.update_metadata_fields()
+            # .bulk_update() avoids triggering any media save signals
+            Media.objects.bulk_update(batch, Media.METADATA_DERIVED_FIELDS)
+            updated += len(batch)
+            last_pk = batch[-1].pk
+            log.info(f'Updated metadata fields for {updated} media items')
+        log.info('Done')
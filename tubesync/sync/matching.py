@@ -1,10 +1,13 @@
 '''
     Match functions take a single Media object instance as its only argument and return
     two boolean values. The first value is if the match was exact or "best fit", the
-    second argument is the ID of the format that was matched.
+    second argument is the ID of the format that was matched. Formats are read with
+    Media.iter_formats() which uses the stored MediaFormat rows where available.
 '''
 
 
+from functools import lru_cache
+from itertools import product
 from django.conf import settings
 
 
@@ -74,317 +77,129 @@ def get_best_audio_format(media):
         return False, False
 
 
+# Fallback tiers for video formats, tried in order, for each combination of the
+# source (prefer_60fps, prefer_hdr) settings. Each tier is a test of whether a format
+# matches the source (resolution, vcodec) and whether it (is_hdr, is_60fps). The
+# first tier is the exact match, any format matches after the last tier.
+VIDEO_FORMAT_TIERS = {
+    (True, True): (
+        lambda res, vcodec, hdr, fps: res and vcodec and hdr and fps,
+        lambda res, vcodec, hdr, fps: res and hdr and fps,
+        lambda res, vcodec, hdr, fps: vcodec and hdr and fps,
+        lambda res, vcodec, hdr, fps: res and vcodec and fps,
+        lambda res, vcodec, hdr, fps: res and hdr,
+        lambda res, vcodec, hdr, fps: res and fps,
+        lambda res, vcodec, hdr, fps: res and vcodec and hdr,
+        lambda res, vcodec, hdr, fps: res and vcodec,
+        lambda res, vcodec, hdr, fps: res,
+    ),
+    (True, False): (
+        lambda res, vcodec, hdr, fps: res and vcodec and fps and not hdr,
+        lambda res, vcodec, hdr, fps: res and fps and not hdr,
+        lambda res, vcodec, hdr, fps: vcodec and fps and not hdr,
+        lambda res, vcodec, hdr, fps: vcodec and fps,
+        lambda res, vcodec, hdr, fps: res and vcodec and not hdr,
+        lambda res, vcodec, hdr, fps: res and vcodec,
+        lambda res, vcodec, hdr, fps: res,
+    ),
+    (False, True): (
+        lambda res, vcodec, hdr, fps: res and vcodec and hdr,
+        lambda res, vcodec, hdr, fps: res and hdr and not fps,
+        lambda res, vcodec, hdr, fps: vcodec and hdr and not fps,
+        lambda res, vcodec, hdr, fps: vcodec and hdr,
+        lambda res, vcodec, hdr, fps: res and vcodec and not fps,
+        lambda res, vcodec, hdr, fps: res and vcodec,
+        lambda res, vcodec, hdr, fps: res,
+    ),
+    (False, False): (
+        lambda res, vcodec, hdr, fps: res and vcodec and not fps and not hdr,
+        lambda res, vcodec, hdr, fps: res and not hdr and not fps,
+        lambda res, vcodec, hdr, fps: vcodec and not hdr and fps,
+        lambda res, vcodec, hdr, fps: res and vcodec and not hdr,
+        lambda res, vcodec, hdr, fps: res and vcodec and not fps,
+        lambda res, vcodec, hdr, fps: res and vcodec,
+        lambda res, vcodec, hdr, fps: res and not hdr,
+        lambda res, vcodec, hdr, fps: res,
+    ),
+}
+
+
+@lru_cache(maxsize=None)
+def compile_video_format_ranks(prefer_60fps, prefer_hdr, can_fallback):
+    '''
+        Compiles the fallback tiers for a source into a lookup table of the tier
+        each (resolution, vcodec, is_hdr, is_60fps) match combination falls into,
+        lower is better. Tier 0 is an exact match. Formats which do not match any
+        allowed tier are ranked None.
+    '''
+    tiers = VIDEO_FORMAT_TIERS[(bool(prefer_60fps), bool(prefer_hdr))]
+    if not can_fallback:
+        tiers = tiers[:1]
+    ranks = {}
+    for key in product((False, True), repeat=4):
+        for rank, tier in enumerate(tiers):
+            if tier(*key):
+                break
+        else:
+            # Any format is the final fallback, match the highest resolution
+            rank = len(tiers) if can_fallback else None
+        ranks[key] = rank
+    return ranks
+
+
 def get_best_video_format(media):
     '''
         Finds the best match for the source required video format. If the source
         has a 'fallback' of fail this can return no match. Resolution is treated
-        as the most important factor to match. This is pretty verbose due to the
-        'soft' matching requirements for prefer_hdr and prefer_60fps.
+        as the most important factor to match. Formats are ranked in a single pass
+        by the compiled fallback tier they fall into for the source settings, then
+        by height with later formats winning ties.
     '''
+    source = media.source
     # Check if the source wants audio only, fast path to return
-    if media.source.is_audio:
+    if source.is_audio:
         return False, False
-    # Filter video-only formats by resolution that matches the source
-    video_formats = []
-    for fmt in media.iter_formats():
+    source_resolution = source.source_resolution.strip().upper()
+    source_vcodec = source.source_vcodec
+    source_height = source.source_resolution_height
+    can_fallback = source.can_fallback
+    ranks = compile_video_format_ranks(source.prefer_60fps, source.prefer_hdr,
+                                       can_fallback)
+    # Video-only formats in the source resolution are preferred, if there are none
+    # formats of up to the source resolution height are used if we can fallback
+    best_key, best_match = None, None
+    fallback_key, fallback_match = None, None
+    for i, fmt in enumerate(media.iter_formats()):
         # If the format has an audio stream, skip it
         if fmt['acodec'] is not None:
             continue
-        if not fmt['vcodec']:
-            continue
-        if media.source.source_resolution.strip().upper() == fmt['format']:
-            video_formats.append(fmt)
-    # Check we matched some streams
-    if not video_formats:
-        # No streams match the requested resolution, see if we can fallback
-        if media.source.can_fallback:
-            # Find the next-best format matches by height
-            for fmt in media.iter_formats():
-                # If the format has an audio stream, skip it
-                if fmt['acodec'] is not None:
-                    continue
-                if (fmt['height'] <= media.source.source_resolution_height and 
-                    fmt['height'] >= min_height):
-                    video_formats.append(fmt)
-        else:
-            # Can't fallback
-            return False, False
-    video_formats = list(reversed(sorted(video_formats, key=lambda k: k['height'])))
-    source_resolution = media.source.source_resolution.strip().upper()
-    source_vcodec = media.source.source_vcodec
-    if not video_formats:
-        # Still no matches
+        res_match = source_resolution == fmt['format']
+        if res_match and fmt['vcodec']:
+            rank = ranks[(True, source_vcodec == fmt['vcodec'],
+                          bool(fmt['is_hdr']), bool(fmt['is_60fps']))]
+            if rank is not None:
+                key = (rank, -fmt['height'], -i)
+                if best_key is None or key < best_key:
+                    best_key, best_match = key, fmt
+        elif (can_fallback and best_key is None and
+              min_height <= fmt['height'] <= source_height):
+            rank = ranks[(res_match, source_vcodec == fmt['vcodec'],
+                          bool(fmt['is_hdr']), bool(fmt['is_60fps']))]
+            key = (rank, -fmt['height'], -i)
+            if fallback_key is None or key < fallback_key:
+                fallback_key, fallback_match = key, fmt
+    if best_key is None:
+        best_key, best_match = fallback_key, fallback_match
+    if not best_match:
+        # Nope, failed to find match
         return False, False
-    exact_match, best_match = None, None
-    # Of our filtered video formats, check for resolution + codec + hdr + fps match
-    if media.source.prefer_60fps and media.source.prefer_hdr:
-        for fmt in video_formats:
-            # Check for an exact match
-            if (source_resolution == fmt['format'] and
-                source_vcodec == fmt['vcodec'] and 
-                fmt['is_hdr'] and
-                fmt['is_60fps']):
-                # Exact match
-                exact_match, best_match = True, fmt
-                break
-        if media.source.can_fallback:
-            if not best_match:
-                for fmt in video_formats:
-                    # Check for a resolution, hdr and fps match but drop the codec
-                    if (source_resolution == fmt['format'] and 
-                        fmt['is_hdr'] and fmt['is_60fps']):
-                        # Close match
-                        exact_match, best_match = False, fmt
-                        break
-            if not best_match:
-                for fmt in video_formats:
-                    # Check for a codec, hdr and fps match but drop the resolution
-                    if (source_vcodec == fmt['vcodec'] and 
-                        fmt['is_hdr'] and fmt['is_60fps']):
-                        # Close match
-                        exact_match, best_match = False, fmt
-                        break
-            if not best_match:
-                for fmt in video_formats:
-                    # Check for resolution, codec and 60fps match
-                    if (source_resolution == fmt['format'] and
-                        source_vcodec == fmt['vcodec'] and
-                        fmt['is_60fps']):
-                        exact_match, best_match = False, fmt
-                        break
-            if not best_match:
-                for fmt in video_formats:
-                    # Check for resolution and hdr match
-                    if (source_resolution == fmt['format'] and
-                        fmt['is_hdr']):
-                        exact_match, best_match = False, fmt
-                        break
-            if not best_match:
-                for fmt in video_formats:
-                    # Check for resolution and 60fps match
-                    if (source_resolution == fmt['format'] and
-                        fmt['is_60fps']):
-                        exact_match, best_match = False, fmt
-                        break
-            if not best_match:
-                for fmt in video_formats:
-                    # Check for resolution, codec and hdr match
-                    if (source_resolution == fmt['format'] and
-                        source_vcodec == fmt['vcodec'] and
-                        fmt['is_hdr']):
-                        exact_match, best_match = False, fmt
-                        break
-            if not best_match:
-                for fmt in video_formats:
-                    # Check for resolution and codec
-                    if (source_resolution == fmt['format'] and
-                        source_vcodec == fmt['vcodec']):
-                        exact_match, best_match = False, fmt
-                        break
-            if not best_match:
-                for fmt in video_formats:
-                    # Check for resolution
-                    if source_resolution == fmt['format']:
-                        exact_match, best_match = False, fmt
-                        break
-            if not best_match:
-                # Match the highest resolution
-                exact_match, best_match = False, video_formats[0]
-    # Check for resolution + codec + fps match
-    if media.source.prefer_60fps and not media.source.prefer_hdr:
-        for fmt in video_formats:
-            # Check for an exact match
-            if (source_resolution == fmt['format'] and
-                source_vcodec == fmt['vcodec'] and 
-                fmt['is_60fps'] and
-                not fmt['is_hdr']):
-                # Exact match
-                exact_match, best_match = True, fmt
-                break
-        if media.source.can_fallback:
-            if not best_match:
-                for fmt in video_formats:
-                    # Check for a resolution and fps match but drop the codec
-                    if (source_resolution == fmt['format'] and 
-                        fmt['is_60fps'] and
-                        not fmt['is_hdr']):
-                        exact_match, best_match = False, fmt
-                        break
-            if not best_match:
-                for fmt in video_formats:
-                    # Check for a codec and fps match but drop the resolution
-                    if (source_vcodec == fmt['vcodec'] and 
-                        fmt['is_60fps'] and
-                        not fmt['is_hdr']):
-                        exact_match, best_match = False, fmt
-                        break
-            if not best_match:
-                for fmt in video_formats:
-                    # Check for a codec and 60fps match
-                    if (source_vcodec == fmt['vcodec'] and 
-                        fmt['is_60fps']):
-                        exact_match, best_match = False, fmt
-                        break
-            if not best_match:
-                for fmt in video_formats:
-                    # Check for codec and resolution match bot drop 60fps
-                    if (source_resolution == fmt['format'] and
-                        source_vcodec == fmt['vcodec'] and
-                        not fmt['is_hdr']):
-                        exact_match, best_match = False, fmt
-                        break
-            if not best_match:
-                for fmt in video_formats:
-                    # Check for codec and resolution match only
-                    if (source_resolution == fmt['format'] and
-                        source_vcodec == fmt['vcodec']):
-                        exact_match, best_match = False, fmt
-                        break
-            if not best_match:
-                for fmt in video_formats:
-                    # Check for resolution
-                    if source_resolution == fmt['format']:
-                        exact_match, best_match = False, fmt
-                        break
-            if not best_match:
-                # Match the highest resolution
-                exact_match, best_match = False, video_formats[0]
-    # Check for resolution + codec + hdr
-    elif media.source.prefer_hdr and not media.source.prefer_60fps:
-        for fmt in video_formats:
-            # Check for an exact match
-            if (source_resolution == fmt['format'] and
-                source_vcodec == fmt['vcodec'] and 
-                fmt['is_hdr']):
-                # Exact match
-                exact_match, best_match = True, fmt
-                break
-        if media.source.can_fallback:
-            if not best_match:
-                for fmt in video_formats:
-                    # Check for a resolution and fps match but drop the codec
-                    if (source_resolution == fmt['format'] and 
-                        fmt['is_hdr'] and
-                        not fmt['is_60fps']):
-                        exact_match, best_match = False, fmt
-                        break
-            if not best_match:
-                for fmt in video_formats:
-                    # Check for a codec and fps match but drop the resolution
-                    if (source_vcodec == fmt['vcodec'] and 
-                        fmt['is_hdr'] and
-                        not fmt['is_60fps']):
-                        exact_match, best_match = False, fmt
-                        break
-            if not best_match:
-                for fmt in video_formats:
-                    # Check for a codec and 60fps match
-                    if (source_vcodec == fmt['vcodec'] and 
-                        fmt['is_hdr']):
-                        exact_match, best_match = False, fmt
-                        break
-            if not best_match:
-                for fmt in video_formats:
-                    # Check for codec and resolution match bot drop hdr
-                    if (source_resolution == fmt['format'] and
-                        source_vcodec == fmt['vcodec'] and
-                        not fmt['is_60fps']):
-                        exact_match, best_match = False, fmt
-                        break
-            if not best_match:
-                for fmt in video_formats:
-                    # Check for codec and resolution match only
-                    if (source_resolution == fmt['format'] and
-                        source_vcodec == fmt['vcodec']):
-                        exact_match, best_match = False, fmt
-                        break
-            if not best_match:
-                for fmt in video_formats:
-                    # Check for resolution
-                    if source_resolution == fmt['format']:
-                        exact_match, best_match = False, fmt
-                        break
-            if not best_match:
-                # Match the highest resolution
-                exact_match, best_match = False, video_formats[0]
-    # check for resolution + codec
-    elif not media.source.prefer_hdr and not media.source.prefer_60fps:
-        for fmt in video_formats:
-            # Check for an exact match
-            if (source_resolution == fmt['format'] and
-                source_vcodec == fmt['vcodec'] and
-                not fmt['is_60fps'] and
-                not fmt['is_hdr']):
-                # Exact match
-                exact_match, best_match = True, fmt
-                break
-        if media.source.can_fallback:
-            if not best_match:
-                for fmt in video_formats:
-                    # Check for a resolution, hdr and fps match but drop the codec
-                    if (source_resolution == fmt['format'] and 
-                        not fmt['is_hdr'] and not fmt['is_60fps']):
-                        # Close match
-                        exact_match, best_match = False, fmt
-                        break
-            if not best_match:
-                for fmt in video_formats:
-                    # Check for a codec, hdr and fps match but drop the resolution
-                    if (source_vcodec == fmt['vcodec'] and 
-                        not fmt['is_hdr'] and fmt['is_60fps']):
-                        # Close match
-                        exact_match, best_match = False, fmt
-                        break
-            if not best_match:
-                for fmt in video_formats:
-                    # Check for resolution, codec and hdr match
-                    if (source_resolution == fmt['format'] and
-                        source_vcodec == fmt['vcodec'] and
-                        not fmt['is_hdr']):
-                        exact_match, best_match = False, fmt
-                        break
-            if not best_match:
-                for fmt in video_formats:
-                    # Check for resolution, codec and 60fps match
-                    if (source_resolution == fmt['format'] and
-                        source_vcodec == fmt['vcodec'] and
-                        not fmt['is_60fps']):
-                        exact_match, best_match = False, fmt
-                        break
-            if not best_match:
-                for fmt in video_formats:
-                    # Check for resolution and codec
-                    if (source_resolution == fmt['format'] and
-                        source_vcodec == fmt['vcodec']):
-                        exact_match, best_match = False, fmt
-                        break
-            if not best_match:
-                for fmt in video_formats:
-                    # Check for resolution and not hdr
-                    if (source_resolution == fmt['format'] and
-                        not fmt['is_hdr']):
-                        exact_match, best_match = False, fmt
-                        break
-            if not best_match:
-                for fmt in video_formats:
-                    # Check for resolution
-                    if source_resolution == fmt['format']:
-                        exact_match, best_match = False, fmt
-                        break
-            if not best_match:
-                # Match the highest resolution
-                exact_match, best_match = False, video_formats[0]
-    # See if we found a match
-    if best_match:
-        # Final check to see if the match we found was good enough
-        if exact_match:
-            return True, best_match['id']
-        elif media.source.can_fallback:
-            # Allow the fallback if it meets requirements
-            if (media.source.fallback == media.source.FALLBACK_NEXT_BEST_HD and
-                best_match['height'] >= fallback_hd_cutoff):
-                return False, best_match['id']
-            elif media.source.fallback == media.source.FALLBACK_NEXT_BEST:
-                return False, best_match['id']
+    # Final check to see if the match we found was good enough
+    if best_key[0] == 0:
+        return True, best_match['id']
+    if (source.fallback == source.FALLBACK_NEXT_BEST_HD and
+        best_match['height'] >= fallback_hd_cutoff):
+        return False, best_match['id']
+    elif source.fallback == source.FALLBACK_NEXT_BEST:
+        return False, best_match['id']
     # Nope, failed to find match
     return False, False
@@ -0,0 +1,42 @@
+# Generated by Django 3.2.25 on 2026-10-17 05:59
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sync', '0025_add_video_type_support'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MediaFormat',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.PositiveSmallIntegerField(help_text='Position of the format in the metadata format list', verbose_name='position')),
+                ('format_id', models.CharField(db_index=True, help_text='Format ID, such as a YouTube itag', max_length=100, verbose_name='format id')),
+                ('format', models.CharField(blank=True, help_text='Normalised format name, such as 1080P', max_length=100, null=True, verbose_name='format')),
+                ('format_verbose', models.CharField(blank=True, default='', help_text='Full format description', max_length=200, verbose_name='format verbose')),
+                ('height', models.PositiveIntegerField(default=0, help_text='Height in pixels of the format', verbose_name='height')),
+                ('width', models.PositiveIntegerField(default=0, help_text='Width in pixels of the format', verbose_name='width')),
+                ('vcodec', models.CharField(blank=True, db_index=True, help_text='Video codec of the format, if any', max_length=30, null=True, verbose_name='video codec')),
+                ('acodec', models.CharField(blank=True, db_index=True, help_text='Audio codec of the format, if any', max_length=30, null=True, verbose_name='audio codec')),
+                ('fps', models.FloatField(blank=True, help_text='Frames per second of the format', null=True, verbose_name='fps')),
+                ('vbr', models.FloatField(blank=True, help_text='Total bitrate of the format', null=True, verbose_name='video bitrate')),
+                ('abr', models.FloatField(blank=True, help_text='Audio bitrate of the format', null=True, verbose_name='audio bitrate')),
+                ('is_60fps', models.BooleanField(default=False, help_text='Format is 60fps', verbose_name='is 60fps')),
+                ('is_hdr', models.BooleanField(default=False, help_text='Format is HDR', verbose_name='is hdr')),
+                ('is_hls', models.BooleanField(default=False, help_text='Format is HLS', verbose_name='is hls')),
+                ('is_dash', models.BooleanField(default=False, help_text='Format is DASH', verbose_name='is dash')),
+                ('media', models.ForeignKey(help_text='Media the format belongs to', on_delete=django.db.models.deletion.CASCADE, related_name='media_formats', to='sync.media')),
+            ],
+            options={
+                'verbose_name': 'Media Format',
+                'verbose_name_plural': 'Media Formats',
+                'ordering': ('media', 'position'),
+                'unique_together': {('media', 'position')},
+            },
+        ),
+    ]
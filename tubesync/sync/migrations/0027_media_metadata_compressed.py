@@ -0,0 +1,19 @@
+# Generated by Django 3.2.25 on 2026-10-17 05:59
+
+from django.db import migrations
+import sync.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sync', '0026_media_format'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='media',
+            name='metadata',
+            field=sync.fields.CompressedTextField(blank=True, help_text='JSON encoded metadata for the media', null=True, verbose_name='metadata'),
+        ),
+    ]
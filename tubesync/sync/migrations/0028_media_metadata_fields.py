@@ -0,0 +1,65 @@
+# Generated by Django 3.2.25 on 2026-10-17 06:02
+
+import json
+from datetime import datetime
+from django.db import migrations, models
+
+
+def copy_metadata_fields(apps, schema_editor):
+    # Populate the new columns for existing media so filenames and NFO files which
+    # use them don't change, "./manage.py update-metadata-fields" does the same
+    Media = apps.get_model('sync', 'Media')
+    fields = ('upload_date', 'thumbnail', 'uploader', 'playlist_title')
+    batch = []
+    for media in Media.objects.exclude(metadata__isnull=True).only('pk', 'metadata').iterator(chunk_size=500):
+        try:
+            metadata = json.loads(media.metadata)
+        except ValueError:
+            continue
+        if not isinstance(metadata, dict):
+            continue
+        try:
+            upload_date = datetime.strptime(metadata.get('upload_date', '').strip(), '%Y%m%d')
+            media.upload_date = upload_date.date()
+        except (AttributeError, ValueError):
+            media.upload_date = None
+        media.thumbnail = (metadata.get('thumbnail', '') or '').strip()[:1000]
+        media.uploader = (metadata.get('uploader', '') or '')[:200]
+        media.playlist_title = (metadata.get('playlist_title', '') or '')[:200]
+        batch.append(media)
+        if len(batch) >= 500:
+            Media.objects.bulk_update(batch, fields)
+            batch = []
+    if batch:
+        Media.objects.bulk_update(batch, fields)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sync', '0027_media_metadata_compressed'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='media',
+            name='playlist_title',
+            field=models.CharField(blank=True, db_index=True, default='', help_text='Title of the playlist the media was indexed from', max_length=200, verbose_name='playlist title'),
+        ),
+        migrations.AddField(
+            model_name='media',
+            name='thumbnail',
+            field=models.CharField(blank=True, default='', help_text='URL of the media thumbnail on the source', max_length=1000, verbose_name='thumbnail'),
+        ),
+        migrations.AddField(
+            model_name='media',
+            name='upload_date',
+            field=models.DateField(blank=True, db_index=True, help_text='Date the media was uploaded to the source', null=True, verbose_name='upload date'),
+        ),
+        migrations.AddField(
+            model_name='media',
+            name='uploader',
+            field=models.CharField(blank=True, db_index=True, default='', help_text='Name of the media uploader', max_length=200, verbose_name='uploader'),
+        ),
+        migrations.RunPython(copy_metadata_fields, migrations.RunPython.noop),
+    ]
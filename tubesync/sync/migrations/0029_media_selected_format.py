@@ -0,0 +1,23 @@
+# Generated by Django 3.2.25 on 2026-10-17 06:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sync', '0028_media_metadata_fields'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='media',
+            name='selected_format',
+            field=models.CharField(blank=True, default='', help_text='Format string chosen for the media, empty if no format matched', max_length=200, verbose_name='selected format'),
+        ),
+        migrations.AddField(
+            model_name='media',
+            name='selected_format_fingerprint',
+            field=models.CharField(blank=True, default='', help_text='Fingerprint of the source settings the format was chosen with', max_length=40, verbose_name='selected format fingerprint'),
+        ),
+    ]
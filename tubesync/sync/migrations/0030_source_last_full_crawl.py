@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-17 06:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sync', '0029_media_selected_format'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='source',
+            name='last_full_crawl',
+            field=models.DateTimeField(blank=True, help_text='Date and time all media in the source was last crawled', null=True, verbose_name='last full crawl'),
+        ),
+    ]
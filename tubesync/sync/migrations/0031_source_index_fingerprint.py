@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-17 06:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sync', '0030_source_last_full_crawl'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='source',
+            name='index_fingerprint',
+            field=models.CharField(blank=True, default='', help_text='Fingerprint of the media keys found by the last index of the source', max_length=40, verbose_name='index fingerprint'),
+        ),
+    ]
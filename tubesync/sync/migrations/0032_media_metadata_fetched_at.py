@@ -0,0 +1,27 @@
+# Generated by Django 3.2.25 on 2026-10-17 06:19
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def set_metadata_fetched_at(apps, schema_editor):
+    # Metadata for existing media was downloaded soon after the media was created,
+    # use that rather than refreshing all the existing metadata at once
+    Media = apps.get_model('sync', 'Media')
+    Media.objects.exclude(metadata__isnull=True).update(metadata_fetched_at=F('created'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sync', '0031_source_index_fingerprint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='media',
+            name='metadata_fetched_at',
+            field=models.DateTimeField(blank=True, db_index=True, help_text='Date and time the metadata for the media was last downloaded', null=True, verbose_name='metadata fetched at'),
+        ),
+        migrations.RunPython(set_metadata_fetched_at, migrations.RunPython.noop),
+    ]
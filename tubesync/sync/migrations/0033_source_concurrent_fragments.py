@@ -0,0 +1,19 @@
+# Generated by Django 3.2.25 on 2026-10-17 06:25
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sync', '0032_media_metadata_fetched_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='source',
+            name='concurrent_fragments',
+            field=models.PositiveSmallIntegerField(default=0, help_text='Number of fragments of DASH and HLS media downloaded at once, 0 uses the global default', validators=[django.core.validators.MaxValueValidator(16)], verbose_name='concurrent fragments'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 3.2.25 on 2026-10-17 06:29
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sync', '0033_source_concurrent_fragments'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='source',
+            name='downloader',
+            field=models.CharField(choices=[('default', 'Default'), ('native', 'Native (yt-dlp)'), ('aria2c', 'aria2c, multiple connections per file')], default='default', help_text='Downloader for media which is not split into fragments, the native downloader is used if an external downloader is not installed', max_length=16, verbose_name='downloader'),
+        ),
+        migrations.AddField(
+            model_name='source',
+            name='downloader_connections',
+            field=models.PositiveSmallIntegerField(default=0, help_text='Number of connections per file for external downloaders, 0 uses the global default', validators=[django.core.validators.MaxValueValidator(16)], verbose_name='downloader connections'),
+        ),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 3.2.25 on 2026-10-17 07:10
+
+import json
+from django.db import migrations
+from sync.utils import parse_media_format
+
+
+def create_media_formats(apps, schema_editor):
+    # Store the formats of media whose metadata was downloaded before the
+    # MediaFormat table existed, otherwise every access to their formats looks for
+    # rows which don't exist before parsing the metadata
+    Media = apps.get_model('sync', 'Media')
+    MediaFormat = apps.get_model('sync', 'MediaFormat')
+    batch = []
+    media_items = Media.objects.exclude(metadata__isnull=True).filter(
+        media_formats__isnull=True).only('pk', 'metadata')
+    for media in media_items.iterator(chunk_size=500):
+        try:
+            metadata = json.loads(media.metadata)
+        except ValueError:
+            continue
+        if not isinstance(metadata, dict):
+            continue
+        for position, fmt in enumerate(metadata.get('formats', None) or []):
+            fmt = parse_media_format(fmt)
+            batch.append(MediaFormat(
+                media_id=media.pk,
+                position=position,
+                format_id=fmt['id'],
+                format=fmt['format'],
+                format_verbose=(fmt['format_verbose'] or '')[:200],
+                height=fmt['height'],
+                width=fmt['width'],
+                vcodec=fmt['vcodec'],
+                acodec=fmt['acodec'],
+                fps=fmt['fps'],
+                vbr=fmt['vbr'],
+                abr=fmt['abr'],
+                is_60fps=fmt['is_60fps'],
+                is_hdr=fmt['is_hdr'],
+                is_hls=fmt['is_hls'],
+                is_dash=fmt['is_dash'],
+            ))
+        if len(batch) >= 500:
+            MediaFormat.objects.bulk_create(batch)
+            batch = []
+    if batch:
+        MediaFormat.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sync', '0034_source_downloader'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_media_formats, migrations.RunPython.noop),
+    ]
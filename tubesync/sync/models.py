@@ -2,28 +2,35 @@ import os
 import uuid
 import json
 import re
+import time
+from hashlib import sha1
 from xml.etree import ElementTree
 from collections import OrderedDict
+from contextlib import closing
 from datetime import datetime, timedelta
 from pathlib import Path
 from django.conf import settings
 from django.db import models
 from django.core.exceptions import SuspiciousOperation
 from django.core.files.storage import FileSystemStorage
-from django.core.validators import RegexValidator
+from django.core.validators import RegexValidator, MaxValueValidator
 from django.utils.text import slugify
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
+from common.logger import log
 from common.errors import NoFormatException
 from common.utils import clean_filename, clean_emoji
 from .youtube import (get_media_info as get_youtube_media_info,
+                      iter_media_info_entries as iter_youtube_media_info_entries,
                       download_media as download_youtube_media,
-                      get_channel_image_info as get_youtube_channel_image_info)
-from .utils import seconds_to_timestr, parse_media_format
+                      get_channel_image_info as get_youtube_channel_image_info,
+                      get_partial_download_dir, DownloadProgress)
+from .utils import (seconds_to_timestr, parse_media_format, prune_metadata,
+                    iter_concurrently, whole_number)
 from .matching import (get_best_combined_format, get_best_audio_format,
                        get_best_video_format)
 from .mediaservers import PlexMediaServer
-from .fields import CommaSepChoiceField
+from .fields import CommaSepChoiceField, CompressedTextField
 
 media_file_storage = FileSystemStorage(location=str(settings.DOWNLOAD_ROOT), base_url='/media-data/')
 
@@ -104,6 +111,16 @@ class Source(models.Model):
         (FALLBACK_NEXT_BEST_HD, _('Get next best resolution but at least HD'))
     )
 
+    DOWNLOADER_DEFAULT = 'default'
+    DOWNLOADER_NATIVE = 'native'
+    DOWNLOADER_ARIA2C = 'aria2c'
+    DOWNLOADERS = (DOWNLOADER_DEFAULT, DOWNLOADER_NATIVE, DOWNLOADER_ARIA2C)
+    DOWNLOADER_CHOICES = (
+        (DOWNLOADER_DEFAULT, _('Default')),
+        (DOWNLOADER_NATIVE, _('Native (yt-dlp)')),
+        (DOWNLOADER_ARIA2C, _('aria2c, multiple connections per file')),
+    )
+
     FILTER_SECONDS_CHOICES = (
         (True, _('Minimum Length')),
         (False, _('Maximum Length')),
@@ -169,12 +186,17 @@ class Source(models.Model):
         SOURCE_TYPE_YOUTUBE_CHANNEL_ID: 'https://www.youtube.com/channel/{key}/{type}',
         SOURCE_TYPE_YOUTUBE_PLAYLIST: 'https://www.youtube.com/playlist?list={key}',
     }
-    # Callback functions to get a list of media from the source
+    # Callback functions to lazily iterate over the media in the source
     INDEXERS = {
-        SOURCE_TYPE_YOUTUBE_CHANNEL: get_youtube_media_info,
-        SOURCE_TYPE_YOUTUBE_CHANNEL_ID: get_youtube_media_info,
-        SOURCE_TYPE_YOUTUBE_PLAYLIST: get_youtube_media_info,
+        SOURCE_TYPE_YOUTUBE_CHANNEL: iter_youtube_media_info_entries,
+        SOURCE_TYPE_YOUTUBE_CHANNEL_ID: iter_youtube_media_info_entries,
+        SOURCE_TYPE_YOUTUBE_PLAYLIST: iter_youtube_media_info_entries,
     }
+    # Source types which list the newest media first, these can be indexed
+    # incrementally by stopping at already known media
+    INCREMENTAL_SOURCE_TYPES = (SOURCE_TYPE_YOUTUBE_CHANNEL, SOURCE_TYPE_YOUTUBE_CHANNEL_ID)
+    # Fields updated by indexing, saving only these does not affect the media
+    INDEX_STATE_FIELDS = ('has_failed', 'last_crawl', 'last_full_crawl', 'index_fingerprint')
     # Field names to find the media ID used as the key when storing media
     KEY_FIELD = {
         SOURCE_TYPE_YOUTUBE_CHANNEL: 'id',
@@ -227,6 +249,19 @@ class Source(models.Model):
         blank=True,
         help_text=_('Date and time the source was last crawled')
     )
+    last_full_crawl = models.DateTimeField(
+        _('last full crawl'),
+        null=True,
+        blank=True,
+        help_text=_('Date and time all media in the source was last crawled')
+    )
+    index_fingerprint = models.CharField(
+        _('index fingerprint'),
+        max_length=40,
+        blank=True,
+        default='',
+        help_text=_('Fingerprint of the media keys found by the last index of the source')
+    )
     source_type = models.CharField(
         _('source type'),
         max_length=1,
@@ -427,6 +462,29 @@ class Source(models.Model):
             )
         ]
     )
+    concurrent_fragments = models.PositiveSmallIntegerField(
+        _('concurrent fragments'),
+        default=0,
+        validators=[MaxValueValidator(16)],
+        help_text=_('Number of fragments of DASH and HLS media downloaded at once, 0 '
+                    'uses the global default')
+    )
+    downloader = models.CharField(
+        _('downloader'),
+        max_length=16,
+        choices=DOWNLOADER_CHOICES,
+        default=DOWNLOADER_DEFAULT,
+        help_text=_('Downloader for media which is not split into fragments, the '
+                    'native downloader is used if an external downloader is not '
+                    'installed')
+    )
+    downloader_connections = models.PositiveSmallIntegerField(
+        _('downloader connections'),
+        default=0,
+        validators=[MaxValueValidator(16)],
+        help_text=_('Number of connections per file for external downloaders, 0 uses '
+                    'the global default')
+    )
 
     def __str__(self):
         return self.name
@@ -439,6 +497,24 @@ class Source(models.Model):
     def icon(self):
         return self.ICONS.get(self.source_type)
 
+    @property
+    def download_concurrent_fragments(self):
+        if self.concurrent_fragments > 0:
+            return self.concurrent_fragments
+        return max(1, getattr(settings, 'DOWNLOAD_CONCURRENT_FRAGMENTS', 1))
+
+    @property
+    def download_downloader(self):
+        if self.downloader != self.DOWNLOADER_DEFAULT:
+            return self.downloader
+        return getattr(settings, 'DOWNLOAD_DOWNLOADER', self.DOWNLOADER_NATIVE)
+
+    @property
+    def download_downloader_connections(self):
+        if self.downloader_connections > 0:
+            return self.downloader_connections
+        return max(1, getattr(settings, 'DOWNLOAD_DOWNLOADER_CONNECTIONS', 1))
+
     @property
     def slugname(self):
         replaced = self.name.replace('_', '-').replace('&', 'and').replace('+', 'and')
@@ -546,6 +622,25 @@ class Source(models.Model):
     def can_fallback(self):
         return self.fallback != self.FALLBACK_FAIL
 
+    @property
+    def format_fingerprint(self):
+        '''
+            Returns a short hash of the settings which affect the format chosen for
+            media from this source. Media store the fingerprint with their selected
+            format so the selection is only recalculated when these settings change.
+        '''
+        parts = (
+            self.source_resolution,
+            self.source_vcodec,
+            self.source_acodec,
+            self.prefer_60fps,
+            self.prefer_hdr,
+            self.fallback,
+            getattr(settings, 'VIDEO_HEIGHT_CUTOFF', 360),
+            getattr(settings, 'VIDEO_HEIGHT_IS_HD', 500),
+        )
+        return sha1('|'.join(map(str, parts)).encode()).hexdigest()[:16]
+
     @property
     def example_media_format_dict(self):
         '''
@@ -599,31 +694,97 @@ class Source(models.Model):
             return True
         return bool(re.search(self.filter_text, media_item_title))
 
-    def get_index(self, type):
+    @property
+    def can_index_incrementally(self):
+        return (self.source_type in self.INCREMENTAL_SOURCE_TYPES and
+                settings.INDEX_INCREMENTAL_KNOWN_LIMIT > 0)
+
+    @property
+    def needs_full_index(self):
+        '''
+            Returns True if the next index of the source should fetch all media, which
+            is required to find media removed from the source. Sources which list the
+            newest media first are fully indexed every INDEX_FULL_INTERVAL_HOURS and
+            incrementally indexed otherwise.
+        '''
+        if not self.can_index_incrementally or not self.last_full_crawl:
+            return True
+        interval = timedelta(hours=settings.INDEX_FULL_INTERVAL_HOURS)
+        return self.last_full_crawl + interval <= timezone.now()
+
+    def iter_index(self, type, known_keys=None):
+        '''
+            Lazily yields the entries for a source index type as dicts, pages of the
+            index are only fetched as they are needed. If known_keys is set this
+            stops once INDEX_INCREMENTAL_KNOWN_LIMIT consecutive entries are known.
+        '''
         indexer = self.INDEXERS.get(self.source_type, None)
         if not callable(indexer):
             raise Exception(f'Source type f"{self.source_type}" has no indexer')
-        response = indexer(self.get_index_url(type=type))
-        if not isinstance(response, dict):
-            return []
-        entries = response.get('entries', []) 
-        return entries
+        limit = settings.INDEX_INCREMENTAL_KNOWN_LIMIT
+        known_run = 0
+        count = 0
+        start = time.monotonic()
+        try:
+            for entry in indexer(self.get_index_url(type=type)):
+                count += 1
+                yield entry
+                if known_keys is None:
+                    continue
+                if entry.get(self.key_field, None) in known_keys:
+                    known_run += 1
+                    if known_run >= limit:
+                        return
+                else:
+                    known_run = 0
+        finally:
+            elapsed = time.monotonic() - start
+            log.info(f'Indexed {count} entries from the {type} tab of source: '
+                     f'{self} in {elapsed:.2f} seconds')
 
-    def index_media(self):
+    def index_media(self, incremental=False, known_keys=None):
         '''
-            Index the media source returning a list of media metadata as dicts.
+            Index the media source yielding media metadata as dicts. If incremental
+            is True only the newest media are indexed, see iter_index(), known_keys
+            is the set of keys of the known media and is loaded if it is not set.
+            Videos and streams tabs are indexed concurrently with their entries
+            merged and de-duplicated by key. Indexing stops after
+            MAX_ENTRIES_PROCESSING entries if it is set.
         '''
-        entries = list()
+        types = []
         if self.index_videos:
-            entries += self.get_index('videos')
+            types.append('videos')
         # Playlists do something different that I have yet to figure out
         if self.source_type != Source.SOURCE_TYPE_YOUTUBE_PLAYLIST:
             if self.index_streams:
-                entries += self.get_index('streams')
+                types.append('streams')
+        if not incremental:
+            known_keys = None
+        elif known_keys is None:
+            known_keys = set(self.media_source.values_list('key', flat=True))
+        if len(types) > 1:
+            entries = iter_concurrently(
+                (self.iter_index(type, known_keys) for type in types),
+                max_workers=settings.INDEX_TAB_WORKERS
+            )
+        else:
+            entries = (entry for type in types for entry in self.iter_index(type, known_keys))
+        max_entries = settings.MAX_ENTRIES_PROCESSING
+        seen_keys = set()
+        count = 0
+        # Closing the entries stops fetching the index once enough are processed
+        with closing(entries):
+            for entry in entries:
+                key = entry.get(self.key_field, None)
+                if key in seen_keys:
+                    continue
+                if key:
+                    seen_keys.add(key)
+                yield entry
+                count += 1
+                if max_entries and count >= max_entries:
+                    break
 
-        if settings.MAX_ENTRIES_PROCESSING:
-            entries = entries[:settings.MAX_ENTRIES_PROCESSING]
-        return entries
 
 def get_media_thumb_path(instance, filename):
     fileid = str(instance.uuid)
@@ -722,6 +883,17 @@ class Media(models.Model):
             Source.SOURCE_TYPE_YOUTUBE_PLAYLIST: 'playlist_title',
         },
     }
+    # Top level metadata keys kept when pruning metadata in addition to the keys in
+    # METADATA_FIELDS and any keys in settings.MEDIA_METADATA_EXTRA_FIELDS
+    METADATA_KEEP_FIELDS = ('id', 'webpage_url', 'channel', 'channel_id',
+                            'channel_url', 'uploader_id', 'uploader_url', 'timestamp',
+                            'release_timestamp', 'tags', 'view_count', 'live_status',
+                            'is_live', 'was_live', 'availability', 'epoch')
+    # Keys removed from every format when pruning metadata, none are used by the
+    # format matchers and the URLs expire anyway
+    METADATA_FORMAT_DROP_FIELDS = ('url', 'manifest_url', 'fragments',
+                                   'fragment_base_url', 'http_headers',
+                                   'downloader_options')
     STATE_UNKNOWN = 'unknown'
     STATE_SCHEDULED = 'scheduled'
     STATE_DOWNLOADING = 'downloading'
@@ -740,6 +912,9 @@ class Media(models.Model):
         STATE_DISABLED_AT_SOURCE: '<i class="fas fa-stop-circle" title="Media downloading disabled at source"></i>',
         STATE_ERROR: '<i class="fas fa-exclamation-triangle" title="Error downloading"></i>',
     }
+    # Process-wide hit and miss counters for the parsed metadata cache
+    metadata_cache_hits = 0
+    metadata_cache_misses = 0
 
     uuid = models.UUIDField(
         _('uuid'),
@@ -795,12 +970,19 @@ class Media(models.Model):
         null=True,
         help_text=_('Height (Y) of the thumbnail')
     )
-    metadata = models.TextField(
+    metadata = CompressedTextField(
         _('metadata'),
         blank=True,
         null=True,
         help_text=_('JSON encoded metadata for the media')
     )
+    metadata_fetched_at = models.DateTimeField(
+        _('metadata fetched at'),
+        db_index=True,
+        null=True,
+        blank=True,
+        help_text=_('Date and time the metadata for the media was last downloaded')
+    )
     can_download = models.BooleanField(
         _('can download'),
         db_index=True,
@@ -913,6 +1095,55 @@ class Media(models.Model):
         default='',
         help_text=_('Video title')
     )
+    upload_date = models.DateField(
+        _('upload date'),
+        db_index=True,
+        blank=True,
+        null=True,
+        help_text=_('Date the media was uploaded to the source')
+    )
+    thumbnail = models.CharField(
+        _('thumbnail'),
+        max_length=1000,
+        blank=True,
+        null=False,
+        default='',
+        help_text=_('URL of the media thumbnail on the source')
+    )
+    uploader = models.CharField(
+        _('uploader'),
+        max_length=200,
+        db_index=True,
+        blank=True,
+        null=False,
+        default='',
+        help_text=_('Name of the media uploader')
+    )
+    playlist_title = models.CharField(
+        _('playlist title'),
+        max_length=200,
+        db_index=True,
+        blank=True,
+        null=False,
+        default='',
+        help_text=_('Title of the playlist the media was indexed from')
+    )
+    selected_format = models.CharField(
+        _('selected format'),
+        max_length=200,
+        blank=True,
+        null=False,
+        default='',
+        help_text=_('Format string chosen for the media, empty if no format matched')
+    )
+    selected_format_fingerprint = models.CharField(
+        _('selected format fingerprint'),
+        max_length=40,
+        blank=True,
+        null=False,
+        default='',
+        help_text=_('Fingerprint of the source settings the format was chosen with')
+    )
 
     def __str__(self):
         return self.key
@@ -924,28 +1155,133 @@ class Media(models.Model):
             ('source', 'key'),
         )
 
+    # Fields copied from the metadata into their own columns when metadata is saved
+    METADATA_DERIVED_FIELDS = ('title', 'duration', 'upload_date', 'thumbnail',
+                               'uploader', 'playlist_title')
+
+    # Fields storing the chosen format and the source settings it was chosen with
+    SELECTED_FORMAT_FIELDS = ('selected_format', 'selected_format_fingerprint')
+
     def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
-        # Trigger an update of derived fields from metadata
-        if self.metadata:
-            self.title = self.metadata_title
-            self.duration = self.metadata_duration
+        # Trigger an update of derived fields from metadata, skipped when the metadata
+        # is unchanged since it was loaded as the fields are already up to date
+        if self.metadata and self.metadata is not getattr(self, '_db_metadata', None):
+            self.update_metadata_fields()
         if update_fields is not None and "metadata" in update_fields:
-            # If only some fields are being updated, make sure we update title and duration if metadata changes
-            update_fields = {"title", "duration"}.union(update_fields)
+            # If only some fields are being updated, make sure we update the derived fields if metadata changes
+            update_fields = set(self.METADATA_DERIVED_FIELDS).union(update_fields)
+        if self.metadata:
+            # Store the chosen format, only recalculated if the metadata or the
+            # source format settings have changed
+            self.get_format_str()
+            if update_fields is not None and getattr(self, '_selected_format_changed', False):
+                update_fields = set(self.SELECTED_FORMAT_FIELDS).union(update_fields)
 
         super().save(
             force_insert=force_insert,
             force_update=force_update,
             using=using,
             update_fields=update_fields,)
+        self._selected_format_changed = False
 
     def get_metadata_field(self, field):
         fields = self.METADATA_FIELDS.get(field, {})
         return fields.get(self.source.source_type, '')
 
+    def update_metadata_fields(self):
+        '''
+            Copies values from the metadata into their own columns so they are fast to
+            access and can be filtered on.
+        '''
+        self.title = self.metadata_title[:200]
+        self.duration = self.metadata_duration
+        upload_date = self.metadata_upload_date
+        self.upload_date = upload_date.date() if upload_date else None
+        self.thumbnail = self.metadata_thumbnail[:1000]
+        self.uploader = self.metadata_uploader[:200]
+        self.playlist_title = self.metadata_playlist_title[:200]
+
+    @classmethod
+    def prune_source_metadata(cls, source_type, metadata):
+        '''
+            Removes everything from a metadata dict which TubeSync doesn't use, such
+            as captions, heatmaps, thumbnail lists and per-format fragments, before
+            it is saved.
+        '''
+        keep_fields = set(cls.METADATA_KEEP_FIELDS)
+        for fields in cls.METADATA_FIELDS.values():
+            keep_fields.add(fields.get(source_type, ''))
+        keep_fields.update(getattr(settings, 'MEDIA_METADATA_EXTRA_FIELDS', ()))
+        return prune_metadata(metadata, keep_fields, cls.METADATA_FORMAT_DROP_FIELDS)
+
+    def prune_metadata(self, metadata):
+        return self.prune_source_metadata(self.source.source_type, metadata)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the metadata as loaded, stored formats are only used while the
+        # metadata on the instance is unchanged
+        instance._db_metadata = instance.__dict__.get('metadata')
+        # The stored selected format was chosen with the metadata as loaded
+        instance._selected_format_metadata = instance._db_metadata
+        return instance
+
+    @property
+    def parsed_formats(self):
+        '''
+            Returns a list of format dicts as returned by parse_media_format. The
+            MediaFormat rows written when the metadata was downloaded are used where
+            available, otherwise the formats are parsed from the metadata. Cached on
+            the instance against the metadata string in the same way as
+            loaded_metadata.
+        '''
+        raw, formats = getattr(self, '_parsed_formats_cache', (None, None))
+        if formats is not None and raw is self.metadata:
+            return formats
+        formats = None
+        if self.metadata and self.metadata is getattr(self, '_db_metadata', None):
+            formats = [fmt.as_dict() for fmt in self.media_formats.all()] or None
+        if formats is None:
+            formats = [parse_media_format(fmt) for fmt in self.formats]
+        self._parsed_formats_cache = (self.metadata, formats)
+        return formats
+
     def iter_formats(self):
-        for fmt in self.formats:
-            yield parse_media_format(fmt)
+        for fmt in self.parsed_formats:
+            yield fmt
+
+    @property
+    def formats_by_id(self):
+        '''
+            Returns a dict of format ID to parsed format dict, built from the same
+            parsed formats the matching code uses. If a format ID is repeated the
+            first format wins. Cached on the instance until the parsed formats change.
+        '''
+        formats = self.parsed_formats
+        cached_formats, formats_by_id = getattr(self, '_formats_by_id_cache', (None, None))
+        if formats_by_id is not None and cached_formats is formats:
+            return formats_by_id
+        formats_by_id = {}
+        for fmt in formats:
+            formats_by_id.setdefault(fmt['id'], fmt)
+        self._formats_by_id_cache = (formats, formats_by_id)
+        return formats_by_id
+
+    def save_formats(self):
+        '''
+            Replaces the stored MediaFormat rows for this media item with the formats
+            in the current metadata. Called after the metadata has been saved.
+        '''
+        formats = [parse_media_format(fmt) for fmt in self.formats]
+        MediaFormat.objects.filter(media=self).delete()
+        MediaFormat.objects.bulk_create([
+            MediaFormat.from_parsed(self, position, fmt)
+            for position, fmt in enumerate(formats)
+        ])
+        self._db_metadata = self.metadata
+        self._parsed_formats_cache = (self.metadata, formats)
+        return len(formats)
 
     def get_best_combined_format(self):
         return get_best_combined_format(self)
@@ -960,7 +1296,26 @@ class Media(models.Model):
         '''
             Returns a youtube-dl compatible format string for the best matches
             combination of source requirements and available audio and video formats.
-            Returns boolean False if there is no valid downloadable combo.
+            Returns boolean False if there is no valid downloadable combo. The chosen
+            format is stored on the media item and reused until the metadata or the
+            source format settings change.
+        '''
+        fingerprint = self.source.format_fingerprint
+        if (self.selected_format_fingerprint == fingerprint and
+            self.metadata is getattr(self, '_selected_format_metadata', None)):
+            return self.selected_format or False
+        format_str = self.calculate_format_str()
+        self.selected_format = format_str or ''
+        self.selected_format_fingerprint = fingerprint
+        self._selected_format_metadata = self.metadata
+        # Saved by the next save() even if it only updates some fields
+        self._selected_format_changed = True
+        return format_str
+
+    def calculate_format_str(self):
+        '''
+            Runs the format matching code to find the format string for the media,
+            see get_format_str().
         '''
         if self.source.is_audio:
             audio_match, audio_format = self.get_best_audio_format()
@@ -1090,10 +1445,7 @@ class Media(models.Model):
         '''
             Matches a format code, such as '22', to a processed format dict.
         '''
-        for fmt in self.iter_formats():
-            if format_code == fmt['id']:
-                return fmt
-        return False
+        return self.formats_by_id.get(format_code, False)
 
     @property
     def format_dict(self):
@@ -1132,15 +1484,44 @@ class Media(models.Model):
     def has_metadata(self):
         return self.metadata is not None
 
+    @property
+    def metadata_is_stale(self):
+        '''
+            Returns True if the media is still to be downloaded and its metadata was
+            downloaded more than METADATA_REFRESH_TTL_HOURS ago, so the available
+            formats may have changed. Downloaded media, and media from sources
+            which don't download media, is never stale.
+        '''
+        ttl = getattr(settings, 'METADATA_REFRESH_TTL_HOURS', 0)
+        if not ttl or self.downloaded or not self.has_metadata:
+            return False
+        if not self.source.download_media:
+            return False
+        if not self.metadata_fetched_at:
+            return True
+        return self.metadata_fetched_at < timezone.now() - timedelta(hours=ttl)
+
     @property
     def loaded_metadata(self):
+        '''
+            Returns the metadata JSON parsed into a dict. The parsed dict is cached
+            on the instance against the exact metadata string it was parsed from so
+            reassigning self.metadata invalidates it. Treat the returned dict as
+            read-only, it is shared between all callers.
+        '''
+        raw, data = getattr(self, '_loaded_metadata_cache', (None, None))
+        if data is not None and raw is self.metadata:
+            Media.metadata_cache_hits += 1
+            return data
+        Media.metadata_cache_misses += 1
         try:
             data = json.loads(self.metadata)
             if not isinstance(data, dict):
-                return {}
-            return data
+                data = {}
         except Exception as e:
-            return {}
+            data = {}
+        self._loaded_metadata_cache = (self.metadata, data)
+        return data
 
     @property
     def url(self):
@@ -1163,9 +1544,9 @@ class Media(models.Model):
         return slugify(replaced)[:80]
 
     @property
-    def thumbnail(self):
+    def metadata_thumbnail(self):
         field = self.get_metadata_field('thumbnail')
-        return self.loaded_metadata.get(field, '').strip()
+        return (self.loaded_metadata.get(field, '') or '').strip()
 
     @property
     def name(self):
@@ -1173,7 +1554,7 @@ class Media(models.Model):
         return title if title else self.key
 
     @property
-    def upload_date(self):
+    def metadata_upload_date(self):
         field = self.get_metadata_field('upload_date')
         try:
             upload_date_str = self.loaded_metadata.get(field, '').strip()
@@ -1229,9 +1610,9 @@ class Media(models.Model):
         return self.loaded_metadata.get(field, 0)
 
     @property
-    def uploader(self):
+    def metadata_uploader(self):
         field = self.get_metadata_field('uploader')
-        return self.loaded_metadata.get(field, '')
+        return self.loaded_metadata.get(field, '') or ''
 
     @property
     def formats(self):
@@ -1239,9 +1620,9 @@ class Media(models.Model):
         return self.loaded_metadata.get(field, [])
 
     @property
-    def playlist_title(self):
+    def metadata_playlist_title(self):
         field = self.get_metadata_field('playlist_title')
-        return self.loaded_metadata.get(field, '')
+        return self.loaded_metadata.get(field, '') or ''
 
     @property
     def filename(self):
@@ -1479,14 +1860,34 @@ class Media(models.Model):
                                str(self.filepath), self.source.write_json,
                                self.source.sponsorblock_categories.selected_choices, self.source.embed_thumbnail,
                                self.source.embed_metadata, self.source.enable_sponsorblock,
-                              self.source.write_subtitles, self.source.auto_subtitles,self.source.sub_langs )
+                              self.source.write_subtitles, self.source.auto_subtitles,self.source.sub_langs,
+                               partial_dir=self.partial_download_dir,
+                               progress_key=str(self.pk),
+                               concurrent_fragments=self.source.download_concurrent_fragments,
+                               downloader=self.source.download_downloader,
+                               downloader_connections=self.source.download_downloader_connections)
         # Return the download paramaters
         return format_str, self.source.extension
 
-    def index_metadata(self):
+    @property
+    def download_progress(self):
+        '''
+            Returns the latest progress snapshot of the media download while it is
+            running, or None.
+        '''
+        return DownloadProgress.get(str(self.pk))
+
+    @property
+    def partial_download_dir(self):
+        return get_partial_download_dir(self.pk)
+
+    def index_metadata(self, extractor=None):
         '''
-            Index the media metadata returning a dict of info.
+            Index the media metadata returning a dict of info. If a MediaInfoExtractor
+            is passed its YoutubeDL instance is used for the extraction.
         '''
+        if extractor is not None:
+            return extractor.get_media_info(self.url)
         indexer = self.INDEXERS.get(self.source.source_type, None)
         if not callable(indexer):
             raise Exception(f'Media with source type f"{self.source.source_type}" '
@@ -1495,19 +1896,177 @@ class Media(models.Model):
 
     def calculate_episode_number(self):
         if self.source.source_type == Source.SOURCE_TYPE_YOUTUBE_PLAYLIST:
-            sorted_media = Media.objects.filter(source=self.source)
+            sorted_media = Media.objects.filter(source=self.source).values_list('pk', flat=True)
         else:
             self_year = self.upload_date.year if self.upload_date else self.created.year
-            filtered_media = Media.objects.filter(source=self.source, published__year=self_year)
-            filtered_media = [m for m in filtered_media if m.upload_date is not None]
-            sorted_media = sorted(filtered_media, key=lambda x: (x.upload_date, x.key))
+            filtered_media = Media.objects.filter(
+                source=self.source, published__year=self_year, upload_date__isnull=False
+            ).values_list('pk', 'upload_date', 'key')
+            sorted_media = [pk for pk, upload_date, key in
+                            sorted(filtered_media, key=lambda x: (x[1], x[2]))]
         position_counter = 1
-        for media in sorted_media:
-            if media == self:
+        for media_pk in sorted_media:
+            if media_pk == self.pk:
                 return position_counter
             position_counter += 1
 
 
+class MediaFormat(models.Model):
+    '''
+        A single available format for a Media item in the form returned by
+        parse_media_format. These are written once when the metadata is downloaded
+        so the format matchers don't need to parse the metadata JSON.
+    '''
+
+    media = models.ForeignKey(
+        Media,
+        on_delete=models.CASCADE,
+        related_name='media_formats',
+        help_text=_('Media the format belongs to')
+    )
+    position = models.PositiveSmallIntegerField(
+        _('position'),
+        help_text=_('Position of the format in the metadata format list')
+    )
+    format_id = models.CharField(
+        _('format id'),
+        max_length=100,
+        db_index=True,
+        help_text=_('Format ID, such as a YouTube itag')
+    )
+    format = models.CharField(
+        _('format'),
+        max_length=100,
+        blank=True,
+        null=True,
+        help_text=_('Normalised format name, such as 1080P')
+    )
+    format_verbose = models.CharField(
+        _('format verbose'),
+        max_length=200,
+        blank=True,
+        default='',
+        help_text=_('Full format description')
+    )
+    height = models.PositiveIntegerField(
+        _('height'),
+        default=0,
+        help_text=_('Height in pixels of the format')
+    )
+    width = models.PositiveIntegerField(
+        _('width'),
+        default=0,
+        help_text=_('Width in pixels of the format')
+    )
+    vcodec = models.CharField(
+        _('video codec'),
+        max_length=30,
+        db_index=True,
+        blank=True,
+        null=True,
+        help_text=_('Video codec of the format, if any')
+    )
+    acodec = models.CharField(
+        _('audio codec'),
+        max_length=30,
+        db_index=True,
+        blank=True,
+        null=True,
+        help_text=_('Audio codec of the format, if any')
+    )
+    fps = models.FloatField(
+        _('fps'),
+        blank=True,
+        null=True,
+        help_text=_('Frames per second of the format')
+    )
+    vbr = models.FloatField(
+        _('video bitrate'),
+        blank=True,
+        null=True,
+        help_text=_('Total bitrate of the format')
+    )
+    abr = models.FloatField(
+        _('audio bitrate'),
+        blank=True,
+        null=True,
+        help_text=_('Audio bitrate of the format')
+    )
+    is_60fps = models.BooleanField(
+        _('is 60fps'),
+        default=False,
+        help_text=_('Format is 60fps')
+    )
+    is_hdr = models.BooleanField(
+        _('is hdr'),
+        default=False,
+        help_text=_('Format is HDR')
+    )
+    is_hls = models.BooleanField(
+        _('is hls'),
+        default=False,
+        help_text=_('Format is HLS')
+    )
+    is_dash = models.BooleanField(
+        _('is dash'),
+        default=False,
+        help_text=_('Format is DASH')
+    )
+
+    def __str__(self):
+        return f'{self.media} / {self.format_id}'
+
+    class Meta:
+        verbose_name = _('Media Format')
+        verbose_name_plural = _('Media Formats')
+        ordering = ('media', 'position')
+        unique_together = (
+            ('media', 'position'),
+        )
+
+    @classmethod
+    def from_parsed(cls, media, position, fmt):
+        return cls(
+            media=media,
+            position=position,
+            format_id=fmt['id'],
+            format=fmt['format'],
+            format_verbose=(fmt['format_verbose'] or '')[:200],
+            height=fmt['height'],
+            width=fmt['width'],
+            vcodec=fmt['vcodec'],
+            acodec=fmt['acodec'],
+            fps=fmt['fps'],
+            vbr=fmt['vbr'],
+            abr=fmt['abr'],
+            is_60fps=fmt['is_60fps'],
+            is_hdr=fmt['is_hdr'],
+            is_hls=fmt['is_hls'],
+            is_dash=fmt['is_dash'],
+        )
+
+    def as_dict(self):
+        '''
+            Returns the format as a dict in the same form as parse_media_format.
+        '''
+        return {
+            'id': self.format_id,
+            'format': self.format,
+            'format_verbose': self.format_verbose,
+            'height': self.height,
+            'width': self.width,
+            'vcodec': self.vcodec,
+            'fps': whole_number(self.fps),
+            'vbr': whole_number(self.vbr),
+            'acodec': self.acodec,
+            'abr': whole_number(self.abr),
+            'is_60fps': self.is_60fps,
+            'is_hdr': self.is_hdr,
+            'is_hls': self.is_hls,
+            'is_dash': self.is_dash,
+        }
+
+
 class MediaServer(models.Model):
     '''
         A remote media server, such as a Plex server.
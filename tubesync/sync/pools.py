@@ -0,0 +1,185 @@
+'''
+    Runs background tasks on a separate pool of worker threads for each class of
+    task, so quick tasks such as downloading thumbnails never wait behind media
+    downloads which can take hours. Used by the "process-task-pools" management
+    command in place of "process_tasks".
+'''
+
+
+import os
+import threading
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Count, Q
+from django.utils import timezone
+from background_task.models import Task
+from background_task.settings import app_settings
+from background_task.tasks import tasks, bg_runner
+from common.logger import log
+
+
+# Task function names run by each pool, tasks not listed run in the DEFAULT_POOL
+TASK_POOLS = {
+    'index': (
+        'sync.tasks.index_source_task',
+        'sync.tasks.check_source_directory_exists',
+        'sync.tasks.download_source_images',
+        'sync.tasks.save_all_media_for_source',
+        'sync.tasks.housekeeping_task',
+    ),
+    'metadata': (
+        'sync.tasks.download_media_metadata',
+        'sync.tasks.download_media_metadata_batch',
+        'sync.tasks.refresh_media_metadata_batch',
+    ),
+    'thumbnail': (
+        'sync.tasks.download_media_thumbnail',
+    ),
+    'download': (
+        'sync.tasks.download_media',
+    ),
+    'mediaserver': (
+        'sync.tasks.rescan_media_server',
+    ),
+}
+DEFAULT_POOL = 'index'
+
+
+def get_task_pool(task_name):
+    '''
+        Returns the name of the pool which runs a task function.
+    '''
+    for pool, task_names in TASK_POOLS.items():
+        if task_name in task_names:
+            return pool
+    return DEFAULT_POOL
+
+
+def get_pool_workers():
+    '''
+        Returns a dict of the number of worker threads for each pool from the
+        TASK_POOL_WORKERS setting, pools missing from the setting get one worker.
+    '''
+    configured = getattr(settings, 'TASK_POOL_WORKERS', {})
+    return {pool: max(1, int(configured.get(pool, 1))) for pool in TASK_POOLS}
+
+
+def get_pool_filter(pool):
+    '''
+        Returns a Q filter matching the tasks run by a pool.
+    '''
+    if pool != DEFAULT_POOL:
+        return Q(task_name__in=TASK_POOLS[pool])
+    other_task_names = [name for other, task_names in TASK_POOLS.items()
+                        if other != pool for name in task_names]
+    return ~Q(task_name__in=other_task_names)
+
+
+def get_pool_status():
+    '''
+        Returns a list of dicts of the queue depth of each pool, the number of
+        workers and the number of running, ready (waiting for a worker) and
+        scheduled (to run in the future) tasks. Calculated from the tasks table so
+        it can be displayed by the web server.
+    '''
+    now = timezone.now()
+    expires_at = now - timedelta(seconds=app_settings.BACKGROUND_TASK_MAX_RUN_TIME)
+    running = Q(locked_by__isnull=False, locked_at__gt=expires_at)
+    waiting = ~running & Q(failed_at__isnull=True)
+    counts = Task.objects.values('task_name').annotate(
+        running=Count('pk', filter=running),
+        ready=Count('pk', filter=waiting & Q(run_at__lte=now)),
+        scheduled=Count('pk', filter=waiting & Q(run_at__gt=now)),
+    )
+    workers = get_pool_workers()
+    status = {pool: {'name': pool, 'workers': workers[pool], 'running': 0,
+                     'ready': 0, 'scheduled': 0} for pool in TASK_POOLS}
+    for row in counts:
+        pool = status[get_task_pool(row['task_name'])]
+        for key in ('running', 'ready', 'scheduled'):
+            pool[key] += row[key]
+    return list(status.values())
+
+
+class TaskPoolScheduler:
+    '''
+        Locks ready tasks and runs them on the worker pool for their class, up to
+        the number of workers in each pool at once. Tasks are run with the same
+        runner as "process_tasks" so retries, completed tasks and signals behave
+        the same.
+    '''
+
+    def __init__(self, workers=None):
+        self.workers = workers or get_pool_workers()
+        self.worker_name = str(os.getpid())
+        self.lock = threading.Lock()
+        self.running = {pool: set() for pool in self.workers}
+        self.executors = {
+            pool: ThreadPoolExecutor(max_workers=count,
+                                     thread_name_prefix=f'tasks-{pool}')
+            for pool, count in self.workers.items()
+        }
+
+    def get_ready_tasks(self, pool, count):
+        '''
+            Returns up to count tasks for a pool which are ready to run, in the
+            same order "process_tasks" would run them.
+        '''
+        now = timezone.now()
+        with self.lock:
+            running = set().union(*self.running.values())
+        ordering = f'{app_settings.BACKGROUND_TASK_PRIORITY_ORDERING}priority'
+        # Tasks running for longer than MAX_RUN_TIME are unlocked, don't start them
+        # again while they are still running here
+        return Task.objects.unlocked(now).filter(
+            get_pool_filter(pool),
+            task_name__in=list(tasks._tasks),
+            run_at__lte=now,
+            failed_at=None
+        ).exclude(pk__in=running).order_by(ordering, 'run_at')[:count]
+
+    def run_task(self, pool, task):
+        try:
+            bg_runner(tasks._tasks[task.task_name], task)
+        except Exception as e:
+            log.error(f'Task pool "{pool}" failed to run task {task}: {e}')
+        finally:
+            with self.lock:
+                self.running[pool].discard(task.pk)
+            close_old_connections()
+
+    def run_pending(self):
+        '''
+            Starts ready tasks on every pool with a free worker. Returns the number
+            of tasks started.
+        '''
+        started = 0
+        for pool, count in self.workers.items():
+            with self.lock:
+                free = count - len(self.running[pool])
+            if free <= 0:
+                continue
+            for task in self.get_ready_tasks(pool, free):
+                locked_task = task.lock(self.worker_name)
+                if not locked_task:
+                    # Locked by another worker
+                    continue
+                with self.lock:
+                    self.running[pool].add(locked_task.pk)
+                log.info(f'Running task on pool "{pool}": {locked_task}')
+                self.executors[pool].submit(self.run_task, pool, locked_task)
+                started += 1
+        return started
+
+    def status(self):
+        '''
+            Returns a dict of the number of tasks running on each pool.
+        '''
+        with self.lock:
+            return {pool: len(running) for pool, running in self.running.items()}
+
+    def shutdown(self, wait=True):
+        for executor in self.executors.values():
+            executor.shutdown(wait=wait)
@@ -4,7 +4,7 @@ from django.conf import settings
 from django.db.models.signals import pre_save, post_save, pre_delete, post_delete
 from django.dispatch import receiver
 from django.utils.translation import gettext_lazy as _
-from background_task.signals import task_failed
+from background_task.signals import task_failed, task_error, task_rescheduled
 from background_task.models import Task
 from common.logger import log
 from .models import Source, Media, MediaServer
@@ -12,15 +12,23 @@ from .tasks import (delete_task_by_source, delete_task_by_media, index_source_ta
                     download_media_thumbnail, download_media_metadata,
                     map_task_to_instance, check_source_directory_exists,
                     download_media, rescan_media_server, download_source_images,
-                    save_all_media_for_source)
+                    save_all_media_for_source, is_media_download_running)
 from .utils import delete_file
-from .filtering import filter_media
+from .filtering import filter_media, filter_indexed_media
+from .youtube import YouTubeThrottledError, circuit_breaker
 
 
 @receiver(pre_save, sender=Source)
 def source_pre_save(sender, instance, **kwargs):
     # Triggered before a source is saved, if the schedule has been updated recreate
     # its indexing task
+    update_fields = kwargs.get('update_fields', None)
+    if update_fields and set(update_fields).issubset(Source.INDEX_STATE_FIELDS):
+        # Only the index state is being saved
+        return
+    # The source settings may have changed, make sure the next index processes
+    # all the media again
+    instance.index_fingerprint = ''
     try:
         existing_source = Source.objects.get(pk=instance.pk)
     except Source.DoesNotExist:
@@ -42,6 +50,10 @@ def source_pre_save(sender, instance, **kwargs):
 
 @receiver(post_save, sender=Source)
 def source_post_save(sender, instance, created, **kwargs):
+    update_fields = kwargs.get('update_fields', None)
+    if update_fields and set(update_fields).issubset(Source.INDEX_STATE_FIELDS):
+        # Only the index state was saved, the media do not need to be checked
+        return
     # Check directory exists and create an indexing task for newly created sources
     if created:
         verbose_name = _('Check download directory exists for source "{}"')
@@ -103,6 +115,28 @@ def task_task_failed(sender, task_id, completed_task, **kwargs):
         obj.save()
 
 
+@receiver(task_error)
+def task_task_error(sender, task, **kwargs):
+    # Triggered before a task which raised an error is rescheduled, the sender is
+    # the class of the error. Retrying while YouTube throttles requests must not
+    # use up the task attempts, undo the attempt the reschedule is about to count
+    # before it checks for the maximum attempts. This is -1 for a task on its first
+    # attempt until the reschedule increments it
+    if issubclass(sender, YouTubeThrottledError):
+        task.attempts -= 1
+        task.throttled = True
+
+
+@receiver(task_rescheduled, sender=Task)
+def task_task_rescheduled(sender, task, **kwargs):
+    # Triggered when a task is rescheduled after an error, throttled tasks wait for
+    # the circuit breaker to close before they are retried
+    if getattr(task, 'throttled', False):
+        retry_at = circuit_breaker.retry_at()
+        if retry_at and retry_at > task.run_at:
+            task.run_at = retry_at
+
+
 @receiver(post_save, sender=Media)
 def media_post_save(sender, instance, created, **kwargs):
     # If the media is skipped manually, bail.
@@ -115,6 +149,9 @@ def media_post_save(sender, instance, created, **kwargs):
     # already been downloaded
     if not instance.downloaded and instance.metadata:
         skip_changed = filter_media(instance)
+    elif not instance.downloaded:
+        # No metadata yet, filter on the fields saved when the media was indexed
+        skip_changed = filter_indexed_media(instance)
 
     # Recalculate the "can_download" flag, this may
     # need to change if the source specifications have been changed
@@ -132,8 +169,9 @@ def media_post_save(sender, instance, created, **kwargs):
         post_save.disconnect(media_post_save, sender=Media)
         instance.save()
         post_save.connect(media_post_save, sender=Media)
-    # If the media is missing metadata schedule it to be downloaded
-    if not instance.metadata:
+    # If the media is missing metadata schedule it to be downloaded, unless the
+    # media is already skipped by the filters on the indexed fields
+    if not instance.metadata and not instance.skip:
         log.info(f'Scheduling task to download metadata for: {instance.url}')
         verbose_name = _('Downloading metadata for "{}"')
         download_media_metadata(
@@ -163,8 +201,12 @@ def media_post_save(sender, instance, created, **kwargs):
     if not instance.media_file_exists:
         instance.downloaded = False
         instance.media_file = None
+    # A download which is already running is left alone, the media is saved while
+    # it runs when stale metadata is refreshed and replacing the task would start
+    # a second download of the same media
     if (not instance.downloaded and instance.can_download and not instance.skip
-        and instance.source.download_media):
+        and instance.source.download_media
+        and not is_media_download_running(instance.pk)):
         delete_task_by_media('sync.tasks.download_media', (str(instance.pk),))
         verbose_name = _('Downloading media for "{}"')
         download_media(
@@ -7,27 +7,43 @@
 import os
 import json
 import math
+import time
 import uuid
 from io import BytesIO
 from hashlib import sha1
 from datetime import timedelta, datetime
-from shutil import copyfile
+from shutil import copyfile, rmtree
 from PIL import Image
 from django.conf import settings
 from django.core.files.base import ContentFile
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import IntegrityError, transaction
+from django.db.models import Q
 from django.utils import timezone
-from django.db.utils import IntegrityError
 from django.utils.translation import gettext_lazy as _
 from background_task import background
 from background_task.models import Task, CompletedTask
+from background_task.settings import app_settings
 from common.logger import log
 from common.errors import NoMediaException, DownloadFailedException
 from common.utils import json_serial
 from .models import Source, Media, MediaServer
 from .utils import (get_remote_image, resize_image_to_height, delete_file,
-                    write_text_file)
-from .filtering import filter_media
+                    write_text_file, parse_index_entry, get_directory_size,
+                    get_directory_mtime, get_partial_download_size)
+from .filtering import filter_media, filter_indexed_media
+from .youtube import (MetadataFetcher, YouTubeThrottledError, circuit_breaker,
+                      get_partial_downloads_dir)
+
+
+# Number of media items created, scheduled or deleted per query while indexing
+INDEX_BATCH_SIZE = 500
+# Number of completed tasks or expired media deleted per query by housekeeping
+CLEANUP_BATCH_SIZE = 500
+# Removing up to this many media no longer in a source is always allowed
+REMOVED_MEDIA_SAFETY_MIN = 10
+# Number of media IDs looked up in the arguments of tasks per query
+TASK_LOOKUP_BATCH_SIZE = 100
 
 
 def get_hash(task_name, pk):
@@ -118,6 +134,18 @@ def get_media_download_task(media_id):
         return False
 
 
+def is_media_download_running(media_id):
+    '''
+        Returns True if a download_media task for the media is locked by a worker
+        and has not run for longer than MAX_RUN_TIME.
+    '''
+    expires_at = timezone.now() - timedelta(
+        seconds=app_settings.BACKGROUND_TASK_MAX_RUN_TIME)
+    return Task.objects.get_task(
+        'sync.tasks.download_media', args=(str(media_id),)
+    ).filter(locked_by__isnull=False, locked_at__gt=expires_at).exists()
+
+
 def delete_task_by_source(task_name, source_id):
     return Task.objects.filter(task_name=task_name, queue=str(source_id)).delete()
 
@@ -126,32 +154,333 @@ def delete_task_by_media(task_name, args):
     return Task.objects.drop_task(task_name, args=args)
 
 
+def schedule_media_metadata_tasks(media_ids, run_at=None, refresh=False):
+    '''
+        Schedules download_media_metadata_batch tasks for many media items at once,
+        METADATA_BATCH_SIZE media items per task, to run now or at run_at. With
+        refresh the low priority refresh_media_metadata_batch tasks are scheduled.
+    '''
+    media_ids = [str(media_id) for media_id in media_ids]
+    batch_size = max(1, settings.METADATA_BATCH_SIZE)
+    if refresh:
+        task_name = 'sync.tasks.refresh_media_metadata_batch'
+        verbose_name = _('Refreshing metadata for {} media items')
+        priority = 18
+    else:
+        task_name = 'sync.tasks.download_media_metadata_batch'
+        verbose_name = _('Downloading metadata for {} media items')
+        priority = 5
+    tasks = [
+        Task.objects.new_task(
+            task_name,
+            args=(media_ids[i:i + batch_size],),
+            priority=priority,
+            run_at=run_at,
+            verbose_name=verbose_name.format(len(media_ids[i:i + batch_size])),
+        )
+        for i in range(0, len(media_ids), batch_size)
+    ]
+    Task.objects.bulk_create(tasks, batch_size=INDEX_BATCH_SIZE)
+    return len(tasks)
+
+
+def create_indexed_media(source, entries, existing_keys):
+    '''
+        Creates a chunk of new Media objects found when indexing a source from a
+        list of (key, fields) tuples, skipping keys in existing_keys, and schedules
+        their metadata downloads. The media are filtered on the fields from the
+        index first, metadata is only downloaded for media not skipped. Returns the
+        number of media created.
+    '''
+    new_media = [Media(key=key, source=source, **fields) for key, fields in entries
+                 if key not in existing_keys]
+    if not new_media:
+        return 0
+    for media in new_media:
+        filter_indexed_media(media)
+    # .bulk_create() does not trigger media_post_save, schedule the metadata
+    # downloads it would have scheduled directly
+    try:
+        with transaction.atomic():
+            Media.objects.bulk_create(new_media, batch_size=INDEX_BATCH_SIZE)
+    except IntegrityError:
+        # Another index or a manual add created some of the media since the known
+        # keys were loaded, create the media one at a time skipping those
+        created = []
+        for media in new_media:
+            try:
+                with transaction.atomic():
+                    Media.objects.bulk_create([media])
+            except IntegrityError:
+                log.info(f'Media already exists, not indexing it again: {source} / '
+                         f'{media.key}')
+                continue
+            created.append(media)
+        new_media = created
+    schedule_media_metadata_tasks(media.pk for media in new_media if not media.skip)
+    for media in new_media:
+        skipped = ' (skipped)' if media.skip else ''
+        log.info(f'Indexed new media: {source} / {media}{skipped}')
+    return len(new_media)
+
+
+def index_source_media(source, videos, full_index=True, existing_keys=None):
+    '''
+        Creates Media objects for indexed videos which are not already known for a
+        source, in chunks of INDEX_BATCH_SIZE as the videos are consumed. The keys
+        of all the videos are kept, the Media fields available from the index, see
+        parse_index_entry(), are only kept for the current chunk. New media have
+        their metadata download scheduled as each chunk is created. existing_keys
+        is the set of keys of the known media, it is loaded when it is first
+        needed if it is not set.
+
+        A fingerprint of the sorted keys is set as the source index_fingerprint, so
+        it doesn't depend on the order the videos and streams tabs are merged in.
+        If the fingerprint matches the previous index nothing has changed and
+        nothing more is done. Returns a tuple of the counts of new and unchanged
+        media and the set of keys of known media no longer in the index, which is
+        only found for a full index which has changed.
+    '''
+    keys = set()
+    chunk = []
+    new_count = 0
+    for video in videos:
+        key = video.get(source.key_field, None)
+        if not key:
+            # Video has no unique key (ID), it can't be indexed
+            continue
+        if key in keys:
+            continue
+        keys.add(key)
+        chunk.append((key, parse_index_entry(video)))
+        if len(chunk) >= INDEX_BATCH_SIZE:
+            if existing_keys is None:
+                existing_keys = set(Media.objects.filter(source=source)
+                                    .values_list('key', flat=True))
+            new_count += create_indexed_media(source, chunk, existing_keys)
+            chunk = []
+    fingerprint = sha1(('full' if full_index else 'incremental').encode('utf-8'))
+    for key in sorted(keys):
+        fingerprint.update(f'|{key}'.encode('utf-8'))
+    fingerprint.update(f'|{len(keys)}'.encode('utf-8'))
+    fingerprint = fingerprint.hexdigest()
+    unchanged = not new_count and fingerprint == source.index_fingerprint
+    source.index_fingerprint = fingerprint
+    if unchanged:
+        # Same media as the last index, nothing to do
+        return 0, len(keys), set()
+    if existing_keys is None:
+        existing_keys = set(Media.objects.filter(source=source)
+                            .values_list('key', flat=True))
+    if chunk:
+        new_count += create_indexed_media(source, chunk, existing_keys)
+    removed_keys = existing_keys - keys if full_index else set()
+    return new_count, len(keys) - new_count, removed_keys
+
+
 def cleanup_completed_tasks():
+    '''
+        Deletes completed tasks older than COMPLETED_TASKS_DAYS_TO_KEEP days in
+        batches. Returns the number of completed tasks deleted.
+    '''
     days_to_keep = getattr(settings, 'COMPLETED_TASKS_DAYS_TO_KEEP', 30)
     delta = timezone.now() - timedelta(days=days_to_keep)
     log.info(f'Deleting completed tasks older than {days_to_keep} days '
              f'(run_at before {delta})')
-    CompletedTask.objects.filter(run_at__lt=delta).delete()
+    old_tasks = CompletedTask.objects.filter(run_at__lt=delta).order_by('pk')
+    deleted = 0
+    while True:
+        batch = list(old_tasks.values_list('pk', flat=True)[:CLEANUP_BATCH_SIZE])
+        if not batch:
+            break
+        CompletedTask.objects.filter(pk__in=batch).delete()
+        deleted += len(batch)
+    return deleted
 
 
 def cleanup_old_media():
+    '''
+        Deletes downloaded media older than the days to keep for sources with
+        delete_old_media enabled, in batches. Returns the number of media deleted.
+    '''
+    deleted = 0
     for source in Source.objects.filter(delete_old_media=True, days_to_keep__gt=0):
         delta = timezone.now() - timedelta(days=source.days_to_keep)
-        for media in source.media_source.filter(downloaded=True, download_date__lt=delta):
-            log.info(f'Deleting expired media: {source} / {media} '
+        expired = list(source.media_source.filter(
+            downloaded=True,
+            download_date__lt=delta
+        ).values_list('pk', flat=True))
+        for i in range(0, len(expired), CLEANUP_BATCH_SIZE):
+            # .delete() also triggers a pre_delete signal that removes the files
+            Media.objects.filter(pk__in=expired[i:i + CLEANUP_BATCH_SIZE]).delete()
+        if expired:
+            log.info(f'Deleted {len(expired)} expired media for source: {source} '
                      f'(now older than {source.days_to_keep} days / '
                      f'download_date before {delta})')
-            # .delete() also triggers a pre_delete signal that removes the files
-            media.delete()
+        deleted += len(expired)
+    return deleted
+
 
+def cleanup_removed_media(source, removed_keys):
+    '''
+        Deletes downloaded media with keys in removed_keys, the keys of media no
+        longer in the source index. Media are deleted in batches, the
+        media_pre_delete signal removes the files for each batch before the rows
+        are deleted. If more than MAX_REMOVED_MEDIA_FRACTION of the downloaded media
+        would be deleted nothing is deleted, as the index is more likely incomplete
+        than the media removed. Returns the number of media deleted.
+    '''
+    downloaded = dict(Media.objects.filter(source=source, downloaded=True)
+                      .values_list('key', 'pk'))
+    removed = [pk for key, pk in downloaded.items() if key in removed_keys]
+    if not removed:
+        return 0
+    max_fraction = getattr(settings, 'MAX_REMOVED_MEDIA_FRACTION', 0)
+    if (max_fraction and len(removed) > REMOVED_MEDIA_SAFETY_MIN and
+        len(removed) / len(downloaded) > max_fraction):
+        log.error(f'Not removing {len(removed)} of {len(downloaded)} downloaded media '
+                  f'no longer in source {source}, more than {max_fraction:.0%} of the '
+                  f'downloaded media would be removed which usually means the '
+                  f'source index was incomplete')
+        return 0
+    for i in range(0, len(removed), INDEX_BATCH_SIZE):
+        batch = removed[i:i + INDEX_BATCH_SIZE]
+        # .delete() triggers a pre_delete signal for each item that removes the files
+        Media.objects.filter(pk__in=batch).delete()
+    log.info(f'Removed {len(removed)} of {len(downloaded)} downloaded media no '
+             f'longer in source {source}')
+    return len(removed)
 
-def cleanup_removed_media(source, videos):
-    media_objects = Media.objects.filter(source=source, downloaded=True)
-    for item in media_objects:
-        matching_source_item = [video['id'] for video in videos if video['id'] == item.key]
-        if not matching_source_item:
-            log.info(f'{item.title} is no longer in source, removing')
-            item.delete()
+
+def get_pending_media_ids(media_ids, task_names):
+    '''
+        Returns the set of IDs in media_ids which the first argument of a waiting or
+        running task named in task_names refers to, batch tasks refer to a list of
+        media IDs. Only the tasks which mention the media IDs are loaded, with
+        TASK_LOOKUP_BATCH_SIZE media IDs per query.
+    '''
+    media_ids = [str(media_id) for media_id in media_ids]
+    pending = set()
+    for i in range(0, len(media_ids), TASK_LOOKUP_BATCH_SIZE):
+        mentions = Q()
+        for media_id in media_ids[i:i + TASK_LOOKUP_BATCH_SIZE]:
+            mentions |= Q(task_params__contains=media_id)
+        tasks = Task.objects.filter(mentions, task_name__in=task_names,
+                                    failed_at__isnull=True)
+        for task_params in tasks.values_list('task_params', flat=True):
+            try:
+                args, kwargs = json.loads(task_params)
+                media_id = args[0]
+            except (TypeError, ValueError, IndexError):
+                continue
+            if isinstance(media_id, list):
+                pending.update(media_id)
+            else:
+                pending.add(media_id)
+    return pending.intersection(media_ids)
+
+
+def filter_expired_media(source):
+    '''
+        Re-runs the filters on the media of a source which have not been downloaded
+        and were published before the download cap date or the days to keep, the
+        filters which depend on the current time, and saves the media which are now
+        skipped in bulk. Indexing a source doesn't save all its media so this
+        replaces the filtering which used to happen then as media got older.
+        Returns the number of media now skipped.
+    '''
+    cutoffs = []
+    if source.download_cap_date:
+        cutoffs.append(source.download_cap_date)
+    if source.delete_old_media and source.days_to_keep > 0:
+        cutoffs.append(timezone.now() - timedelta(days=source.days_to_keep))
+    if not cutoffs:
+        return 0
+    skipped = []
+    for media in Media.objects.filter(source=source, downloaded=False, skip=False,
+                                      manual_skip=False, published__lte=max(cutoffs)):
+        media.source = source
+        if media.metadata:
+            changed = filter_media(media)
+        else:
+            changed = filter_indexed_media(media)
+        if changed and media.skip:
+            skipped.append(media)
+    Media.objects.bulk_update(skipped, ['skip'], batch_size=INDEX_BATCH_SIZE)
+    if skipped:
+        log.info(f'Skipped {len(skipped)} media now older than the cutoff for '
+                 f'source: {source}')
+    return len(skipped)
+
+
+def schedule_missing_media_tasks(source):
+    '''
+        Schedules metadata downloads for media of a source with no metadata,
+        thumbnail downloads for media with no thumbnail, and downloads for media
+        which can be downloaded, which have no task waiting or running because
+        their task failed or was lost. Failed download tasks are replaced. Indexing
+        a source only saves the index state so this replaces the rescheduling which
+        used to happen when all the media were saved. Returns a tuple of the number
+        of metadata, thumbnail and media downloads scheduled.
+    '''
+    media = Media.objects.filter(source=source, skip=False, manual_skip=False)
+    no_metadata = [str(pk) for pk in
+                   media.filter(metadata__isnull=True).values_list('pk', flat=True)]
+    pending = get_pending_media_ids(no_metadata, (
+        'sync.tasks.download_media_metadata',
+        'sync.tasks.download_media_metadata_batch',
+    ))
+    missing_metadata = [pk for pk in no_metadata if pk not in pending]
+    if missing_metadata:
+        log.info(f'Scheduling metadata downloads for {len(missing_metadata)} media '
+                 f'with no metadata task for source: {source}')
+        schedule_media_metadata_tasks(missing_metadata)
+    no_thumbnail = list(media.filter(Q(thumb='') | Q(thumb__isnull=True)).exclude(
+        thumbnail=''
+    ).only('pk', 'key', 'title', 'thumbnail'))
+    pending = get_pending_media_ids((instance.pk for instance in no_thumbnail),
+                                    ('sync.tasks.download_media_thumbnail',))
+    thumbnail_count = 0
+    for instance in no_thumbnail:
+        if str(instance.pk) in pending:
+            continue
+        verbose_name = _('Downloading thumbnail for "{}"')
+        download_media_thumbnail(
+            str(instance.pk),
+            instance.thumbnail,
+            queue=str(source.pk),
+            priority=10,
+            verbose_name=verbose_name.format(instance.name),
+            remove_existing_tasks=True
+        )
+        thumbnail_count += 1
+    if thumbnail_count:
+        log.info(f'Scheduled {thumbnail_count} thumbnail downloads with no thumbnail '
+                 f'task for source: {source}')
+    if not source.download_media:
+        return len(missing_metadata), thumbnail_count, 0
+    not_downloaded = list(media.filter(can_download=True, downloaded=False)
+                          .only('pk', 'key', 'title'))
+    pending = get_pending_media_ids((instance.pk for instance in not_downloaded),
+                                    ('sync.tasks.download_media',))
+    count = 0
+    for instance in not_downloaded:
+        if str(instance.pk) in pending:
+            continue
+        delete_task_by_media('sync.tasks.download_media', (str(instance.pk),))
+        verbose_name = _('Downloading media for "{}"')
+        download_media(
+            str(instance.pk),
+            queue=str(source.pk),
+            priority=15,
+            verbose_name=verbose_name.format(instance.name),
+            remove_existing_tasks=True
+        )
+        count += 1
+    if count:
+        log.info(f'Scheduled {count} media downloads with no download task for '
+                 f'source: {source}')
+    return len(missing_metadata), thumbnail_count, count
 
 
 @background(schedule=0)
@@ -166,41 +495,128 @@ def index_source_task(source_id):
         return
     # Reset any errors
     source.has_failed = False
-    source.save()
-    # Index the source
-    videos = source.index_media()
-    if not videos:
+    source.save(update_fields=['has_failed'])
+    # Index the source, only the newest media are indexed unless a full index
+    # is due, see Source.needs_full_index
+    full_index = source.needs_full_index
+    index_type = 'full' if full_index else 'incremental'
+    log.info(f'Indexing media for source: {source} ({index_type} index)')
+    previous_fingerprint = source.index_fingerprint
+    # The known keys are loaded once for both stopping an incremental index early
+    # and finding the new media
+    known_keys = set(source.media_source.values_list('key', flat=True))
+    videos = source.index_media(incremental=not full_index, known_keys=known_keys)
+    new_count, unchanged_count, removed_keys = index_source_media(
+        source, videos, full_index=full_index, existing_keys=known_keys)
+    if not new_count and not unchanged_count:
         raise NoMediaException(f'Source "{source}" (ID: {source_id}) returned no '
                                f'media to index, is the source key valid? Check the '
                                f'source configuration is correct and that the source '
                                f'is reachable')
     # Got some media, update the last crawl timestamp
     source.last_crawl = timezone.now()
-    source.save()
-    log.info(f'Found {len(videos)} media items for source: {source}')
-    for video in videos:
-        # Create or update each video as a Media object
-        key = video.get(source.key_field, None)
-        if not key:
-            # Video has no unique key (ID), it can't be indexed
-            continue
+    if full_index:
+        source.last_full_crawl = source.last_crawl
+    # Saving only the index state does not trigger a check of all the media
+    source.save(update_fields=Source.INDEX_STATE_FIELDS)
+    log.info(f'Indexed {new_count + unchanged_count} media items for source: '
+             f'{source} ({new_count} new, {unchanged_count} unchanged, '
+             f'{len(removed_keys)} no longer in source)')
+    # Media get older without being saved, re-run the filters which depend on the
+    # time whether or not the index has changed
+    filter_expired_media(source)
+    if source.index_fingerprint == previous_fingerprint:
+        log.info(f'Index of source {source} is unchanged since the last index, not '
+                 f'checking for removed media or missing tasks')
+        return
+    # Removed media can only be found with a full index of the source
+    if full_index and source.delete_removed_media:
+        log.info(f'Cleaning up media no longer in source {source}')
+        cleanup_removed_media(source, removed_keys)
+    # Retry media whose tasks failed or were lost
+    schedule_missing_media_tasks(source)
+
+
+def schedule_housekeeping_task():
+    '''
+        Schedules the repeating housekeeping task if it is not already scheduled
+        and updates the schedule of an existing task to HOUSEKEEPING_INTERVAL.
+    '''
+    interval = settings.HOUSEKEEPING_INTERVAL
+    existing = Task.objects.filter(task_name='sync.tasks.housekeeping_task')
+    if existing.exists():
+        existing.update(repeat=interval)
+        return
+    log.info(f'Scheduling housekeeping every {interval} seconds')
+    housekeeping_task(
+        repeat=interval,
+        priority=20,
+        verbose_name=_('Housekeeping'),
+        remove_existing_tasks=True
+    )
+
+
+def cleanup_partial_downloads():
+    '''
+        Deletes the partial downloads kept in YOUTUBE_DL_TEMPDIR for media which no
+        longer exists, has been downloaded or is skipped, and partial downloads not
+        written to for PARTIAL_DOWNLOAD_MAX_AGE_HOURS. Returns the number of partial
+        downloads and bytes deleted.
+    '''
+    partial_downloads_dir = get_partial_downloads_dir()
+    if not partial_downloads_dir or not partial_downloads_dir.is_dir():
+        return 0, 0
+    directories = {}
+    for path in partial_downloads_dir.iterdir():
+        if path.is_dir():
+            directories[path.name] = path
+    valid_ids = []
+    for name in directories:
         try:
-            media = Media.objects.get(key=key, source=source)
-        except Media.DoesNotExist:
-            media = Media(key=key)
-        media.source = source
+            valid_ids.append(uuid.UUID(name))
+        except ValueError:
+            continue
+    pending = {str(pk) for pk in Media.objects.filter(
+        pk__in=valid_ids, downloaded=False, skip=False, manual_skip=False
+    ).values_list('pk', flat=True)}
+    max_age = settings.PARTIAL_DOWNLOAD_MAX_AGE_HOURS * 3600
+    now = time.time()
+    deleted, deleted_bytes = 0, 0
+    for name, path in directories.items():
         try:
-            media.save()
-            log.info(f'Indexed media: {source} / {media}')
-        except IntegrityError as e:
-            log.error(f'Index media failed: {source} / {media} with "{e}"')
-    # Tack on a cleanup of old completed tasks
-    cleanup_completed_tasks()
-    # Tack on a cleanup of old media
-    cleanup_old_media()
-    if source.delete_removed_media:
-        log.info(f'Cleaning up media no longer in source {source}')
-        cleanup_removed_media(source, videos)
+            if name in pending and now - get_directory_mtime(path) < max_age:
+                continue
+            size = get_directory_size(path)
+        except OSError:
+            # Deleted by a download finishing
+            continue
+        log.info(f'Deleting {size} bytes of stale partial downloads: "{path}"')
+        rmtree(path, ignore_errors=True)
+        deleted += 1
+        deleted_bytes += size
+    return deleted, deleted_bytes
+
+
+@background(schedule=0)
+def housekeeping_task():
+    '''
+        Runs the cleanups which apply to all sources, such as deleting old completed
+        tasks and expired media, once per HOUSEKEEPING_INTERVAL instead of after
+        every source index.
+    '''
+    start = time.monotonic()
+    tasks_deleted = cleanup_completed_tasks()
+    tasks_elapsed = time.monotonic() - start
+    start = time.monotonic()
+    media_deleted = cleanup_old_media()
+    media_elapsed = time.monotonic() - start
+    media_refreshing = schedule_metadata_refresh()
+    partials_deleted, partial_bytes_deleted = cleanup_partial_downloads()
+    log.info(f'Housekeeping deleted {tasks_deleted} completed tasks in '
+             f'{tasks_elapsed:.2f} seconds and {media_deleted} expired media in '
+             f'{media_elapsed:.2f} seconds, scheduled metadata refreshes for '
+             f'{media_refreshing} media items, deleted {partials_deleted} stale '
+             f'partial downloads ({partial_bytes_deleted} bytes)')
 
 
 @background(schedule=0)
@@ -287,26 +703,144 @@ def download_media_metadata(media_id):
     if media.manual_skip:
         log.info(f'Task for ID: {media_id} skipped, due to task being manually skipped.')
         return
-    source = media.source
-    metadata = media.index_metadata()
+    save_media_metadata(media, media.index_metadata())
+
+
+def save_media_metadata(media, metadata):
+    '''
+        Prunes and saves downloaded metadata for a media item along with the formats
+        parsed from it.
+    '''
+    metadata = media.prune_metadata(metadata)
     media.metadata = json.dumps(metadata, default=json_serial)
-    upload_date = media.upload_date
+    media.metadata_fetched_at = timezone.now()
+    upload_date = media.metadata_upload_date
     # Media must have a valid upload date
     if upload_date:
         media.published = timezone.make_aware(upload_date)
 
-    # Store title in DB so it's fast to access
-    if media.metadata_title:
-        media.title = media.metadata_title[:200]
-
-    # Store duration in DB so it's fast to access
-    if media.metadata_duration:
-        media.duration = media.metadata_duration
-
+    # Title, duration, upload date, thumbnail, uploader and playlist title are
+    # stored in their own columns when the media is saved so they're fast to access
     # Don't filter media here, the post_save signal will handle that
     media.save()
-    log.info(f'Saved {len(media.metadata)} bytes of metadata for: '
-             f'{source} / {media_id}')
+    # Store the parsed formats so format matching doesn't need the metadata JSON
+    num_formats = media.save_formats()
+    log.info(f'Saved {len(media.metadata)} bytes of metadata and {num_formats} '
+             f'formats for: {media.source} / {media.pk}')
+
+
+def fetch_media_metadata(media_items, refresh=False):
+    '''
+        Downloads and saves the metadata for a dict of media items keyed by their
+        ID strings with a MetadataFetcher, METADATA_FETCH_WORKERS at a time and rate
+        limited to METADATA_FETCH_RATE downloads a second. Each media item is saved
+        as soon as its metadata is downloaded. If a media item fails to download new
+        metadata it is rescheduled on its own as a download_media_metadata task,
+        which retries it, failed refreshes are picked up by the next refresh. If
+        YouTube throttles requests the rest of the media items are rescheduled.
+        Returns the number of media items saved.
+    '''
+    fetcher = MetadataFetcher(workers=settings.METADATA_FETCH_WORKERS)
+    saved = 0
+    remaining = set(media_items)
+    urls = ((media_id, media.url) for media_id, media in media_items.items())
+    for media_id, metadata, error in fetcher.fetch(urls):
+        media = media_items[media_id]
+        if isinstance(error, YouTubeThrottledError):
+            # Stop downloading, the rest of the batch is retried once YouTube stops
+            # throttling requests without using up any task attempts
+            log.warning(f'Metadata downloads throttled by YouTube, rescheduling '
+                        f'{len(remaining)} media items')
+            schedule_media_metadata_tasks(remaining, refresh=refresh,
+                                          run_at=circuit_breaker.retry_at())
+            break
+        remaining.discard(media_id)
+        if error is None:
+            try:
+                save_media_metadata(media, metadata)
+            except Exception as e:
+                error = e
+        if error is not None:
+            if refresh:
+                log.error(f'Failed to refresh metadata for: {media.source} / '
+                          f'{media.pk}: {error}')
+                continue
+            log.error(f'Failed to download metadata for: {media.source} / '
+                      f'{media.pk} in a batch, rescheduling it: {error}')
+            verbose_name = _('Downloading metadata for "{}"')
+            download_media_metadata(
+                str(media.pk),
+                priority=5,
+                verbose_name=verbose_name.format(media.pk),
+                remove_existing_tasks=True
+            )
+            continue
+        saved += 1
+    stats = fetcher.stats()
+    log.info(f'{"Refreshed" if refresh else "Downloaded"} metadata for {saved} of '
+             f'{len(media_items)} media items in {stats["elapsed"]:.2f} seconds '
+             f'({stats["per_second"]:.2f}/s, {stats["failed"]} failed, '
+             f'{stats["throttled_waits"]} waited {stats["waited"]:.2f} seconds for the '
+             f'rate limit)')
+    return saved
+
+
+@background(schedule=0)
+def download_media_metadata_batch(media_ids):
+    '''
+        Downloads the metadata for several new media items at once, see
+        fetch_media_metadata().
+    '''
+    media_items = {}
+    for media in Media.objects.filter(pk__in=media_ids).select_related('source'):
+        if media.manual_skip or media.metadata:
+            # Skipped or metadata already downloaded by another task
+            continue
+        media_items[str(media.pk)] = media
+    fetch_media_metadata(media_items)
+
+
+@background(schedule=0)
+def refresh_media_metadata_batch(media_ids):
+    '''
+        Downloads the metadata again for several media items which are still to be
+        downloaded and have stale metadata, so newly available formats are used.
+    '''
+    media_items = {}
+    for media in Media.objects.filter(pk__in=media_ids).select_related('source'):
+        if media.skip or media.manual_skip or not media.metadata_is_stale:
+            # Skipped, downloaded or refreshed since the task was scheduled
+            continue
+        media_items[str(media.pk)] = media
+    fetch_media_metadata(media_items, refresh=True)
+
+
+def schedule_metadata_refresh():
+    '''
+        Schedules refresh_media_metadata_batch tasks for up to METADATA_REFRESH_LIMIT
+        media items still to be downloaded, from sources which download media, with
+        metadata older than METADATA_REFRESH_TTL_HOURS, oldest first. Nothing is
+        scheduled while earlier refresh tasks are still waiting to run. Returns the
+        number of media items.
+    '''
+    ttl = settings.METADATA_REFRESH_TTL_HOURS
+    if ttl <= 0:
+        return 0
+    if Task.objects.filter(task_name='sync.tasks.refresh_media_metadata_batch').exists():
+        return 0
+    cutoff = timezone.now() - timedelta(hours=ttl)
+    media_ids = list(Media.objects.filter(
+        source__download_media=True,
+        downloaded=False,
+        skip=False,
+        manual_skip=False,
+        metadata__isnull=False,
+        metadata_fetched_at__lt=cutoff
+    ).order_by('metadata_fetched_at').values_list(
+        'pk', flat=True
+    )[:settings.METADATA_REFRESH_LIMIT])
+    schedule_media_metadata_tasks(media_ids, refresh=True)
+    return len(media_ids)
 
 
 @background(schedule=0)
@@ -381,13 +915,36 @@ def download_media(media_id):
                      f'the source has a download cap and the media is now too old, '
                      f'not downloading')
             return
+    if media.metadata_is_stale:
+        # Formats may have been added since the metadata was downloaded
+        log.info(f'Refreshing stale metadata before downloading media: {media} '
+                 f'(UUID: {media.pk})')
+        try:
+            save_media_metadata(media, media.index_metadata())
+        except YouTubeThrottledError:
+            raise
+        except Exception as e:
+            log.error(f'Failed to refresh metadata for media: {media} (UUID: '
+                      f'{media.pk}), downloading with the existing metadata: {e}')
     filepath = media.filepath
+    partial_dir = media.partial_download_dir
+    resumed_bytes = 0
+    if partial_dir:
+        resumed_bytes = get_partial_download_size(partial_dir, media.get_format_str())
+    if resumed_bytes:
+        log.info(f'Resuming download of media: {media} (UUID: {media.pk}) from '
+                 f'{resumed_bytes} bytes of partial downloads in: "{partial_dir}"')
     log.info(f'Downloading media: {media} (UUID: {media.pk}) to: "{filepath}"')
     format_str, container = media.download_media()
     if os.path.exists(filepath):
         # Media has been downloaded successfully
         log.info(f'Successfully downloaded media: {media} (UUID: {media.pk}) to: '
                  f'"{filepath}"')
+        if resumed_bytes:
+            log.info(f'Saved {resumed_bytes} bytes by resuming the partial '
+                     f'download of media: {media} (UUID: {media.pk})')
+        if partial_dir:
+            rmtree(partial_dir, ignore_errors=True)
         # Link the media file to the object and update info about the download
         media.media_file.name = str(media.source.type_directory_path / media.filename)
         media.downloaded = True
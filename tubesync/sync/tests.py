@@ -5,17 +5,48 @@
 '''
 
 
+import os
+import json
 import logging
-from datetime import datetime, timedelta
+import random
+import struct
+import tempfile
+import threading
+import time
+import uuid
+from unittest import mock
+from datetime import date, datetime, timedelta
 from urllib.parse import urlsplit
 from xml.etree import ElementTree
 from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
 from django.test import TestCase, Client
 from django.utils import timezone
 from background_task.models import Task
+from background_task.signals import task_error
+import yt_dlp
+from common.errors import DownloadFailedException
 from .models import Source, Media
-from .tasks import cleanup_old_media
+from .tasks import (cleanup_old_media, cleanup_removed_media, index_source_media,
+                    cleanup_partial_downloads,
+                    schedule_housekeeping_task, download_media_metadata_batch,
+                    schedule_metadata_refresh, refresh_media_metadata_batch,
+                    schedule_media_metadata_tasks,
+                    download_media, schedule_missing_media_tasks,
+                    index_source_task, create_indexed_media)
 from .filtering import filter_media
+from .utils import (parse_media_format, parse_index_entry, TokenBucket,
+                    read_aria2_control_file, get_partial_download_size)
+from .youtube import (MetadataFetcher, YouTubeThrottledError, circuit_breaker,
+                      is_throttling_error, get_media_info, iter_media_info_entries,
+                      download_media as download_youtube_media, DownloadProgress,
+                      record_download_throughput, get_download_throughput,
+                      ExternalDownloadMonitor)
+from .matching import min_height, fallback_hd_cutoff, get_best_video_format
+from .fields import CompressedTextField
+from .pools import TaskPoolScheduler, get_pool_status, get_task_pool
 
 
 class FrontEndTestCase(TestCase):
@@ -188,6 +219,9 @@ class FrontEndTestCase(TestCase):
             'prefer_hdr': False,
             'fallback': 'f',
             'sub_langs': 'en',
+            'concurrent_fragments': 0,
+            'downloader': 'default',
+            'downloader_connections': 0,
         }
         response = c.post('/source-add', data)
         self.assertEqual(response.status_code, 302)
@@ -232,6 +266,9 @@ class FrontEndTestCase(TestCase):
             'prefer_hdr': False,
             'fallback': Source.FALLBACK_FAIL,
             'sub_langs': 'en',
+            'concurrent_fragments': 0,
+            'downloader': 'default',
+            'downloader_connections': 0,
         }
         response = c.post(f'/source-update/{source_uuid}', data)
         self.assertEqual(response.status_code, 302)
@@ -264,6 +301,9 @@ class FrontEndTestCase(TestCase):
             'prefer_hdr': False,
             'fallback': Source.FALLBACK_FAIL,
             'sub_langs': 'en',
+            'concurrent_fragments': 0,
+            'downloader': 'default',
+            'downloader_connections': 0,
         }
         response = c.post(f'/source-update/{source_uuid}', data)
         self.assertEqual(response.status_code, 302)
@@ -699,6 +739,91 @@ class MediaTestCase(TestCase):
             self.assertEqual(expected_node.tag, nfo_node.tag)
             self.assertEqual(expected_node.text, nfo_node.text)
 
+    def test_loaded_metadata_cache(self):
+        # Repeated access only parses the metadata once
+        self.media.refresh_from_db()
+        misses = Media.metadata_cache_misses
+        hits = Media.metadata_cache_hits
+        first = self.media.loaded_metadata
+        self.assertEqual(first['title'], 'no fancy stuff title')
+        self.assertEqual(self.media.metadata_uploader, 'test uploader')
+        self.assertEqual(self.media.categories, ['test category 1', 'test category 2'])
+        self.assertIs(self.media.loaded_metadata, first)
+        self.assertEqual(Media.metadata_cache_misses, misses + 1)
+        self.assertEqual(Media.metadata_cache_hits, hits + 3)
+        # Reassigning the metadata invalidates the cache
+        self.media.metadata = '{"title": "a new title"}'
+        self.assertEqual(self.media.loaded_metadata, {'title': 'a new title'})
+        self.assertEqual(self.media.metadata_title, 'a new title')
+        self.assertEqual(Media.metadata_cache_misses, misses + 2)
+        self.media.metadata = None
+        self.assertEqual(self.media.loaded_metadata, {})
+
+    def test_metadata_compression(self):
+        prefix = CompressedTextField.COMPRESSED_PREFIX
+        # Metadata is compressed in the database and transparently decompressed
+        self.assertTrue(Media.objects.filter(
+            pk=self.media.pk, metadata__startswith=prefix).exists())
+        self.assertEqual(Media.objects.get(pk=self.media.pk).metadata, metadata)
+        # Uncompressed metadata written before compression is still readable
+        with connection.cursor() as cursor:
+            cursor.execute('UPDATE sync_media SET metadata = %s', [metadata])
+        self.assertFalse(Media.objects.filter(metadata__startswith=prefix).exists())
+        self.assertEqual(Media.objects.get(pk=self.media.pk).metadata, metadata)
+        # The backfill command compresses existing rows
+        call_command('compress-metadata', batch_size=1)
+        self.assertTrue(Media.objects.filter(
+            pk=self.media.pk, metadata__startswith=prefix).exists())
+        self.assertEqual(Media.objects.get(pk=self.media.pk).metadata, metadata)
+
+    def test_metadata_fields(self):
+        # Fields are copied from the metadata when saved
+        media = Media.objects.get(pk=self.media.pk)
+        self.assertEqual(media.upload_date, date(2017, 9, 11))
+        self.assertEqual(media.uploader, 'test uploader')
+        self.assertEqual(media.thumbnail, media.metadata_thumbnail)
+        self.assertEqual(media.playlist_title, media.metadata_playlist_title)
+        self.assertTrue(Media.objects.filter(upload_date__year=2017,
+                                             uploader='test uploader').exists())
+        # Saving unchanged metadata doesn't need to parse it
+        misses = Media.metadata_cache_misses
+        media.save()
+        self.assertEqual(Media.metadata_cache_misses, misses)
+        # The backfill command repopulates the columns
+        Media.objects.update(upload_date=None, uploader='', thumbnail='')
+        call_command('update-metadata-fields')
+        media = Media.objects.get(pk=self.media.pk)
+        self.assertEqual(media.upload_date, date(2017, 9, 11))
+        self.assertEqual(media.uploader, 'test uploader')
+        self.assertEqual(media.thumbnail, media.metadata_thumbnail)
+
+    def test_prune_metadata(self):
+        data = json.loads(metadata)
+        data['automatic_captions'] = {'en': [{'url': 'https://example.com/en'}]}
+        data['heatmap'] = [{'start_time': 0.0, 'end_time': 1.0, 'value': 1.0}]
+        data['formats'][0]['fragments'] = [{'url': 'https://example.com/1'}]
+        data['formats'][0]['http_headers'] = {'User-Agent': 'test'}
+        pruned = self.media.prune_metadata(data)
+        self.assertNotIn('automatic_captions', pruned)
+        self.assertNotIn('heatmap', pruned)
+        self.assertNotIn('fragments', pruned['formats'][0])
+        self.assertNotIn('http_headers', pruned['formats'][0])
+        for key in ('title', 'upload_date', 'description', 'uploader'):
+            self.assertEqual(pruned[key], data[key])
+        self.assertEqual([parse_media_format(f) for f in pruned['formats']],
+                         [parse_media_format(f) for f in data['formats']])
+        with self.settings(MEDIA_METADATA_EXTRA_FIELDS=('heatmap',)):
+            self.assertIn('heatmap', self.media.prune_metadata(data))
+        with self.settings(MEDIA_METADATA_EXTRA_FIELDS=('*',)):
+            self.assertIn('automatic_captions', self.media.prune_metadata(data))
+        # The companion command prunes existing rows
+        Media.objects.filter(pk=self.media.pk).update(metadata=json.dumps(data))
+        call_command('prune-metadata')
+        media = Media.objects.get(pk=self.media.pk)
+        self.assertNotIn('heatmap', media.loaded_metadata)
+        self.assertEqual(media.title, self.media.title)
+        self.assertEqual(media.get_format_str(), self.media.get_format_str())
+
 
 class MediaFilterTestCase(TestCase):
 
@@ -870,6 +995,320 @@ class MediaFilterTestCase(TestCase):
         self.assertFalse(self.media.skip)
 
 
+def cascade_best_video_format(media):
+    '''
+        The original fallback cascade used for video format matching, kept to check
+        the single pass ranking in get_best_video_format() returns the same results.
+    '''
+    # Check if the source wants audio only, fast path to return
+    if media.source.is_audio:
+        return False, False
+    # Filter video-only formats by resolution that matches the source
+    video_formats = []
+    for fmt in media.iter_formats():
+        # If the format has an audio stream, skip it
+        if fmt['acodec'] is not None:
+            continue
+        if not fmt['vcodec']:
+            continue
+        if media.source.source_resolution.strip().upper() == fmt['format']:
+            video_formats.append(fmt)
+    # Check we matched some streams
+    if not video_formats:
+        # No streams match the requested resolution, see if we can fallback
+        if media.source.can_fallback:
+            # Find the next-best format matches by height
+            for fmt in media.iter_formats():
+                # If the format has an audio stream, skip it
+                if fmt['acodec'] is not None:
+                    continue
+                if (fmt['height'] <= media.source.source_resolution_height and 
+                    fmt['height'] >= min_height):
+                    video_formats.append(fmt)
+        else:
+            # Can't fallback
+            return False, False
+    video_formats = list(reversed(sorted(video_formats, key=lambda k: k['height'])))
+    source_resolution = media.source.source_resolution.strip().upper()
+    source_vcodec = media.source.source_vcodec
+    if not video_formats:
+        # Still no matches
+        return False, False
+    exact_match, best_match = None, None
+    # Of our filtered video formats, check for resolution + codec + hdr + fps match
+    if media.source.prefer_60fps and media.source.prefer_hdr:
+        for fmt in video_formats:
+            # Check for an exact match
+            if (source_resolution == fmt['format'] and
+                source_vcodec == fmt['vcodec'] and 
+                fmt['is_hdr'] and
+                fmt['is_60fps']):
+                # Exact match
+                exact_match, best_match = True, fmt
+                break
+        if media.source.can_fallback:
+            if not best_match:
+                for fmt in video_formats:
+                    # Check for a resolution, hdr and fps match but drop the codec
+                    if (source_resolution == fmt['format'] and 
+                        fmt['is_hdr'] and fmt['is_60fps']):
+                        # Close match
+                        exact_match, best_match = False, fmt
+                        break
+            if not best_match:
+                for fmt in video_formats:
+                    # Check for a codec, hdr and fps match but drop the resolution
+                    if (source_vcodec == fmt['vcodec'] and 
+                        fmt['is_hdr'] and fmt['is_60fps']):
+                        # Close match
+                        exact_match, best_match = False, fmt
+                        break
+            if not best_match:
+                for fmt in video_formats:
+                    # Check for resolution, codec and 60fps match
+                    if (source_resolution == fmt['format'] and
+                        source_vcodec == fmt['vcodec'] and
+                        fmt['is_60fps']):
+                        exact_match, best_match = False, fmt
+                        break
+            if not best_match:
+                for fmt in video_formats:
+                    # Check for resolution and hdr match
+                    if (source_resolution == fmt['format'] and
+                        fmt['is_hdr']):
+                        exact_match, best_match = False, fmt
+                        break
+            if not best_match:
+                for fmt in video_formats:
+                    # Check for resolution and 60fps match
+                    if (source_resolution == fmt['format'] and
+                        fmt['is_60fps']):
+                        exact_match, best_match = False, fmt
+                        break
+            if not best_match:
+                for fmt in video_formats:
+                    # Check for resolution, codec and hdr match
+                    if (source_resolution == fmt['format'] and
+                        source_vcodec == fmt['vcodec'] and
+                        fmt['is_hdr']):
+                        exact_match, best_match = False, fmt
+                        break
+            if not best_match:
+                for fmt in video_formats:
+                    # Check for resolution and codec
+                    if (source_resolution == fmt['format'] and
+                        source_vcodec == fmt['vcodec']):
+                        exact_match, best_match = False, fmt
+                        break
+            if not best_match:
+                for fmt in video_formats:
+                    # Check for resolution
+                    if source_resolution == fmt['format']:
+                        exact_match, best_match = False, fmt
+                        break
+            if not best_match:
+                # Match the highest resolution
+                exact_match, best_match = False, video_formats[0]
+    # Check for resolution + codec + fps match
+    if media.source.prefer_60fps and not media.source.prefer_hdr:
+        for fmt in video_formats:
+            # Check for an exact match
+            if (source_resolution == fmt['format'] and
+                source_vcodec == fmt['vcodec'] and 
+                fmt['is_60fps'] and
+                not fmt['is_hdr']):
+                # Exact match
+                exact_match, best_match = True, fmt
+                break
+        if media.source.can_fallback:
+            if not best_match:
+                for fmt in video_formats:
+                    # Check for a resolution and fps match but drop the codec
+                    if (source_resolution == fmt['format'] and 
+                        fmt['is_60fps'] and
+                        not fmt['is_hdr']):
+                        exact_match, best_match = False, fmt
+                        break
+            if not best_match:
+                for fmt in video_formats:
+                    # Check for a codec and fps match but drop the resolution
+                    if (source_vcodec == fmt['vcodec'] and 
+                        fmt['is_60fps'] and
+                        not fmt['is_hdr']):
+                        exact_match, best_match = False, fmt
+                        break
+            if not best_match:
+                for fmt in video_formats:
+                    # Check for a codec and 60fps match
+                    if (source_vcodec == fmt['vcodec'] and 
+                        fmt['is_60fps']):
+                        exact_match, best_match = False, fmt
+                        break
+            if not best_match:
+                for fmt in video_formats:
+                    # Check for codec and resolution match bot drop 60fps
+                    if (source_resolution == fmt['format'] and
+                        source_vcodec == fmt['vcodec'] and
+                        not fmt['is_hdr']):
+                        exact_match, best_match = False, fmt
+                        break
+            if not best_match:
+                for fmt in video_formats:
+                    # Check for codec and resolution match only
+                    if (source_resolution == fmt['format'] and
+                        source_vcodec == fmt['vcodec']):
+                        exact_match, best_match = False, fmt
+                        break
+            if not best_match:
+                for fmt in video_formats:
+                    # Check for resolution
+                    if source_resolution == fmt['format']:
+                        exact_match, best_match = False, fmt
+                        break
+            if not best_match:
+                # Match the highest resolution
+                exact_match, best_match = False, video_formats[0]
+    # Check for resolution + codec + hdr
+    elif media.source.prefer_hdr and not media.source.prefer_60fps:
+        for fmt in video_formats:
+            # Check for an exact match
+            if (source_resolution == fmt['format'] and
+                source_vcodec == fmt['vcodec'] and 
+                fmt['is_hdr']):
+                # Exact match
+                exact_match, best_match = True, fmt
+                break
+        if media.source.can_fallback:
+            if not best_match:
+                for fmt in video_formats:
+                    # Check for a resolution and fps match but drop the codec
+                    if (source_resolution == fmt['format'] and 
+                        fmt['is_hdr'] and
+                        not fmt['is_60fps']):
+                        exact_match, best_match = False, fmt
+                        break
+            if not best_match:
+                for fmt in video_formats:
+                    # Check for a codec and fps match but drop the resolution
+                    if (source_vcodec == fmt['vcodec'] and 
+                        fmt['is_hdr'] and
+                        not fmt['is_60fps']):
+                        exact_match, best_match = False, fmt
+                        break
+            if not best_match:
+                for fmt in video_formats:
+                    # Check for a codec and 60fps match
+                    if (source_vcodec == fmt['vcodec'] and 
+                        fmt['is_hdr']):
+                        exact_match, best_match = False, fmt
+                        break
+            if not best_match:
+                for fmt in video_formats:
+                    # Check for codec and resolution match bot drop hdr
+                    if (source_resolution == fmt['format'] and
+                        source_vcodec == fmt['vcodec'] and
+                        not fmt['is_60fps']):
+                        exact_match, best_match = False, fmt
+                        break
+            if not best_match:
+                for fmt in video_formats:
+                    # Check for codec and resolution match only
+                    if (source_resolution == fmt['format'] and
+                        source_vcodec == fmt['vcodec']):
+                        exact_match, best_match = False, fmt
+                        break
+            if not best_match:
+                for fmt in video_formats:
+                    # Check for resolution
+                    if source_resolution == fmt['format']:
+                        exact_match, best_match = False, fmt
+                        break
+            if not best_match:
+                # Match the highest resolution
+                exact_match, best_match = False, video_formats[0]
+    # check for resolution + codec
+    elif not media.source.prefer_hdr and not media.source.prefer_60fps:
+        for fmt in video_formats:
+            # Check for an exact match
+            if (source_resolution == fmt['format'] and
+                source_vcodec == fmt['vcodec'] and
+                not fmt['is_60fps'] and
+                not fmt['is_hdr']):
+                # Exact match
+                exact_match, best_match = True, fmt
+                break
+        if media.source.can_fallback:
+            if not best_match:
+                for fmt in video_formats:
+                    # Check for a resolution, hdr and fps match but drop the codec
+                    if (source_resolution == fmt['format'] and 
+                        not fmt['is_hdr'] and not fmt['is_60fps']):
+                        # Close match
+                        exact_match, best_match = False, fmt
+                        break
+            if not best_match:
+                for fmt in video_formats:
+                    # Check for a codec, hdr and fps match but drop the resolution
+                    if (source_vcodec == fmt['vcodec'] and 
+                        not fmt['is_hdr'] and fmt['is_60fps']):
+                        # Close match
+                        exact_match, best_match = False, fmt
+                        break
+            if not best_match:
+                for fmt in video_formats:
+                    # Check for resolution, codec and hdr match
+                    if (source_resolution == fmt['format'] and
+                        source_vcodec == fmt['vcodec'] and
+                        not fmt['is_hdr']):
+                        exact_match, best_match = False, fmt
+                        break
+            if not best_match:
+                for fmt in video_formats:
+                    # Check for resolution, codec and 60fps match
+                    if (source_resolution == fmt['format'] and
+                        source_vcodec == fmt['vcodec'] and
+                        not fmt['is_60fps']):
+                        exact_match, best_match = False, fmt
+                        break
+            if not best_match:
+                for fmt in video_formats:
+                    # Check for resolution and codec
+                    if (source_resolution == fmt['format'] and
+                        source_vcodec == fmt['vcodec']):
+                        exact_match, best_match = False, fmt
+                        break
+            if not best_match:
+                for fmt in video_formats:
+                    # Check for resolution and not hdr
+                    if (source_resolution == fmt['format'] and
+                        not fmt['is_hdr']):
+                        exact_match, best_match = False, fmt
+                        break
+            if not best_match:
+                for fmt in video_formats:
+                    # Check for resolution
+                    if source_resolution == fmt['format']:
+                        exact_match, best_match = False, fmt
+                        break
+            if not best_match:
+                # Match the highest resolution
+                exact_match, best_match = False, video_formats[0]
+    # See if we found a match
+    if best_match:
+        # Final check to see if the match we found was good enough
+        if exact_match:
+            return True, best_match['id']
+        elif media.source.can_fallback:
+            # Allow the fallback if it meets requirements
+            if (media.source.fallback == media.source.FALLBACK_NEXT_BEST_HD and
+                best_match['height'] >= fallback_hd_cutoff):
+                return False, best_match['id']
+            elif media.source.fallback == media.source.FALLBACK_NEXT_BEST:
+                return False, best_match['id']
+    # Nope, failed to find match
+    return False, False
+
+
 class FormatMatchingTestCase(TestCase):
 
     def setUp(self):
@@ -1658,6 +2097,140 @@ class FormatMatchingTestCase(TestCase):
             self.media.get_best_video_format()
             self.media.get_best_audio_format()
 
+    def test_video_format_ranking_equivalence(self):
+
+        class FormatListMedia:
+            def __init__(self, source, formats):
+                self.source = source
+                self.formats = formats
+            def iter_formats(self):
+                return iter(self.formats)
+
+        def source_settings():
+            for resolution in Source.SOURCE_RESOLUTIONS:
+                for vcodec in Source.SOURCE_VCODECS:
+                    for prefer_60fps in (False, True):
+                        for prefer_hdr in (False, True):
+                            for fallback in Source.FALLBACKS:
+                                yield resolution, vcodec, prefer_60fps, prefer_hdr, fallback
+
+        def check(media):
+            for resolution, vcodec, prefer_60fps, prefer_hdr, fallback in source_settings():
+                self.source.source_resolution = resolution
+                self.source.source_vcodec = vcodec
+                self.source.prefer_60fps = prefer_60fps
+                self.source.prefer_hdr = prefer_hdr
+                self.source.fallback = fallback
+                self.assertEqual(get_best_video_format(media),
+                                 cascade_best_video_format(media))
+
+        # All the real world test metadata
+        for metadata in all_test_metadata.values():
+            media = FormatListMedia(self.source, [])
+            self.media.metadata = metadata
+            media.formats = list(self.media.iter_formats())
+            check(media)
+        # Randomly generated format lists, seeded so failures are reproducible
+        rng = random.Random(20231001)
+        heights = (144, 240, 360, 480, 720, 1080, 1440, 2160, 4320)
+        for _ in range(150):
+            formats = []
+            for i in range(rng.randint(0, 12)):
+                height = rng.choice(heights)
+                formats.append({
+                    'id': str(i),
+                    'format': rng.choice((f'{height}P', f'{height}P', None, 'AUDIO')),
+                    'height': height,
+                    'vcodec': rng.choice(('AVC1', 'VP9', 'AV1', None, '')),
+                    'acodec': rng.choice((None, None, None, 'OPUS', 'MP4A')),
+                    'is_60fps': rng.random() < 0.4,
+                    'is_hdr': rng.random() < 0.3,
+                })
+            check(FormatListMedia(self.source, formats))
+
+    def test_stored_formats(self):
+        self.source.fallback = Source.FALLBACK_NEXT_BEST
+        self.media.metadata = all_test_metadata['20230629']
+        self.media.save()
+        parsed_formats = list(self.media.iter_formats())
+        expected_format_str = self.media.get_format_str()
+        self.assertEqual(self.media.save_formats(), len(parsed_formats))
+        self.assertEqual(self.media.media_formats.count(), len(parsed_formats))
+        # A fresh instance reads the formats from the MediaFormat table
+        media = Media.objects.get(pk=self.media.pk)
+        media.source = self.source
+        with self.assertNumQueries(1):
+            stored_formats = list(media.iter_formats())
+            list(media.iter_formats())
+        self.assertEqual(stored_formats, parsed_formats)
+        # The stored values have the same types as parsed ones, 24.0 == 24 but 24.0
+        # would be shown in filenames
+        self.assertEqual([{k: type(v) for k, v in fmt.items()} for fmt in stored_formats],
+                         [{k: type(v) for k, v in fmt.items()} for fmt in parsed_formats])
+        self.assertEqual(media.get_format_str(), expected_format_str)
+        # Changing the metadata on the instance stops the stored formats being used
+        media.metadata = all_test_metadata['boring']
+        self.assertEqual(list(media.iter_formats()),
+                         [parse_media_format(f) for f in media.formats])
+
+    def test_selected_format(self):
+        self.source.fallback = Source.FALLBACK_NEXT_BEST
+        self.source.save()
+        self.media.metadata = all_test_metadata['20230629']
+        self.media.save()
+        self.media.save_formats()
+        expected_format_str = self.media.calculate_format_str()
+        self.assertEqual(self.media.selected_format, expected_format_str)
+        self.assertEqual(self.media.selected_format_fingerprint,
+                         self.source.format_fingerprint)
+        # A fresh instance uses the stored format without reading any formats
+        media = Media.objects.get(pk=self.media.pk)
+        media.source = self.source
+        with self.assertNumQueries(0):
+            self.assertEqual(media.get_format_str(), expected_format_str)
+        # Changing the source format settings recalculates the format
+        self.source.source_resolution = Source.SOURCE_RESOLUTION_AUDIO
+        self.assertNotEqual(self.source.format_fingerprint,
+                            media.selected_format_fingerprint)
+        audio_format_str = media.get_format_str()
+        self.assertNotEqual(audio_format_str, expected_format_str)
+        self.assertEqual(audio_format_str, media.calculate_format_str())
+        self.assertEqual(media.selected_format_fingerprint,
+                         self.source.format_fingerprint)
+        # Saving stores the new selection even with limited update_fields
+        media.save(update_fields=['skip'])
+        media = Media.objects.get(pk=self.media.pk)
+        self.assertEqual(media.selected_format, audio_format_str)
+        # Changing the metadata recalculates the format
+        self.source.source_resolution = Source.SOURCE_RESOLUTION_1080P
+        media.source = self.source
+        media.get_format_str()
+        media.metadata = all_test_metadata['boring']
+        self.assertEqual(media.get_format_str(), media.calculate_format_str())
+        self.assertEqual(media.selected_format, media.calculate_format_str() or '')
+        # The format recalculated with unchanged source settings is saved with the
+        # metadata
+        Media.objects.filter(pk=media.pk).update(selected_format='')
+        media.save(update_fields=['metadata'])
+        media = Media.objects.get(pk=self.media.pk)
+        self.assertEqual(media.selected_format_fingerprint,
+                         self.source.format_fingerprint)
+        self.assertEqual(media.selected_format, media.calculate_format_str() or '')
+
+    def test_format_by_code(self):
+        self.media.metadata = all_test_metadata['20230629']
+        formats = list(self.media.iter_formats())
+        self.assertGreater(len(formats), 40)
+        for fmt in formats:
+            self.assertEqual(self.media.get_format_by_code(fmt['id']), fmt)
+        self.assertFalse(self.media.get_format_by_code('nonexistent'))
+        self.assertFalse(self.media.get_format_by_code(False))
+        # The map is built once and rebuilt when the metadata changes
+        self.assertIs(self.media.formats_by_id, self.media.formats_by_id)
+        self.media.metadata = all_test_metadata['boring']
+        self.assertEqual(set(self.media.formats_by_id),
+                         {fmt['id'] for fmt in self.media.iter_formats()})
+
     def test_is_regex_match(self):
         
         self.media.metadata = all_test_metadata['boring']
@@ -1709,8 +2282,921 @@ class TasksTestCase(TestCase):
         self.assertEqual(src1.media_source.all().count(), 3)
         self.assertEqual(src2.media_source.all().count(), 3)
 
-        cleanup_old_media()
+        self.assertEqual(cleanup_old_media(), 1)
 
         self.assertEqual(src1.media_source.all().count(), 3)
         self.assertEqual(src2.media_source.all().count(), 2)
         self.assertEqual(Media.objects.filter(pk=m22.pk).exists(), False)
+
+    def test_index_source_media(self):
+        source = Source.objects.create(key='ccc', name='ccc', directory='/tmp/c')
+        existing = Media.objects.create(source=source, key='c1')
+        Media.objects.create(source=source, key='c2')
+        Task.objects.all().delete()
+        videos = [{'id': 'c1'}, {'id': 'c3'}, {'id': 'c3'}, {'id': 'c4'}, {'title': 'no id'}]
+        # Loading the known keys, creating the media in a savepoint as tests run in a
+        # transaction, and scheduling the metadata downloads
+        with self.assertNumQueries(5):
+            counts = index_source_media(source, iter(videos))
+        self.assertEqual(counts, (2, 1, {'c2'}))
+        self.assertEqual(set(source.media_source.values_list('key', flat=True)),
+                         {'c1', 'c2', 'c3', 'c4'})
+        self.assertEqual(Media.objects.get(pk=existing.pk).key, 'c1')
+        # Metadata downloads are scheduled in a batch for the new media only
+        new_media = source.media_source.filter(key__in=('c3', 'c4'))
+        task = Task.objects.get(task_name='sync.tasks.download_media_metadata_batch')
+        self.assertEqual(task.priority, 5)
+        self.assertEqual(set(json.loads(task.task_params)[0][0]),
+                         {str(media.pk) for media in new_media})
+        self.assertEqual(Task.objects.count(), 1)
+        # A full index of the same media is skipped without any queries
+        source.save(update_fields=Source.INDEX_STATE_FIELDS)
+        self.assertEqual(Task.objects.count(), 1)
+        with self.assertNumQueries(0):
+            self.assertEqual(index_source_media(source, videos), (0, 3, set()))
+        # An incremental index of the same media is skipped without any queries
+        index_source_media(source, videos, full_index=False)
+        with self.assertNumQueries(0):
+            self.assertEqual(index_source_media(source, videos, full_index=False),
+                             (0, 3, set()))
+        # A changed index is compared with the known media
+        videos.append({'id': 'c5'})
+        self.assertEqual(index_source_media(source, videos), (1, 3, {'c2'}))
+        self.assertEqual(Task.objects.count(), 2)
+        # Media created by something else since the known keys were loaded are
+        # skipped rather than failing the index
+        other = Media.objects.create(source=source, key='c6', title='other')
+        Task.objects.all().delete()
+        entries = [('c6', {'title': 'c6'}), ('c7', {'title': 'c7'})]
+        self.assertEqual(create_indexed_media(source, entries, set()), 1)
+        self.assertEqual(Media.objects.get(pk=other.pk).title, 'other')
+        self.assertTrue(source.media_source.filter(key='c7').exists())
+        task = Task.objects.get(task_name='sync.tasks.download_media_metadata_batch')
+        self.assertEqual(json.loads(task.task_params)[0][0],
+                         [str(source.media_source.get(key='c7').pk)])
+        # Changing the source settings makes the next index process all media
+        source.refresh_from_db()
+        self.assertTrue(source.index_fingerprint)
+        source.save()
+        self.assertEqual(Source.objects.get(pk=source.pk).index_fingerprint, '')
+        self.assertTrue(Task.objects.filter(
+            task_name='sync.tasks.save_all_media_for_source').exists())
+
+    def test_incremental_index(self):
+        source = Source.objects.create(key='ddd', name='ddd', directory='/tmp/d',
+                                       index_streams=False)
+        for i in range(10, 100):
+            Media.objects.create(source=source, key=f'd{i}')
+        fetched = []
+
+        def fake_indexer(url):
+            # Newest first, 5 new media then 90 known media
+            for i in range(104, 9, -1):
+                fetched.append(i)
+                yield {'id': f'd{i}'}
+
+        self.assertTrue(source.can_index_incrementally)
+        self.assertTrue(source.needs_full_index)
+        with mock.patch.dict(Source.INDEXERS,
+                             {Source.SOURCE_TYPE_YOUTUBE_CHANNEL: fake_indexer}):
+            with self.settings(INDEX_INCREMENTAL_KNOWN_LIMIT=20):
+                entries = list(source.index_media(incremental=True))
+        # Stops after 20 known media in a row
+        self.assertEqual(len(fetched), 25)
+        self.assertEqual([e['id'] for e in entries[:5]],
+                         ['d104', 'd103', 'd102', 'd101', 'd100'])
+        self.assertEqual(index_source_media(source, entries, full_index=False),
+                         (5, 20, set()))
+        # A full index is only due again after the interval
+        source.last_full_crawl = timezone.now()
+        self.assertFalse(source.needs_full_index)
+        source.last_full_crawl = timezone.now() - timedelta(hours=25)
+        self.assertTrue(source.needs_full_index)
+        # Playlists are always indexed fully
+        source.last_full_crawl = timezone.now()
+        source.source_type = Source.SOURCE_TYPE_YOUTUBE_PLAYLIST
+        self.assertTrue(source.needs_full_index)
+
+    def test_cleanup_removed_media(self):
+        source = Source.objects.create(key='eee', name='eee', directory='/tmp/e',
+                                       delete_removed_media=True)
+        for i in range(40):
+            Media.objects.create(source=source, key=f'e{i}', downloaded=i < 30)
+        # 5 downloaded media removed from the source
+        removed_keys = {f'e{i}' for i in range(5)}
+        self.assertEqual(cleanup_removed_media(source, removed_keys), 5)
+        self.assertEqual(source.media_source.count(), 35)
+        self.assertFalse(source.media_source.filter(key__in=('e0', 'e4')).exists())
+        # An index missing most of the downloaded media removes nothing
+        removed_keys = {f'e{i}' for i in range(25)}
+        self.assertEqual(cleanup_removed_media(source, removed_keys), 0)
+        self.assertEqual(source.media_source.count(), 35)
+        with self.settings(MAX_REMOVED_MEDIA_FRACTION=0):
+            self.assertEqual(cleanup_removed_media(source, removed_keys), 20)
+        self.assertEqual(source.media_source.count(), 15)
+
+    def test_streaming_index(self):
+        source = Source.objects.create(key='fff', name='fff', directory='/tmp/f',
+                                       index_streams=False)
+        fetched = []
+
+        created = {}
+
+        def fake_indexer(url):
+            for i in range(1200):
+                fetched.append(i)
+                if i == 600:
+                    created[i] = source.media_source.count()
+                yield {'id': f'f{i}'}
+
+        with mock.patch.dict(Source.INDEXERS,
+                             {Source.SOURCE_TYPE_YOUTUBE_CHANNEL: fake_indexer}):
+            # The index is only fetched as it is consumed
+            source.index_media()
+            self.assertEqual(fetched, [])
+            # MAX_ENTRIES_PROCESSING stops fetching the index early
+            with self.settings(MAX_ENTRIES_PROCESSING=700):
+                counts = index_source_media(source, source.index_media())
+        self.assertEqual(len(fetched), 700)
+        self.assertEqual(counts, (700, 0, set()))
+        self.assertEqual(source.media_source.count(), 700)
+        # Media are created in chunks while the index is still being fetched
+        self.assertEqual(created, {600: 500})
+
+    def test_concurrent_tab_index(self):
+        source = Source.objects.create(key='ggg', name='ggg', directory='/tmp/g',
+                                       index_streams=True)
+        # Both tabs must be fetched at the same time to pass the barrier
+        barrier = threading.Barrier(2, timeout=10)
+
+        def fake_indexer(url):
+            tab = url.rsplit('/', 1)[-1]
+            barrier.wait()
+            for i in range(300):
+                yield {'id': f'{tab}{i}'}
+            yield {'id': 'shared'}
+
+        with mock.patch.dict(Source.INDEXERS,
+                             {Source.SOURCE_TYPE_YOUTUBE_CHANNEL: fake_indexer}), \
+                mock.patch('sync.utils.connection') as db_connection:
+            keys = [entry['id'] for entry in source.index_media()]
+        # Each tab's thread closes its database connection
+        self.assertEqual(db_connection.close.call_count, 2)
+        self.assertEqual(len(keys), 601)
+        self.assertEqual(len(set(keys)), 601)
+        self.assertIn('videos299', keys)
+        self.assertIn('streams299', keys)
+
+        def failing_indexer(url):
+            yield {'id': 'ok'}
+            raise ValueError('tab failed')
+
+        with mock.patch.dict(Source.INDEXERS,
+                             {Source.SOURCE_TYPE_YOUTUBE_CHANNEL: failing_indexer}):
+            with self.assertRaises(ValueError):
+                list(source.index_media())
+
+    def test_index_fingerprint_tab_order(self):
+        source = Source.objects.create(key='ggh', name='ggh', directory='/tmp/g')
+        videos = [{'id': f'videos{i}'} for i in range(5)]
+        streams = [{'id': f'streams{i}'} for i in range(3)]
+        # The tabs are merged in the order their entries are fetched
+        interleaved = [videos[0], streams[0], videos[1], videos[2], streams[1],
+                       videos[3], streams[2], videos[4]]
+        self.assertEqual(index_source_media(source, videos + streams, full_index=False),
+                         (8, 0, set()))
+        fingerprint = source.index_fingerprint
+        with self.assertNumQueries(0):
+            self.assertEqual(index_source_media(source, interleaved, full_index=False),
+                             (0, 8, set()))
+        with self.assertNumQueries(0):
+            self.assertEqual(index_source_media(source, streams + videos,
+                                                full_index=False), (0, 8, set()))
+        self.assertEqual(source.index_fingerprint, fingerprint)
+
+    def test_housekeeping_task(self):
+        # Scheduled once when the database is migrated
+        housekeeping = Task.objects.filter(task_name='sync.tasks.housekeeping_task')
+        self.assertEqual(housekeeping.count(), 1)
+        self.assertEqual(housekeeping.get().repeat, settings.HOUSEKEEPING_INTERVAL)
+        with self.settings(HOUSEKEEPING_INTERVAL=600):
+            schedule_housekeeping_task()
+        self.assertEqual(housekeeping.count(), 1)
+        self.assertEqual(housekeeping.get().repeat, 600)
+        Task.objects.all().delete()
+        schedule_housekeeping_task()
+        self.assertEqual(housekeeping.count(), 1)
+
+    def test_schedule_missing_media_tasks(self):
+        source = Source.objects.create(key='mmt', name='mmt', directory='/tmp/mmt')
+        now = timezone.now()
+        lost_metadata = Media.objects.create(source=source, key='m1')
+        queued_metadata = Media.objects.create(source=source, key='m2')
+        lost_download = Media.objects.create(source=source, key='m3', metadata=metadata,
+                                             published=now)
+        failed_download = Media.objects.create(source=source, key='m4',
+                                               metadata=metadata, published=now)
+        queued_download = Media.objects.create(source=source, key='m5',
+                                               metadata=metadata, published=now)
+        Media.objects.create(source=source, key='m6', metadata=metadata, published=now,
+                             downloaded=True)
+        Media.objects.create(source=source, key='m7', manual_skip=True)
+        self.assertTrue(lost_download.can_download)
+        Task.objects.all().delete()
+        schedule_media_metadata_tasks([queued_metadata.pk])
+        failed = Task.objects.new_task('sync.tasks.download_media',
+                                       args=(str(failed_download.pk),),
+                                       queue=str(source.pk))
+        failed.failed_at = now
+        failed.save()
+        Task.objects.new_task('sync.tasks.download_media',
+                              args=(str(queued_download.pk),),
+                              queue=str(source.pk)).save()
+        Task.objects.new_task('sync.tasks.download_media_thumbnail',
+                              args=(str(queued_download.pk), queued_download.thumbnail),
+                              queue=str(source.pk)).save()
+        self.assertEqual(schedule_missing_media_tasks(source), (1, 3, 2))
+        thumbnails = Task.objects.filter(task_name='sync.tasks.download_media_thumbnail')
+        self.assertEqual({json.loads(task.task_params)[0][0] for task in thumbnails},
+                         {str(media.pk) for media in source.media_source.filter(
+                             key__in=('m3', 'm4', 'm5', 'm6'))})
+        batches = Task.objects.filter(
+            task_name='sync.tasks.download_media_metadata_batch').order_by('pk')
+        self.assertEqual(json.loads(batches.last().task_params)[0][0],
+                         [str(lost_metadata.pk)])
+        downloads = Task.objects.filter(task_name='sync.tasks.download_media')
+        self.assertEqual(downloads.count(), 3)
+        self.assertFalse(downloads.filter(failed_at__isnull=False).exists())
+        # Nothing is scheduled twice
+        self.assertEqual(schedule_missing_media_tasks(source), (0, 0, 0))
+        source.download_media = False
+        self.assertEqual(schedule_missing_media_tasks(source), (0, 0, 0))
+        # Only the tasks of the media of the source are loaded
+        Media.objects.filter(source=source).update(thumb='thumbs/x.jpg')
+        other = Source.objects.create(key='oth', name='oth', directory='/tmp/oth')
+        schedule_media_metadata_tasks([uuid.uuid4() for i in range(5)])
+        with mock.patch('sync.tasks.json', wraps=json) as tasks_json:
+            self.assertEqual(schedule_missing_media_tasks(source), (0, 0, 0))
+        loaded = [call[0][0] for call in tasks_json.loads.call_args_list]
+        # The metadata batches of the two media with no metadata, not the batch of
+        # the other media
+        self.assertEqual(len(loaded), 2)
+        self.assertTrue(all(str(lost_metadata.pk) in task_params or
+                            str(queued_metadata.pk) in task_params
+                            for task_params in loaded))
+        self.assertEqual(schedule_missing_media_tasks(other), (0, 0, 0))
+        # The index of a source which is unchanged does not look for missing tasks
+        def fake_indexer(url):
+            for key in ('m1', 'm2', 'm3', 'm4', 'm5', 'm6', 'm7'):
+                yield {'id': key}
+
+        with mock.patch.dict(Source.INDEXERS,
+                             {Source.SOURCE_TYPE_YOUTUBE_CHANNEL: fake_indexer}), \
+                mock.patch('sync.tasks.schedule_missing_media_tasks') as sweep:
+            # A full index then the first incremental index
+            index_source_task.now(str(source.pk))
+            index_source_task.now(str(source.pk))
+            self.assertEqual(sweep.call_count, 2)
+            index_source_task.now(str(source.pk))
+            self.assertEqual(sweep.call_count, 2)
+
+    def test_index_filters_expired_media(self):
+        source = Source.objects.create(key='exp', name='exp', directory='/tmp/exp',
+                                       delete_old_media=True, days_to_keep=7)
+        published = timezone.now() - timedelta(days=5)
+        media = Media.objects.create(source=source, key='e1', metadata=metadata,
+                                     published=published)
+        indexed = Media.objects.create(source=source, key='e2', published=published)
+        self.assertFalse(Media.objects.get(pk=media.pk).skip)
+        self.assertFalse(Media.objects.get(pk=indexed.pk).skip)
+        Task.objects.all().delete()
+
+        def fake_indexer(url):
+            yield {'id': 'e1'}
+            yield {'id': 'e2'}
+
+        with mock.patch.dict(Source.INDEXERS,
+                             {Source.SOURCE_TYPE_YOUTUBE_CHANNEL: fake_indexer}):
+            index_source_task.now(str(source.pk))
+            self.assertFalse(Media.objects.get(pk=media.pk).skip)
+            Task.objects.all().delete()
+            # The media get older than the days to keep without the index changing
+            later = timezone.now() + timedelta(days=3)
+            with mock.patch('sync.tasks.timezone.now', return_value=later), \
+                    mock.patch('sync.filtering.timezone.now', return_value=later):
+                index_source_task.now(str(source.pk))
+        self.assertTrue(Media.objects.get(pk=media.pk).skip)
+        self.assertTrue(Media.objects.get(pk=indexed.pk).skip)
+        # No downloads are scheduled for the skipped media
+        self.assertFalse(Task.objects.filter(
+            task_name='sync.tasks.download_media').exists())
+
+    def test_filter_indexed_media(self):
+        source = Source.objects.create(key='hhh', name='hhh', directory='/tmp/h',
+                                       filter_text='keep', filter_seconds=600,
+                                       filter_seconds_min=False)
+        Task.objects.all().delete()
+        published = timezone.now() - timedelta(days=2)
+        videos = [
+            {'id': 'h1', 'title': 'keep this', 'duration': 300.0,
+             'timestamp': published.timestamp()},
+            {'id': 'h2', 'title': 'drop this', 'duration': 300},
+            {'id': 'h3', 'title': 'keep this too', 'duration': 900},
+            {'id': 'h4'},
+        ]
+        self.assertEqual(parse_index_entry(videos[0]), {
+            'title': 'keep this',
+            'duration': 300,
+            'published': published.replace(microsecond=0),
+            'upload_date': published.date(),
+        })
+        self.assertEqual(parse_index_entry({'upload_date': 'invalid'}), {})
+        index_source_media(source, videos)
+        skipped = dict(source.media_source.values_list('key', 'skip'))
+        self.assertEqual(skipped, {'h1': False, 'h2': True, 'h3': True, 'h4': False})
+        # Metadata is only downloaded for media which passed the filters
+        scheduled = set()
+        for task in Task.objects.filter(
+                task_name='sync.tasks.download_media_metadata_batch'):
+            scheduled.update(json.loads(task.task_params)[0][0])
+        self.assertEqual(scheduled, {str(media.pk) for media in
+                                     source.media_source.filter(key__in=('h1', 'h4'))})
+        # Changing the filters rechecks media without metadata when they are saved
+        source.filter_text = ''
+        source.save()
+        media = source.media_source.get(key='h2')
+        media.save()
+        self.assertFalse(Media.objects.get(pk=media.pk).skip)
+        self.assertTrue(Task.objects.get_task('sync.tasks.download_media_metadata',
+                                              args=(str(media.pk),)).exists())
+
+    def test_download_media_metadata_batch(self):
+        source = Source.objects.create(key='jjj', name='jjj', directory='/tmp/j')
+        media_items = [Media.objects.create(source=source, key=f'j{i}')
+                       for i in range(3)]
+        Task.objects.all().delete()
+        urls = []
+
+        def get_media_info(url):
+            urls.append(url)
+            if url.endswith('j1'):
+                raise Exception('failed')
+            return json.loads(metadata)
+
+        with mock.patch('sync.youtube.MediaInfoExtractor') as extractor, \
+                self.settings(METADATA_FETCH_WORKERS=1):
+            extractor.return_value.__enter__.return_value.get_media_info = \
+                get_media_info
+            download_media_metadata_batch.now([str(m.pk) for m in media_items])
+        # One extractor is reused by each worker
+        self.assertEqual(extractor.call_count, 1)
+        self.assertEqual(len(urls), 3)
+        # A failed media item doesn't stop the batch and is retried on its own
+        for i, media in enumerate(media_items):
+            media.refresh_from_db()
+            self.assertEqual(bool(media.metadata), i != 1)
+        self.assertTrue(Task.objects.get_task('sync.tasks.download_media_metadata',
+                                              args=(str(media_items[1].pk),)).exists())
+
+    def test_throttling_circuit_breaker(self):
+        url = 'https://www.youtube.com/watch?v=abc'
+        self.assertFalse(circuit_breaker.is_open())
+        error = yt_dlp.utils.DownloadError(
+            'ERROR: [youtube] abc: Sign in to confirm you\u2019re not a bot')
+        self.assertTrue(is_throttling_error(error))
+        self.assertTrue(is_throttling_error('HTTP Error 429: Too Many Requests'))
+        self.assertFalse(is_throttling_error('Video unavailable'))
+        with mock.patch.object(yt_dlp.YoutubeDL, 'extract_info', side_effect=error):
+            with self.assertRaises(YouTubeThrottledError):
+                get_media_info(url)
+        status = circuit_breaker.status()
+        self.assertTrue(status['open'])
+        self.assertEqual(status['failures'], 1)
+        pause = (status['retry_at'] - timezone.now()).total_seconds()
+        self.assertTrue(55 < pause <= 75)
+        # While paused requests to YouTube aren't made at all
+        with mock.patch.object(yt_dlp.YoutubeDL, 'extract_info') as extract_info:
+            with self.assertRaises(YouTubeThrottledError):
+                get_media_info(url)
+            extract_info.assert_not_called()
+        # The pause doubles while YouTube keeps throttling
+        state = circuit_breaker.state()
+        state['open_until'] = 0
+        cache.set(circuit_breaker.cache_key, state)
+        circuit_breaker.record_throttled(error)
+        pause = (circuit_breaker.retry_at() - timezone.now()).total_seconds()
+        self.assertTrue(115 < pause <= 150)
+        # Throttled tasks are retried after the pause without using an attempt, even
+        # on the first attempt of a task with a single attempt
+        task = Task.objects.new_task('sync.tasks.download_media_metadata',
+                                     args=('abc',))
+        task.save()
+        throttled = YouTubeThrottledError('paused')
+        with self.settings(MAX_ATTEMPTS=1):
+            task_error.send(sender=YouTubeThrottledError, task=task)
+            task.reschedule(YouTubeThrottledError, throttled, None)
+        task = Task.objects.get(pk=task.pk)
+        self.assertIsNone(task.failed_at)
+        self.assertEqual(task.attempts, 0)
+        self.assertGreaterEqual(task.run_at, circuit_breaker.retry_at())
+        task.attempts = 3
+        task.save()
+        task_error.send(sender=YouTubeThrottledError, task=task)
+        task.reschedule(YouTubeThrottledError, throttled, None)
+        task = Task.objects.get(pk=task.pk)
+        self.assertEqual(task.attempts, 3)
+        # Other errors still count
+        task_error.send(sender=ValueError, task=task)
+        task.reschedule(ValueError, ValueError('failed'), None)
+        self.assertEqual(Task.objects.get(pk=task.pk).attempts, 4)
+        # The pause is shown on the tasks page
+        response = Client().get('/tasks')
+        self.assertContains(response, 'YouTube is throttling requests')
+        circuit_breaker.record_success()
+        self.assertFalse(circuit_breaker.is_open())
+        self.assertNotContains(Client().get('/tasks'), 'YouTube is throttling requests')
+        # Errors fetching later pages of an index open the circuit breaker too
+
+        def entries():
+            yield {'id': 'abc'}
+            raise yt_dlp.utils.ExtractorError('HTTP Error 429: Too Many Requests')
+
+        with mock.patch.object(yt_dlp.YoutubeDL, 'extract_info',
+                               return_value={'entries': entries()}):
+            fetched = []
+            with self.assertRaises(YouTubeThrottledError):
+                for entry in iter_media_info_entries(url):
+                    fetched.append(entry)
+        self.assertEqual(fetched, [{'id': 'abc'}])
+        self.assertTrue(circuit_breaker.is_open())
+        # An index which stops early closes a circuit breaker whose pause is over
+        state = circuit_breaker.state()
+        state['open_until'] = 0
+        cache.set(circuit_breaker.cache_key, state)
+
+        def endless_entries():
+            while True:
+                yield {'id': 'abc'}
+
+        with mock.patch.object(yt_dlp.YoutubeDL, 'extract_info',
+                               return_value={'entries': endless_entries()}):
+            entries = iter_media_info_entries(url)
+            self.assertEqual(next(entries), {'id': 'abc'})
+            entries.close()
+        self.assertEqual(circuit_breaker.state()['failures'], 0)
+
+    def test_metadata_refresh(self):
+        source = Source.objects.create(key='kkk', name='kkk', directory='/tmp/k')
+        now = timezone.now()
+        stale = now - timedelta(hours=settings.METADATA_REFRESH_TTL_HOURS + 1)
+        fresh = now - timedelta(hours=1)
+        media = {}
+        for key, fetched_at, downloaded in (('k1', stale, False), ('k2', fresh, False),
+                                            ('k3', stale, True), ('k4', None, False)):
+            media[key] = Media.objects.create(
+                source=source, key=key, downloaded=downloaded, published=now,
+                metadata=metadata if fetched_at else None)
+            Media.objects.filter(pk=media[key].pk).update(metadata_fetched_at=fetched_at)
+            media[key].refresh_from_db()
+        self.assertTrue(media['k1'].metadata_is_stale)
+        self.assertFalse(media['k2'].metadata_is_stale)
+        # Downloaded media is never refreshed
+        self.assertFalse(media['k3'].metadata_is_stale)
+        self.assertFalse(media['k4'].metadata_is_stale)
+        Task.objects.all().delete()
+        self.assertEqual(schedule_metadata_refresh(), 1)
+        task = Task.objects.get(task_name='sync.tasks.refresh_media_metadata_batch')
+        self.assertEqual(json.loads(task.task_params)[0][0], [str(media['k1'].pk)])
+        self.assertGreater(task.priority, 15)
+        # Nothing more is scheduled until the queued refresh has run
+        self.assertEqual(schedule_metadata_refresh(), 0)
+        with self.settings(METADATA_REFRESH_TTL_HOURS=0):
+            self.assertFalse(media['k1'].metadata_is_stale)
+        # Media from sources which don't download media is never refreshed
+        Task.objects.filter(task_name='sync.tasks.refresh_media_metadata_batch').delete()
+        source.download_media = False
+        source.save()
+        media['k1'].source.refresh_from_db()
+        self.assertFalse(media['k1'].metadata_is_stale)
+        self.assertEqual(schedule_metadata_refresh(), 0)
+        source.download_media = True
+        source.save()
+        media['k1'].source.refresh_from_db()
+        with mock.patch('sync.youtube.MediaInfoExtractor') as extractor:
+            extractor.return_value.__enter__.return_value.get_media_info = \
+                lambda url: json.loads(metadata)
+            refresh_media_metadata_batch.now([str(m.pk) for m in media.values()])
+        for key in media:
+            media[key].refresh_from_db()
+        self.assertGreater(media['k1'].metadata_fetched_at, fresh)
+        self.assertFalse(media['k1'].metadata_is_stale)
+        self.assertEqual(media['k2'].metadata_fetched_at, fresh)
+        self.assertEqual(media['k3'].metadata_fetched_at, stale)
+        self.assertIsNone(media['k4'].metadata_fetched_at)
+
+    def test_metadata_refresh_before_download(self):
+        source = Source.objects.create(key='rrr', name='rrr', directory='/tmp/r')
+        media = Media.objects.create(source=source, key='r1', metadata=metadata,
+                                     published=timezone.now())
+        stale = timezone.now() - timedelta(hours=settings.METADATA_REFRESH_TTL_HOURS + 1)
+        Media.objects.filter(pk=media.pk).update(metadata_fetched_at=stale)
+        tasks = Task.objects.filter(task_name='sync.tasks.download_media')
+        task = tasks.get()
+        task.locked_by = str(os.getpid())
+        task.locked_at = timezone.now()
+        task.save()
+        with mock.patch('sync.models.Media.index_metadata',
+                        return_value=json.loads(metadata)), \
+                mock.patch('sync.models.Media.download_media',
+                           return_value=('22', 'mkv')):
+            # The media file isn't created by the mocked download
+            with self.assertRaises(DownloadFailedException):
+                download_media.now(str(media.pk))
+        media.refresh_from_db()
+        self.assertFalse(media.metadata_is_stale)
+        # Saving the refreshed metadata doesn't replace the running download task
+        self.assertEqual(list(tasks.values_list('pk', flat=True)), [task.pk])
+        # Once the download is no longer running the media is rescheduled
+        tasks.update(locked_by=None, locked_at=None)
+        media.save()
+        self.assertEqual(tasks.count(), 1)
+        self.assertNotEqual(tasks.get().pk, task.pk)
+
+    def test_partial_downloads(self):
+        source = Source.objects.create(key='lll', name='lll', directory='/tmp/l')
+        pending = Media.objects.create(source=source, key='l1')
+        stale = Media.objects.create(source=source, key='l2')
+        downloaded = Media.objects.create(source=source, key='l3', downloaded=True)
+        with tempfile.TemporaryDirectory() as tempdir, \
+                self.settings(YOUTUBE_DL_TEMPDIR=tempdir):
+            # Partial downloads are kept in a directory named by the media ID
+            partial_dir = pending.partial_download_dir
+            self.assertEqual(str(partial_dir),
+                             os.path.join(tempdir, 'partial', str(pending.pk)))
+            with mock.patch('sync.youtube.yt_dlp.YoutubeDL') as ydl:
+                download_youtube_media(pending.url, 'best', 'mkv',
+                                       os.path.join(tempdir, 'out', 'video.mkv'),
+                                       False, partial_dir=partial_dir)
+            opts = ydl.call_args[0][0]
+            self.assertTrue(opts['continuedl'])
+            self.assertEqual(opts['paths']['temp'], str(partial_dir))
+            self.assertEqual(opts['paths']['home'], os.path.join(tempdir, 'out'))
+            self.assertTrue(partial_dir.is_dir())
+            # Only the partial downloads of the formats being downloaded are resumed
+            for name, size in (('video.f137.mp4.part', 100), ('video.f140.m4a.part', 10),
+                               ('video.f137.mp4.part.aria2', 1),
+                               ('video.f137.mp4.part-Frag3', 1000),
+                               ('video.f22.mp4.part', 10000), ('video.f140.m4a', 5)):
+                with open(partial_dir / name, 'wb') as f:
+                    f.write(b'x' * size)
+            self.assertEqual(get_partial_download_size(partial_dir, '137+140'), 110)
+            self.assertEqual(get_partial_download_size(partial_dir, '22'), 10000)
+            self.assertEqual(get_partial_download_size(tempdir + '/none', '22'), 0)
+            for media in (pending, stale, downloaded):
+                media.partial_download_dir.mkdir(parents=True, exist_ok=True)
+                with open(media.partial_download_dir / 'video.mkv.part', 'wb') as f:
+                    f.write(b'x' * 100)
+            old = time.time() - (settings.PARTIAL_DOWNLOAD_MAX_AGE_HOURS + 1) * 3600
+            for path in (stale.partial_download_dir,
+                         stale.partial_download_dir / 'video.mkv.part'):
+                os.utime(path, (old, old))
+            (partial_dir.parent / 'unknown').mkdir()
+            self.assertEqual(cleanup_partial_downloads(), (3, 200))
+            self.assertEqual(os.listdir(partial_dir.parent), [str(pending.pk)])
+
+    def test_download_progress(self):
+        source = Source.objects.create(key='mmm', name='mmm', directory='/tmp/m')
+        media = Media.objects.create(source=source, key='m1')
+        Task.objects.all().delete()
+        task = Task.objects.new_task('sync.tasks.download_media', args=(str(media.pk),))
+        task.locked_by = str(os.getpid())
+        task.locked_at = timezone.now()
+        task.save()
+        snapshots = []
+        # Snapshots are kept in files rather than in the database cache
+        self.assertEqual(settings.CACHES['progress']['BACKEND'],
+                         'django.core.cache.backends.filebased.FileBasedCache')
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        caches_setting = dict(settings.CACHES, progress={
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': tempdir.name,
+        })
+        override = self.settings(CACHES=caches_setting)
+        override.enable()
+        self.addCleanup(override.disable)
+
+        def download(urls):
+            opts = ydl.call_args[0][0]
+            hook = opts['progress_hooks'][0]
+            for downloaded in (100, 200, 300):
+                hook({'status': 'downloading', 'filename': '/tmp/m/video.f137.mp4',
+                      'downloaded_bytes': downloaded, 'total_bytes': 400,
+                      'speed': 1000.0, 'eta': 65})
+                snapshots.append(media.download_progress)
+            opts['postprocessor_hooks'][0]({'status': 'started',
+                                            'postprocessor': 'Merger',
+                                            'info_dict': {'filepath': '/tmp/m/v.mkv'}})
+            snapshots.append(media.download_progress)
+            # The JSON endpoint shows the running download
+            response = Client().get('/tasks-progress')
+            snapshots.append(json.loads(response.content))
+            return 0
+
+        with mock.patch('sync.youtube.yt_dlp.YoutubeDL') as ydl, \
+                self.settings(DOWNLOAD_PROGRESS_INTERVAL=60):
+            ydl.return_value.__enter__.return_value.download = download
+            download_youtube_media(media.url, 'best', 'mkv', '/tmp/m/video.mkv',
+                                   False, progress_key=str(media.pk))
+        # Snapshots are throttled, the phase changing is always stored
+        self.assertEqual(snapshots[0]['phase'], 'download')
+        self.assertEqual(snapshots[0]['downloaded_bytes'], 100)
+        self.assertEqual(snapshots[0]['percent'], 25)
+        self.assertEqual(snapshots[0]['eta_str'], '00:01:05')
+        self.assertEqual(snapshots[2]['downloaded_bytes'], 100)
+        self.assertEqual(snapshots[3]['phase'], 'merge')
+        self.assertEqual(snapshots[3]['filename'], 'v.mkv')
+        downloads = snapshots[4]['downloads']
+        self.assertEqual(len(downloads), 1)
+        self.assertEqual(downloads[0]['media'], str(media.pk))
+        self.assertEqual(downloads[0]['phase'], 'merge')
+        # Progress is removed once the download finishes
+        self.assertIsNone(media.download_progress)
+        progress = DownloadProgress(str(media.pk))
+        progress.update('download', downloaded_bytes=50, total_bytes=100)
+        self.assertContains(Client().get('/tasks'), 'Downloading')
+        self.assertContains(Client().get(f'/media/{media.pk}'), 'determinate')
+        self.assertEqual(len(os.listdir(tempdir.name)), 1)
+        progress.finish()
+        self.assertEqual(os.listdir(tempdir.name), [])
+
+class MetadataFetcherTestCase(TestCase):
+    def setUp(self):
+        # Disable general logging for test case
+        logging.disable(logging.CRITICAL)
+
+    def test_metadata_fetcher(self):
+        # The rate limit applies once the burst capacity is used up
+        bucket = TokenBucket(rate=1000, capacity=2)
+        self.assertEqual(bucket.acquire(), 0)
+        self.assertEqual(bucket.acquire(), 0)
+        self.assertGreater(bucket.acquire(), 0)
+        self.assertEqual(TokenBucket(rate=0).acquire(), 0)
+        running = []
+        peak = []
+        lock = threading.Lock()
+
+        def get_media_info(url):
+            with lock:
+                running.append(url)
+                peak.append(len(running))
+            time.sleep(0.01)
+            with lock:
+                running.remove(url)
+            if url == 'u3':
+                raise Exception('failed')
+            return {'id': url}
+
+        # The stats are shown while a metadata batch task is running
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        override = self.settings(CACHES=dict(settings.CACHES, progress={
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': tempdir.name,
+        }))
+        override.enable()
+        self.addCleanup(override.disable)
+        task = Task.objects.new_task('sync.tasks.download_media_metadata_batch',
+                                     args=(['abc'],))
+        task.locked_by = str(os.getpid())
+        task.locked_at = timezone.now()
+        task.save()
+        published = []
+
+        with mock.patch('sync.youtube.MediaInfoExtractor') as extractor, \
+                mock.patch('sync.youtube.connection') as db_connection:
+            extractor.return_value.__enter__.return_value.get_media_info = \
+                get_media_info
+            fetcher = MetadataFetcher(workers=3,
+                                      rate_limiter=TokenBucket(rate=100, capacity=5))
+            results = {}
+            for key, metadata, error in fetcher.fetch(
+                    (i, f'u{i}') for i in range(10)):
+                results[key] = (metadata, error)
+                if not published:
+                    published.append(json.loads(
+                        Client().get('/tasks-progress').content)['metadata'])
+                    published.append(Client().get('/tasks'))
+        self.assertEqual(len(results), 10)
+        self.assertEqual(len(published[0]), 1)
+        self.assertEqual(published[0][0]['workers'], 3)
+        self.assertContains(published[1], 'Downloading metadata on')
+        # The stats are removed once the fetch finishes
+        self.assertEqual(json.loads(Client().get('/tasks-progress').content)['metadata'],
+                         [])
+        # Worker threads close their database connections after each fetch
+        self.assertEqual(db_connection.close.call_count, 10)
+        self.assertLessEqual(max(peak), 3)
+        self.assertLessEqual(extractor.call_count, 3)
+        self.assertEqual(results[0], ({'id': 'u0'}, None))
+        self.assertIsNone(results[3][0])
+        self.assertIsInstance(results[3][1], Exception)
+        stats = fetcher.stats()
+        self.assertEqual(stats['queued'], 0)
+        self.assertEqual(stats['running'], 0)
+        self.assertEqual(stats['fetched'], 9)
+        self.assertEqual(stats['failed'], 1)
+        # The burst capacity runs out so some downloads wait for the rate limiter
+        self.assertGreater(stats['throttled_waits'], 0)
+        self.assertGreater(stats['waited'], 0)
+        self.assertGreater(stats['per_second'], 0)
+
+
+class TaskPoolsTestCase(TestCase):
+    def setUp(self):
+        # Disable general logging for test case
+        logging.disable(logging.CRITICAL)
+
+    def test_task_pools(self):
+        Task.objects.all().delete()
+        for i in range(3):
+            Task.objects.new_task('sync.tasks.download_media', args=(f'd{i}',)).save()
+        for i in range(3):
+            Task.objects.new_task('sync.tasks.download_media_thumbnail',
+                                  args=(f't{i}', 'url')).save()
+        Task.objects.new_task('sync.tasks.rescan_media_server', args=('m',),
+                              run_at=timezone.now() + timedelta(hours=1)).save()
+        self.assertEqual(get_task_pool('sync.tasks.download_media'), 'download')
+        self.assertEqual(get_task_pool('sync.tasks.housekeeping_task'), 'index')
+        self.assertEqual(get_task_pool('sync.tasks.unknown'), 'index')
+        release = threading.Event()
+        ran = []
+
+        def bg_runner(proxy_task, task):
+            ran.append(task.task_name)
+            release.wait(5)
+
+        workers = {'index': 1, 'metadata': 1, 'thumbnail': 2, 'download': 1,
+                   'mediaserver': 1}
+        with mock.patch('sync.pools.bg_runner', bg_runner), \
+                self.settings(TASK_POOL_WORKERS=workers):
+            scheduler = TaskPoolScheduler()
+            try:
+                # Thumbnails don't wait for the running download
+                self.assertEqual(scheduler.run_pending(), 3)
+                self.assertEqual(scheduler.run_pending(), 0)
+                self.assertEqual(scheduler.status()['download'], 1)
+                self.assertEqual(scheduler.status()['thumbnail'], 2)
+                status = {pool['name']: pool for pool in get_pool_status()}
+                self.assertEqual(status['download']['workers'], 1)
+                self.assertEqual(status['download']['running'], 1)
+                self.assertEqual(status['download']['ready'], 2)
+                self.assertEqual(status['thumbnail']['running'], 2)
+                self.assertEqual(status['thumbnail']['ready'], 1)
+                self.assertEqual(status['mediaserver']['scheduled'], 1)
+                self.assertEqual(status['index']['ready'], 0)
+            finally:
+                release.set()
+                scheduler.shutdown()
+        self.assertEqual(sorted(ran), ['sync.tasks.download_media'] +
+                         ['sync.tasks.download_media_thumbnail'] * 2)
+        self.assertEqual(scheduler.status()['download'], 0)
+        self.assertContains(Client().get('/tasks'), 'Worker pools')
+
+
+class DownloadTestCase(TestCase):
+    def setUp(self):
+        # Disable general logging for test case
+        logging.disable(logging.CRITICAL)
+
+    def test_concurrent_fragments(self):
+        source = Source.objects.create(key='fff', name='fff', directory='/tmp/f')
+        # Sources without their own setting use the global default
+        with self.settings(DOWNLOAD_CONCURRENT_FRAGMENTS=3):
+            self.assertEqual(source.download_concurrent_fragments, 3)
+        with self.settings(DOWNLOAD_CONCURRENT_FRAGMENTS=0):
+            self.assertEqual(source.download_concurrent_fragments, 1)
+        source.concurrent_fragments = 6
+        with self.settings(DOWNLOAD_CONCURRENT_FRAGMENTS=3):
+            self.assertEqual(source.download_concurrent_fragments, 6)
+        cache.delete('sync.youtube.download_throughput')
+
+        def download(urls):
+            hook = ydl.call_args[0][0]['progress_hooks'][0]
+            for filename in ('/tmp/f/video.f137.mp4', '/tmp/f/video.f140.m4a'):
+                hook({'status': 'downloading', 'filename': filename,
+                      'downloaded_bytes': 100, 'total_bytes': 1000})
+                time.sleep(0.01)
+                hook({'status': 'finished', 'filename': filename,
+                      'downloaded_bytes': 1000, 'total_bytes': 1000})
+            return 0
+
+        with mock.patch('sync.youtube.yt_dlp.YoutubeDL') as ydl:
+            ydl.return_value.__enter__.return_value.download = download
+            download_youtube_media('https://example.com/', 'best', 'mkv',
+                                   '/tmp/f/video.mkv', False, concurrent_fragments=6)
+        self.assertEqual(ydl.call_args[0][0]['concurrent_fragment_downloads'], 6)
+        # Finished downloads are grouped by the number of concurrent fragments
+        record_download_throughput(3000, 1.0, 1)
+        record_download_throughput(1000, 1.0, 1)
+        record_download_throughput(0, 1.0, 1)
+        throughput = get_download_throughput([
+            {'phase': 'download', 'speed': 1500.4},
+            {'phase': 'download', 'speed': None},
+            {'phase': 'merge', 'speed': 1000},
+        ])
+        self.assertEqual(throughput['current'], 1500)
+        recent = throughput['recent']
+        self.assertEqual([r['concurrent_fragments'] for r in recent], [1, 6])
+        self.assertEqual(recent[0]['downloads'], 2)
+        self.assertEqual(recent[0]['per_second'], 2000)
+        self.assertEqual(recent[1]['downloads'], 1)
+        self.assertEqual(recent[1]['bytes'], 2000)
+        response = Client().get('/tasks-progress')
+        self.assertEqual(json.loads(response.content)['throughput']['recent'], recent)
+
+    def test_external_downloader(self):
+        source = Source.objects.create(key='eee', name='eee', directory='/tmp/e')
+        # Sources without their own setting use the global defaults
+        with self.settings(DOWNLOAD_DOWNLOADER='aria2c',
+                           DOWNLOAD_DOWNLOADER_CONNECTIONS=4):
+            self.assertEqual(source.download_downloader, 'aria2c')
+            self.assertEqual(source.download_downloader_connections, 4)
+            source.downloader = Source.DOWNLOADER_NATIVE
+            source.downloader_connections = 2
+            self.assertEqual(source.download_downloader, 'native')
+            self.assertEqual(source.download_downloader_connections, 2)
+
+        def download(urls):
+            return 0
+
+        def get_opts(which):
+            with mock.patch('sync.youtube.yt_dlp.YoutubeDL') as ydl, \
+                    mock.patch('sync.youtube.shutil.which', return_value=which), \
+                    mock.patch('sync.youtube.ExternalDownloadMonitor') as monitor:
+                ydl.return_value.__enter__.return_value.download = download
+                download_youtube_media('https://example.com/', 'best', 'mkv',
+                                       '/tmp/e/video.mkv', False, downloader='aria2c',
+                                       downloader_connections=32)
+            return ydl.call_args[0][0], monitor
+
+        opts, monitor = get_opts('/usr/bin/aria2c')
+        self.assertEqual(opts['external_downloader'], {'http': '/usr/bin/aria2c'})
+        self.assertIn('--split=16', opts['external_downloader_args']['aria2c'])
+        # Only the control files of this download are monitored
+        self.assertEqual(monitor.call_args[0][0], '/tmp/e')
+        self.assertEqual(monitor.call_args[0][3], 'video.')
+        monitor.return_value.stop.assert_called_once()
+        # Falls back to the native downloader when aria2c is not installed
+        opts, monitor = get_opts(None)
+        self.assertNotIn('external_downloader', opts)
+        monitor.assert_not_called()
+
+    def test_external_download_progress(self):
+        def control_file(piece_length, total_bytes, bitfield, in_flight=()):
+            data = struct.pack('>HIII', 1, 0, 0, piece_length)
+            data += struct.pack('>QQI', total_bytes, 0, len(bitfield)) + bitfield
+            data += struct.pack('>I', len(in_flight))
+            for index, length, blocks in in_flight:
+                data += struct.pack('>III', index, length, len(blocks)) + blocks
+            return data
+
+        events = []
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, 'video.f137.mp4.part.aria2')
+            self.assertIsNone(read_aria2_control_file(path))
+            # 3 of 5 1 MiB pieces done and 2 16 KiB blocks of the fourth piece
+            with open(path, 'wb') as f:
+                f.write(control_file(1024 * 1024, 5 * 1024 * 1024 - 100,
+                                     bytes([0b11010000]),
+                                     [(2, 1024 * 1024, bytes([0b11000000]))]))
+            os.utime(path, (1000, 1000))
+            downloaded = 3 * 1024 * 1024 + 2 * 16 * 1024
+            self.assertEqual(read_aria2_control_file(path),
+                             (downloaded, 5 * 1024 * 1024 - 100))
+            # Control files of other downloads in the same directory are ignored
+            other_path = os.path.join(tempdir, 'other.f137.mp4.part.aria2')
+            with open(other_path, 'wb') as f:
+                f.write(control_file(1024 * 1024, 1024 * 1024, bytes([0b10000000])))
+            monitor = ExternalDownloadMonitor(tempdir, events.append, prefix='video.')
+            monitor.poll()
+            # Unchanged control files are not reported again
+            monitor.poll()
+            with open(path, 'wb') as f:
+                f.write(control_file(1024 * 1024, 5 * 1024 * 1024 - 100,
+                                     bytes([0b11111000])))
+            os.utime(path, (1002, 1002))
+            monitor.poll()
+            with open(path, 'wb') as f:
+                f.write(b'\0')
+            os.utime(path, (1004, 1004))
+            monitor.poll()
+        self.assertEqual(len(events), 2)
+        self.assertEqual(events[0]['filename'],
+                         os.path.join(tempdir, 'video.f137.mp4'))
+        self.assertEqual(events[0]['downloaded_bytes'], downloaded)
+        self.assertIsNone(events[0]['speed'])
+        self.assertEqual(events[1]['downloaded_bytes'], 5 * 1024 * 1024 - 100)
+        self.assertEqual(events[1]['speed'],
+                         (5 * 1024 * 1024 - 100 - downloaded) / 2)
+        self.assertEqual(events[1]['eta'], 0)
@@ -3,6 +3,7 @@ from .views import (DashboardView, SourcesView, ValidateSourceView, AddSourceVie
                     SourceView, UpdateSourceView, DeleteSourceView, MediaView,
                     MediaThumbView, MediaItemView, MediaRedownloadView, MediaSkipView,
                     MediaEnableView, MediaContent, TasksView, CompletedTasksView, ResetTasks,
+                    DownloadProgressView,
                     MediaServersView, AddMediaServerView, MediaServerView,
                     DeleteMediaServerView, UpdateMediaServerView)
 
@@ -92,6 +93,10 @@ urlpatterns = [
          ResetTasks.as_view(),
          name='reset-tasks'),
 
+    path('tasks-progress',
+         DownloadProgressView.as_view(),
+         name='tasks-progress'),
+
     # Media Server URLs
 
     path('mediaservers',
@@ -1,10 +1,18 @@
 import os
 import re
 import math
+import struct
+import queue
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone as dt_timezone
 from pathlib import Path
 import requests
 from PIL import Image
 from django.conf import settings
+from django.db import connection
+from django.utils import timezone
 from urllib.parse import urlsplit, parse_qs
 from django.forms import ValidationError
 
@@ -125,6 +133,107 @@ def delete_file(filepath):
     return False
 
 
+def get_directory_size(path):
+    '''
+        Returns the total size in bytes of the files in a directory and its
+        subdirectories, 0 if it does not exist.
+    '''
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for filename in files:
+            try:
+                size += os.path.getsize(os.path.join(root, filename))
+            except OSError:
+                # Deleted or renamed while walking, such as a finished partial file
+                continue
+    return size
+
+
+# youtube-dl names the partial download of each format of a merged download, such as
+# "name.f137.mp4.part", and the partial download of a single format without its ID
+partial_format_re = re.compile(r'\.f([^.]+)\.[^.]+\.part$')
+
+
+def get_partial_download_size(path, format_str):
+    '''
+        Returns the total size in bytes of the ".part" files in a directory for the
+        formats in a youtube-dl format string such as "137+140", 0 if it does not
+        exist. Control files, fragments and the partial downloads of other formats
+        can't be resumed by the download so are not counted.
+    '''
+    format_ids = set(str(format_str).split('+'))
+    size = 0
+    try:
+        names = os.listdir(path)
+    except OSError:
+        return 0
+    for name in names:
+        if not name.endswith('.part'):
+            continue
+        match = partial_format_re.search(name)
+        if match and match.group(1) not in format_ids:
+            continue
+        try:
+            size += os.path.getsize(os.path.join(path, name))
+        except OSError:
+            # Deleted or renamed since the directory was listed
+            continue
+    return size
+
+
+def get_directory_mtime(path):
+    '''
+        Returns the most recent modification time of a directory or any of the files
+        in it and its subdirectories, as a Unix timestamp.
+    '''
+    mtime = os.path.getmtime(path)
+    for root, dirs, files in os.walk(path):
+        for filename in files:
+            try:
+                mtime = max(mtime, os.path.getmtime(os.path.join(root, filename)))
+            except OSError:
+                continue
+    return mtime
+
+
+def read_aria2_control_file(filepath):
+    '''
+        Returns a tuple of the (downloaded_bytes, total_bytes) of a download in
+        progress from its aria2 ".aria2" control file. Completed pieces and the
+        completed 16 KiB blocks of pieces in flight are counted. Returns None if
+        the control file can't be read.
+    '''
+    try:
+        with open(filepath, 'rb') as f:
+            data = f.read()
+        version = struct.unpack_from('>H', data, 0)[0]
+        # Version 1 is big endian, version 0 uses the byte order of the host
+        order = '>' if version == 1 else '<'
+        offset = 6
+        infohash_length = struct.unpack_from(order + 'I', data, offset)[0]
+        offset += 4 + infohash_length
+        piece_length, total_bytes = struct.unpack_from(order + 'IQ', data, offset)
+        offset += 4 + 8 + 8
+        bitfield_length = struct.unpack_from(order + 'I', data, offset)[0]
+        offset += 4
+        bitfield = data[offset:offset + bitfield_length]
+        offset += bitfield_length
+        downloaded_bytes = sum(bin(b).count('1') for b in bitfield) * piece_length
+        in_flight = struct.unpack_from(order + 'I', data, offset)[0]
+        offset += 4
+        for _ in range(in_flight):
+            _index, length, blocks_length = struct.unpack_from(order + 'III', data,
+                                                               offset)
+            offset += 12
+            blocks = data[offset:offset + blocks_length]
+            offset += blocks_length
+            downloaded_bytes += min(length, sum(bin(b).count('1') for b in blocks) *
+                                    16 * 1024)
+    except (OSError, struct.error):
+        return None
+    return min(downloaded_bytes, total_bytes), total_bytes
+
+
 def seconds_to_timestr(seconds):
    seconds = seconds % (24 * 3600)
    hour = seconds // 3600
@@ -134,6 +243,163 @@ def seconds_to_timestr(seconds):
    return '{:02d}:{:02d}:{:02d}'.format(hour, minutes, seconds)
 
 
+def prune_metadata(metadata, keep_fields, drop_format_fields):
+    '''
+        Returns a copy of a youtube-dl metadata dict with only the top level keys in
+        keep_fields, or all top level keys if keep_fields contains '*', and with the
+        keys in drop_format_fields removed from every format dict.
+    '''
+    if '*' in keep_fields:
+        pruned = dict(metadata)
+    else:
+        pruned = {k: v for k, v in metadata.items() if k in keep_fields}
+    formats = pruned.get('formats', None)
+    if isinstance(formats, (list, tuple)):
+        pruned['formats'] = [
+            {k: v for k, v in fmt.items() if k not in drop_format_fields}
+            if isinstance(fmt, dict) else fmt
+            for fmt in formats
+        ]
+    return pruned
+
+
+def iter_concurrently(iterators, max_workers=2, max_queued=1000):
+    '''
+        Consumes several iterators at once, each on a thread from a bounded thread
+        pool, and yields their items in the order they are produced. At most
+        max_queued items are held waiting to be yielded. An exception raised by any
+        iterator is raised to the caller. When the caller stops consuming the items,
+        by closing this generator, the threads stop consuming their iterators. Each
+        thread closes its database connection when it finishes.
+    '''
+    finished = object()
+    items = queue.Queue(maxsize=max_queued)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def consume(iterator):
+        try:
+            for item in iterator:
+                if not put((None, item)):
+                    return
+        except Exception as e:
+            put((e, finished))
+        else:
+            put((None, finished))
+        finally:
+            # Iterators may use the database, such as through the database cache,
+            # close the connection this thread opened once it is consumed
+            connection.close()
+
+    iterators = list(iterators)
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        for iterator in iterators:
+            executor.submit(consume, iterator)
+        remaining = len(iterators)
+        try:
+            while remaining:
+                error, item = items.get()
+                if error is not None:
+                    raise error
+                if item is finished:
+                    remaining -= 1
+                    continue
+                yield item
+        finally:
+            stop.set()
+
+
+class TokenBucket:
+    '''
+        A thread safe token bucket rate limiter. Tokens are added at rate per second
+        up to capacity, acquire() blocks until a token is available. A rate of 0 or
+        less disables the limit.
+    '''
+
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = max(1.0, float(capacity))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        '''
+            Takes a token from the bucket, waiting for one if the bucket is empty.
+            Returns the number of seconds spent waiting.
+        '''
+        if self.rate <= 0:
+            return 0
+        waited = 0
+        while True:
+            with self.lock:
+                self._refill(time.monotonic())
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+
+def parse_index_entry(entry):
+    '''
+        Returns the Media fields which can be set from a youtube-dl flat playlist
+        entry, as returned when a source is indexed, before the full metadata for the
+        media is downloaded. Fields missing from the entry are not returned.
+    '''
+    fields = {}
+    title = entry.get('title', None)
+    if title and isinstance(title, str):
+        fields['title'] = title[:200]
+    try:
+        duration = int(entry.get('duration', None) or 0)
+    except (TypeError, ValueError):
+        duration = 0
+    if duration > 0:
+        fields['duration'] = duration
+    published = None
+    timestamp = entry.get('timestamp', None) or entry.get('release_timestamp', None)
+    upload_date = entry.get('upload_date', None) or entry.get('release_date', None)
+    if timestamp:
+        try:
+            published = datetime.fromtimestamp(int(timestamp), tz=dt_timezone.utc)
+        except (TypeError, ValueError, OverflowError, OSError):
+            published = None
+    if not published and upload_date:
+        try:
+            published = timezone.make_aware(datetime.strptime(upload_date, '%Y%m%d'))
+        except (TypeError, ValueError):
+            published = None
+    if published:
+        fields['published'] = published
+        fields['upload_date'] = published.date()
+    return fields
+
+
+def whole_number(value):
+    '''
+        Returns whole number floats as ints. The metadata has numbers such as the
+        fps as either, 30.0 fps would be shown in filenames as "30.0fps".
+    '''
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
 def parse_media_format(format_dict):
     '''
         This parser primarily adapts the format dict returned by youtube-dl into a
@@ -193,10 +459,10 @@ def parse_media_format(format_dict):
         'height': height,
         'width': width,
         'vcodec': vcodec,
-        'fps': format_dict.get('fps', 0),
-        'vbr': format_dict.get('tbr', 0),
+        'fps': whole_number(format_dict.get('fps', 0)),
+        'vbr': whole_number(format_dict.get('tbr', 0)),
         'acodec': acodec,
-        'abr': format_dict.get('abr', 0),
+        'abr': whole_number(format_dict.get('abr', 0)),
         'is_60fps': fps > 50,
         'is_hdr': 'HDR' in format_dict.get('format', '').upper(),
         'is_hls': is_hls,
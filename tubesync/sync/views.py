@@ -7,6 +7,8 @@ import shutil
 import sys
 from django.conf import settings
 from django.http import FileResponse, Http404, HttpResponseNotFound, HttpResponseRedirect
+from django.http import JsonResponse
+from django.views import View
 from django.views.generic import TemplateView, ListView, DetailView
 from django.views.generic.edit import (FormView, FormMixin, CreateView, UpdateView,
                                        DeleteView)
@@ -30,7 +32,9 @@ from .forms import (ValidateSourceForm, ConfirmDeleteSourceForm, RedownloadMedia
 from .utils import validate_url, delete_file
 from .tasks import (map_task_to_instance, get_error_message,
                     get_source_completed_tasks, get_media_download_task,
-                    delete_task_by_media, index_source_task)
+                    delete_task_by_media, index_source_task,
+                    schedule_housekeeping_task)
+from .pools import get_pool_status
 from . import signals
 from . import youtube
 
@@ -304,7 +308,8 @@ class EditSourceMixin:
               'source_vcodec', 'source_acodec', 'prefer_60fps', 'prefer_hdr', 'fallback', 'copy_channel_images',
               'copy_thumbnails', 'write_nfo', 'write_json', 'embed_metadata', 'embed_thumbnail',
               'enable_sponsorblock', 'sponsorblock_categories', 'write_subtitles',
-              'auto_subtitles', 'sub_langs')
+              'auto_subtitles', 'sub_langs', 'concurrent_fragments',
+              'downloader', 'downloader_connections')
     errors = {
         'invalid_media_format': _('Invalid media format, the media format contains '
                                   'errors or is empty. Check the table at the end of '
@@ -573,6 +578,10 @@ class MediaItemView(DetailView):
         video_exact, video_format = self.object.get_best_video_format()
         task = get_media_download_task(self.object.pk)
         data['task'] = task
+        # Only running downloads have progress
+        data['progress'] = None
+        if task and task.locked_by:
+            data['progress'] = self.object.download_progress
         data['download_state'] = self.object.get_download_state(task)
         data['download_state_icon'] = self.object.get_download_state_icon(task)
         data['combined_exact'] = combined_exact
@@ -758,6 +767,11 @@ class MediaContent(DetailView):
             return HttpResponse(headers=headers)
 
 
+# Tasks which download metadata for many media items with a MetadataFetcher
+METADATA_BATCH_TASKS = ('sync.tasks.download_media_metadata_batch',
+                        'sync.tasks.refresh_media_metadata_batch')
+
+
 class TasksView(ListView):
     '''
         A list of tasks queued to be completed. This is, for example, scraping for new
@@ -785,6 +799,8 @@ class TasksView(ListView):
     def get_context_data(self, *args, **kwargs):
         data = super().get_context_data(*args, **kwargs)
         data['message'] = self.message
+        data['throttling'] = youtube.circuit_breaker.status()
+        data['pools'] = get_pool_status()
         data['running'] = []
         data['errors'] = []
         data['scheduled'] = []
@@ -799,6 +815,7 @@ class TasksView(ListView):
             setattr(task, 'url', url)
             setattr(task, 'run_now', task.run_at < now)
             if task.locked_by_pid_running():
+                setattr(task, 'progress', None)
                 data['running'].append(task)
             elif task.has_error():
                 error_message = get_error_message(task)
@@ -806,9 +823,54 @@ class TasksView(ListView):
                 data['errors'].append(task)
             else:
                 data['scheduled'].append(task)
+        downloads = {str(task.instance.pk): task for task in data['running']
+                     if task.task_name == 'sync.tasks.download_media'}
+        progress = youtube.DownloadProgress.get_many(downloads)
+        for media_id, snapshot in progress.items():
+            downloads[media_id].progress = snapshot
+        data['throughput'] = youtube.get_download_throughput(progress.values())
+        # Metadata batch tasks don't map to an instance so aren't in the running tasks
+        fetchers = queryset.filter(task_name__in=METADATA_BATCH_TASKS,
+                                   locked_by__isnull=False)
+        data['metadata_fetchers'] = list(youtube.MetadataFetcher.get_many(
+            fetchers.values_list('locked_by', flat=True)).values())
         return data
 
 
+class DownloadProgressView(View):
+    '''
+        Returns the progress of the running media downloads as JSON, optionally for a
+        single media item with the "media" parameter, the download throughput and
+        the stats of the running metadata downloads. Progress is read from the
+        cache, only the running tasks are looked up in the database.
+    '''
+
+    def get(self, request, *args, **kwargs):
+        media_ids = []
+        running = Task.objects.filter(task_name='sync.tasks.download_media',
+                                      locked_by__isnull=False)
+        for task_params in running.values_list('task_params', flat=True):
+            try:
+                args, kwargs = json.loads(task_params)
+                media_ids.append(str(args[0]))
+            except (TypeError, ValueError, IndexError):
+                continue
+        media_id = request.GET.get('media', '')
+        if media_id:
+            media_ids = [m for m in media_ids if m == media_id]
+        progress = youtube.DownloadProgress.get_many(media_ids)
+        fetchers = Task.objects.filter(task_name__in=METADATA_BATCH_TASKS,
+                                       locked_by__isnull=False)
+        fetcher_stats = youtube.MetadataFetcher.get_many(
+            fetchers.values_list('locked_by', flat=True))
+        return JsonResponse({
+            'downloads': [dict(media=media_id, **progress[media_id])
+                          for media_id in media_ids if media_id in progress],
+            'throughput': youtube.get_download_throughput(progress.values()),
+            'metadata': list(fetcher_stats.values()),
+        })
+
+
 class CompletedTasksView(ListView):
     '''
         List of tasks which have been completed with an optional per-source filter.
@@ -885,6 +947,8 @@ class ResetTasks(FormView):
             )
             # This also chains down to call each Media objects .save() as well
             source.save()
+        # Recreate the housekeeping task
+        schedule_housekeeping_task()
         return super().form_valid(form)
 
     def get_success_url(self):
@@ -5,10 +5,19 @@
 
 
 import os
+import time
+import random
+import shutil
+import threading
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from pathlib import Path
 from django.conf import settings
+from django.core.cache import cache, caches
+from django.db import connection
 from copy import copy
 from common.logger import log
+from .utils import TokenBucket, seconds_to_timestr, read_aria2_control_file
 import yt_dlp
 
 
@@ -36,6 +45,132 @@ class YouTubeError(yt_dlp.utils.DownloadError):
     pass
 
 
+class YouTubeThrottledError(YouTubeError):
+    '''
+        Raised when YouTube is throttling requests, or when requests are paused by
+        the circuit_breaker after YouTube throttled an earlier request.
+    '''
+    pass
+
+
+# Lower case fragments of youtube-dl error messages which mean YouTube is throttling
+THROTTLING_MESSAGES = (
+    'http error 429',
+    'too many requests',
+    'confirm you\'re not a bot',
+    'confirm you\u2019re not a bot',
+    'rate-limited by youtube',
+)
+
+
+def is_throttling_error(error):
+    '''
+        Returns True if an error raised by youtube-dl means YouTube is throttling.
+    '''
+    message = str(error).lower()
+    return any(fragment in message for fragment in THROTTLING_MESSAGES)
+
+
+class CircuitBreaker:
+    '''
+        Pauses all youtube-dl requests, in every process, once YouTube starts
+        throttling. Each throttling error in a row doubles the pause, from base
+        seconds up to maximum seconds, plus up to jitter of the pause again at
+        random so waiting tasks don't all retry at once. The state is stored in the
+        cache so the web server can display it.
+    '''
+
+    cache_key = 'sync.youtube.circuit_breaker'
+
+    def __init__(self, base, maximum, jitter=0.25):
+        self.base = base
+        self.maximum = maximum
+        self.jitter = jitter
+
+    def state(self):
+        return cache.get(self.cache_key) or {
+            'failures': 0,
+            'open_until': 0,
+            'last_error': '',
+        }
+
+    def is_open(self):
+        return self.state()['open_until'] > time.time()
+
+    def retry_at(self):
+        '''
+            Returns the datetime requests are paused until, or None if they are not.
+        '''
+        open_until = self.state()['open_until']
+        if open_until <= time.time():
+            return None
+        return datetime.fromtimestamp(open_until, tz=timezone.utc)
+
+    def check(self):
+        '''
+            Raises YouTubeThrottledError if requests are paused.
+        '''
+        retry_at = self.retry_at()
+        if retry_at:
+            raise YouTubeThrottledError(f'Requests to YouTube are paused until '
+                                        f'{retry_at.isoformat()} after YouTube '
+                                        f'throttled requests')
+
+    def record_throttled(self, error):
+        '''
+            Opens the circuit breaker for the next backoff period.
+        '''
+        state = self.state()
+        now = time.time()
+        if state['open_until'] > now:
+            # Already paused, a request which started before the pause failed
+            return
+        state['failures'] += 1
+        pause = min(self.maximum, self.base * 2 ** (state['failures'] - 1))
+        pause += random.uniform(0, pause * self.jitter)
+        state['open_until'] = now + pause
+        state['last_error'] = str(error)[:500]
+        cache.set(self.cache_key, state, None)
+        log.warning(f'YouTube is throttling requests, pausing all requests for '
+                    f'{pause:.0f} seconds (throttled {state["failures"]} time(s) in '
+                    f'a row): {error}')
+
+    def record_success(self):
+        '''
+            Closes the circuit breaker after a request succeeded.
+        '''
+        if self.state()['failures']:
+            cache.delete(self.cache_key)
+            log.info('YouTube requests succeeded again, throttling backoff reset')
+
+    def status(self):
+        '''
+            Returns a dict describing the circuit breaker for display.
+        '''
+        state = self.state()
+        return {
+            'open': state['open_until'] > time.time(),
+            'retry_at': self.retry_at(),
+            'failures': state['failures'],
+            'last_error': state['last_error'],
+        }
+
+
+circuit_breaker = CircuitBreaker(getattr(settings, 'THROTTLE_BACKOFF_BASE', 60),
+                                 getattr(settings, 'THROTTLE_BACKOFF_MAX', 3600))
+
+
+def get_youtube_error(message, error):
+    '''
+        Wraps a youtube-dl error in a YouTubeError, or a YouTubeThrottledError which
+        opens the circuit_breaker if the error means YouTube is throttling.
+    '''
+    if is_throttling_error(error):
+        circuit_breaker.record_throttled(error)
+        return YouTubeThrottledError(message)
+    return YouTubeError(message)
+
+
 def get_yt_opts():
     opts = copy(_defaults)
     cookie_file = settings.COOKIES_FILE
@@ -55,9 +190,11 @@ def get_channel_image_info(url):
         'extract_flat': True,  # Change to False to get detailed info
     })
 
+    circuit_breaker.check()
     with yt_dlp.YoutubeDL(opts) as y:
         try:
             response = y.extract_info(url, download=False)
+            circuit_breaker.record_success()
             
             avatar_url = None
             banner_url = None
@@ -71,8 +208,216 @@ def get_channel_image_info(url):
                     
             return avatar_url, banner_url
         except yt_dlp.utils.DownloadError as e:
-            raise YouTubeError(f'Failed to extract channel info for "{url}": {e}') from e
+            raise get_youtube_error(f'Failed to extract channel info for "{url}": '
+                                    f'{e}', e) from e
+
+
+
+class MediaInfoExtractor:
+    '''
+        Extracts information for many YouTube URLs with a single YoutubeDL instance,
+        which saves setting up the options and extractors again for every URL. Use
+        as a context manager, the YoutubeDL instance is closed on exit.
+    '''
+
+    def __init__(self):
+        opts = get_yt_opts()
+        opts.update({
+            'skip_download': True,
+            'forcejson': True,
+            'simulate': True,
+            'logger': log,
+            'extract_flat': True,
+        })
+        self.ydl = yt_dlp.YoutubeDL(opts)
+
+    def __enter__(self):
+        self.ydl.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        return self.ydl.__exit__(*args)
+
+    def get_media_info(self, url):
+        '''
+            Extracts information from a YouTube URL and returns it as a dict, see
+            get_media_info().
+        '''
+        circuit_breaker.check()
+        try:
+            response = self.ydl.extract_info(url, download=False)
+        except yt_dlp.utils.DownloadError as e:
+            raise get_youtube_error(f'Failed to extract_info for "{url}": {e}', e) from e
+        if not response:
+            raise YouTubeError(f'Failed to extract_info for "{url}": No metadata was '
+                               f'returned by youtube-dl, check for error messages in the '
+                               f'logs above. This task will be retried later with an '
+                               f'exponential backoff.')
+        circuit_breaker.record_success()
+        return response
+
+
+# Shared by every MetadataFetcher in the process so concurrent metadata downloads
+# are rate limited together
+metadata_rate_limiter = TokenBucket(getattr(settings, 'METADATA_FETCH_RATE', 0),
+                                    getattr(settings, 'METADATA_FETCH_BURST', 1))
+
+
+class MetadataFetcher:
+    '''
+        Downloads the metadata for many media URLs at once on a bounded pool of
+        worker threads. Each worker reuses its own MediaInfoExtractor and all workers
+        share the global metadata_rate_limiter. Counters of the queue depth, waits
+        for the rate limiter and throughput are available from stats(), and are
+        stored in the "progress" cache while fetching so the web server can display
+        them.
+    '''
+
+    cache_alias = 'progress'
+    cache_key_prefix = 'sync.youtube.metadata_fetcher.'
+    # Stats of a worker process which has stopped without finishing expire after this
+    timeout = 600
+
+    def __init__(self, workers=1, rate_limiter=None):
+        self.workers = max(1, workers)
+        self.rate_limiter = rate_limiter or metadata_rate_limiter
+        self.local = threading.local()
+        self.extractors = []
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.fetched = 0
+        self.failed = 0
+        self.throttled_waits = 0
+        self.waited = 0
+        self.started = None
+        # Task workers run one task per process, the stats are found by the process
+        # ID the running task is locked by
+        self.cache_key = self.get_cache_key(os.getpid())
+        self.interval = getattr(settings, 'DOWNLOAD_PROGRESS_INTERVAL', 2)
+        self.last_publish = 0
+
+    @classmethod
+    def get_cache_key(cls, pid):
+        return f'{cls.cache_key_prefix}{pid}'
+
+    @classmethod
+    def get_many(cls, pids):
+        '''
+            Returns a dict of the published stats for the task worker process IDs in
+            pids, process IDs with no stats are left out.
+        '''
+        cache_keys = {cls.get_cache_key(pid): str(pid) for pid in pids}
+        stats = caches[cls.cache_alias].get_many(list(cache_keys))
+        return {cache_keys[cache_key]: value for cache_key, value in stats.items()}
+
+    def get_extractor(self):
+        extractor = getattr(self.local, 'extractor', None)
+        if extractor is None:
+            extractor = MediaInfoExtractor().__enter__()
+            self.local.extractor = extractor
+            with self.lock:
+                self.extractors.append(extractor)
+        return extractor
+
+    def fetch_one(self, url):
+        waited = self.rate_limiter.acquire()
+        with self.lock:
+            if waited > 0:
+                self.throttled_waits += 1
+                self.waited += waited
+            self.running += 1
+        try:
+            return self.get_extractor().get_media_info(url)
+        finally:
+            with self.lock:
+                self.running -= 1
+            # The circuit breaker uses the database cache, close the connection
+            # this worker thread opened so it isn't left open after the fetch
+            connection.close()
+
+    def fetch(self, items):
+        '''
+            Downloads the metadata for an iterable of (key, url) pairs. Yields
+            (key, metadata, error) tuples in the order downloads complete, error is
+            None for a successful download. At most two downloads per worker are
+            queued at once.
+        '''
+        items = iter(items)
+        self.started = time.monotonic()
+        pending = {}
+
+        def submit(executor):
+            for key, url in items:
+                pending[executor.submit(self.fetch_one, url)] = key
+                with self.lock:
+                    self.queued += 1
+                if len(pending) >= self.workers * 2:
+                    break
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                try:
+                    submit(executor)
+                    self.publish(force=True)
+                    while pending:
+                        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            key = pending.pop(future)
+                            error = future.exception()
+                            with self.lock:
+                                self.queued -= 1
+                                if error is None:
+                                    self.fetched += 1
+                                else:
+                                    self.failed += 1
+                            metadata = future.result() if error is None else None
+                            yield key, metadata, error
+                        submit(executor)
+                        self.publish()
+                finally:
+                    # Stopped early, don't start any more downloads
+                    for future in pending:
+                        future.cancel()
+        finally:
+            # The workers have all finished once the executor has shut down
+            for extractor in self.extractors:
+                extractor.__exit__(None, None, None)
+            self.extractors = []
+            caches[self.cache_alias].delete(self.cache_key)
+
+    def stats(self):
+        '''
+            Returns a dict of counters for the downloads, queued is the number of
+            submitted downloads which have not completed yet and throttled_waits the
+            number of downloads which waited a total of waited seconds for the rate
+            limiter.
+        '''
+        with self.lock:
+            elapsed = time.monotonic() - self.started if self.started else 0
+            completed = self.fetched + self.failed
+            return {
+                'workers': self.workers,
+                'queued': self.queued,
+                'running': self.running,
+                'fetched': self.fetched,
+                'failed': self.failed,
+                'throttled_waits': self.throttled_waits,
+                'waited': self.waited,
+                'elapsed': elapsed,
+                'per_second': completed / elapsed if elapsed > 0 else 0,
+            }
 
+    def publish(self, force=False):
+        '''
+            Stores the stats in the cache, at most once every
+            DOWNLOAD_PROGRESS_INTERVAL seconds unless force is set.
+        '''
+        now = time.monotonic()
+        if not force and now - self.last_publish < self.interval:
+            return
+        self.last_publish = now
+        caches[self.cache_alias].set(self.cache_key, self.stats(), self.timeout)
 
 
 def get_media_info(url):
@@ -81,39 +426,348 @@ def get_media_info(url):
         or playlist this returns a dict of all the videos on the channel or playlist
         as well as associated metadata.
     '''
+    with MediaInfoExtractor() as extractor:
+        return extractor.get_media_info(url)
+
+
+def iter_media_info_entries(url):
+    '''
+        Extracts the entries from a YouTube channel or playlist URL lazily. Entries
+        are yielded as dicts as youtube-dl fetches each page of the listing, so the
+        caller can stop early without the whole channel or playlist being fetched.
+    '''
     opts = get_yt_opts()
     opts.update({
         'skip_download': True,
-        'forcejson': True,
         'simulate': True,
         'logger': log,
         'extract_flat': True,
+        'lazy_playlist': True,
     })
-    response = {}
+    circuit_breaker.check()
     with yt_dlp.YoutubeDL(opts) as y:
         try:
-            response = y.extract_info(url, download=False)
+            response = y.extract_info(url, download=False, process=False)
+            # Follow any redirects, such as a channel name URL to a channel ID URL
+            redirects = 0
+            while (isinstance(response, dict) and redirects < 5 and
+                   response.get('_type') in ('url', 'url_transparent')):
+                response = y.extract_info(response['url'], download=False,
+                                          ie_key=response.get('ie_key'), process=False)
+                redirects += 1
         except yt_dlp.utils.DownloadError as e:
-            raise YouTubeError(f'Failed to extract_info for "{url}": {e}') from e
-    if not response:
-        raise YouTubeError(f'Failed to extract_info for "{url}": No metadata was '
-                           f'returned by youtube-dl, check for error messages in the '
-                           f'logs above. This task will be retried later with an '
-                           f'exponential backoff.')
-    return response
+            raise get_youtube_error(f'Failed to extract_info for "{url}": {e}', e) from e
+        if not response:
+            raise YouTubeError(f'Failed to extract_info for "{url}": No metadata was '
+                               f'returned by youtube-dl, check for error messages in '
+                               f'the logs above. This task will be retried later with '
+                               f'an exponential backoff.')
+        # Entries are extracted lazily outside of extract_info(), so extractor and
+        # network errors are raised here as they are rather than as DownloadError
+        succeeded = False
+        try:
+            for entry in response.get('entries') or []:
+                if not succeeded:
+                    # The first page was fetched, the caller may stop before the
+                    # last one such as when an incremental index finds known media
+                    circuit_breaker.record_success()
+                    succeeded = True
+                if isinstance(entry, dict):
+                    yield entry
+        except yt_dlp.utils.YoutubeDLError as e:
+            raise get_youtube_error(f'Failed to extract entries for "{url}": {e}',
+                                    e) from e
+        if not succeeded:
+            circuit_breaker.record_success()
+
+
+class DownloadProgress:
+    '''
+        Progress snapshots of a media download stored in the "progress" cache, so
+        the web server can display them. Snapshots are written at most once every
+        DOWNLOAD_PROGRESS_INTERVAL seconds, unless the phase changes, and expire if
+        the download stops updating them.
+    '''
+
+    cache_alias = 'progress'
+    cache_key_prefix = 'sync.youtube.download_progress.'
+    # Snapshots of a download which has stopped without finishing expire after this
+    timeout = 600
+
+    def __init__(self, key):
+        self.cache_key = self.get_cache_key(key)
+        self.interval = getattr(settings, 'DOWNLOAD_PROGRESS_INTERVAL', 2)
+        self.phase = None
+        self.last_write = 0
+        self.started = time.time()
+
+    @classmethod
+    def get_cache_key(cls, key):
+        return f'{cls.cache_key_prefix}{key}'
+
+    @classmethod
+    def get(cls, key):
+        return caches[cls.cache_alias].get(cls.get_cache_key(key))
+
+    @classmethod
+    def get_many(cls, keys):
+        '''
+            Returns a dict of the snapshots of the downloads with the given keys,
+            downloads without a snapshot are left out.
+        '''
+        cache_keys = {cls.get_cache_key(key): key for key in keys}
+        snapshots = caches[cls.cache_alias].get_many(list(cache_keys))
+        return {cache_keys[cache_key]: snapshot
+                for cache_key, snapshot in snapshots.items()}
+
+    def update(self, phase, downloaded_bytes=0, total_bytes=0, speed=None, eta=None,
+               filename=''):
+        '''
+            Stores a progress snapshot, phase is one of "starting", "download",
+            "merge" or "postprocess".
+        '''
+        now = time.monotonic()
+        if phase == self.phase and now - self.last_write < self.interval:
+            return False
+        self.phase = phase
+        self.last_write = now
+        percent = None
+        if downloaded_bytes and total_bytes:
+            percent = min(100, round(downloaded_bytes / total_bytes * 100, 1))
+        caches[self.cache_alias].set(self.cache_key, {
+            'phase': phase,
+            'downloaded_bytes': downloaded_bytes or 0,
+            'total_bytes': total_bytes or 0,
+            'percent': percent,
+            'speed': speed,
+            'eta': eta,
+            'eta_str': seconds_to_timestr(int(eta)) if eta else '',
+            'filename': filename,
+            'started': self.started,
+            'updated': time.time(),
+        }, self.timeout)
+        return True
+
+    def finish(self):
+        caches[self.cache_alias].delete(self.cache_key)
+
+
+# Cache key of the throughput of recently finished downloads
+DOWNLOAD_THROUGHPUT_CACHE_KEY = 'sync.youtube.download_throughput'
+DOWNLOAD_THROUGHPUT_HISTORY = 50
+
+
+def record_download_throughput(downloaded_bytes, seconds, concurrent_fragments,
+                               downloader='native'):
+    '''
+        Adds a finished download to the throughput of the last
+        DOWNLOAD_THROUGHPUT_HISTORY downloads kept in the cache.
+    '''
+    if downloaded_bytes <= 0 or seconds <= 0:
+        return
+    recent = cache.get(DOWNLOAD_THROUGHPUT_CACHE_KEY) or []
+    recent.append((downloaded_bytes, seconds, concurrent_fragments, downloader))
+    cache.set(DOWNLOAD_THROUGHPUT_CACHE_KEY, recent[-DOWNLOAD_THROUGHPUT_HISTORY:], None)
+
+
+def get_download_throughput(snapshots=()):
+    '''
+        Returns a dict of download throughput in bytes per second. "current" is the
+        total speed of the running downloads with the given progress snapshots,
+        "recent" is a list of the average throughput of recently finished
+        downloads for each downloader and number of concurrent fragments used.
+    '''
+    current = sum(snapshot.get('speed') or 0 for snapshot in snapshots
+                  if snapshot.get('phase') == 'download')
+    totals = {}
+    for entry in cache.get(DOWNLOAD_THROUGHPUT_CACHE_KEY) or []:
+        # Downloads recorded before external downloaders were added used native
+        downloaded_bytes, seconds, concurrent_fragments, downloader = (
+            tuple(entry) + ('native',))[:4]
+        total = totals.setdefault((downloader, concurrent_fragments), [0, 0, 0])
+        total[0] += 1
+        total[1] += downloaded_bytes
+        total[2] += seconds
+    recent = [{
+        'downloader': downloader,
+        'concurrent_fragments': concurrent_fragments,
+        'downloads': downloads,
+        'bytes': downloaded_bytes,
+        'seconds': round(seconds, 2),
+        'per_second': round(downloaded_bytes / seconds),
+    } for (downloader, concurrent_fragments), (downloads, downloaded_bytes, seconds) in
+        sorted(totals.items())]
+    return {'current': round(current), 'recent': recent}
+
+
+# External downloaders which can download media in place of the native yt-dlp
+# downloader, by name to the executable. They are only used for media which is not
+# split into fragments.
+EXTERNAL_DOWNLOADERS = {
+    'aria2c': 'aria2c',
+}
+
+
+def get_external_downloader(downloader):
+    '''
+        Returns the path to the executable of an external downloader by name, or
+        None if the native downloader should be used because it was asked for or
+        the external downloader is not installed.
+    '''
+    if not downloader or downloader == 'native':
+        return None
+    executable = EXTERNAL_DOWNLOADERS.get(downloader)
+    if not executable:
+        log.warning(f'Unknown external downloader "{downloader}", using the native '
+                    f'downloader')
+        return None
+    path = shutil.which(executable)
+    if not path:
+        log.warning(f'External downloader "{downloader}" is not installed, using the '
+                    f'native downloader')
+        return None
+    return path
+
+
+class ExternalDownloadMonitor(threading.Thread):
+    '''
+        External downloaders only report to yt-dlp once a file has finished, this
+        reads the progress of files being downloaded by aria2c in a directory from
+        their ".aria2" control files and passes it to a yt-dlp progress hook. Only
+        files with names starting with prefix are read, as the directory may be
+        shared with other downloads.
+    '''
+
+    CONTROL_FILE_SUFFIX = '.aria2'
+
+    def __init__(self, directory, hook, interval=2, prefix=''):
+        super().__init__(name='external-download-monitor', daemon=True)
+        self.directory = directory
+        self.hook = hook
+        self.prefix = prefix
+        self.interval = max(1, interval)
+        self.stopped = threading.Event()
+        # Control file name to the (mtime, downloaded_bytes) last read
+        self.last = {}
+
+    def poll(self):
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        for name in names:
+            if (not name.startswith(self.prefix) or
+                not name.endswith(self.CONTROL_FILE_SUFFIX)):
+                continue
+            control_file = os.path.join(self.directory, name)
+            try:
+                mtime = os.path.getmtime(control_file)
+            except OSError:
+                continue
+            last = self.last.get(name)
+            if last and mtime <= last[0]:
+                # Not saved by aria2c since the last poll
+                continue
+            status = read_aria2_control_file(control_file)
+            if not status:
+                continue
+            downloaded_bytes, total_bytes = status
+            speed, eta = None, None
+            if last:
+                speed = max(0, (downloaded_bytes - last[1]) / (mtime - last[0]))
+                if speed > 0:
+                    eta = round((total_bytes - downloaded_bytes) / speed)
+            self.last[name] = (mtime, downloaded_bytes)
+            filename = control_file[:-len(self.CONTROL_FILE_SUFFIX)]
+            if filename.endswith('.part'):
+                filename = filename[:-len('.part')]
+            self.hook({
+                'status': 'downloading',
+                'filename': filename,
+                'downloaded_bytes': downloaded_bytes,
+                'total_bytes': total_bytes,
+                'speed': speed,
+                'eta': eta,
+            })
+
+    def run(self):
+        try:
+            while not self.stopped.wait(self.interval):
+                self.poll()
+        finally:
+            # Progress may be stored in a database cache from this thread
+            connection.close()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def get_partial_downloads_dir():
+    '''
+        Returns the directory in YOUTUBE_DL_TEMPDIR partial media downloads are kept
+        in between download attempts, or None if there is no temporary directory.
+    '''
+    tempdir = getattr(settings, 'YOUTUBE_DL_TEMPDIR', None)
+    if not tempdir:
+        return None
+    return Path(tempdir) / 'partial'
+
+
+def get_partial_download_dir(key):
+    '''
+        Returns the directory the partial downloads for a media item are kept in,
+        named by key so every attempt to download the media resumes them, or None if
+        there is no temporary directory.
+    '''
+    partial_downloads_dir = get_partial_downloads_dir()
+    if not partial_downloads_dir:
+        return None
+    return partial_downloads_dir / str(key)
 
 
 def download_media(url, media_format, extension, output_file, info_json,
                    sponsor_categories=None,
                    embed_thumbnail=False, embed_metadata=False, skip_sponsors=True,
-                   write_subtitles=False, auto_subtitles=False, sub_langs='en'):
+                   write_subtitles=False, auto_subtitles=False, sub_langs='en',
+                   partial_dir=None, progress_key=None, concurrent_fragments=1,
+                   downloader='native', downloader_connections=1):
     '''
-        Downloads a YouTube URL to a file on disk.
+        Downloads a YouTube URL to a file on disk. If partial_dir is set the
+        partially downloaded files are kept there and resumed by the next download
+        of the same media if this one fails. If progress_key is set progress
+        snapshots are stored with DownloadProgress while downloading. DASH and HLS
+        media is downloaded concurrent_fragments fragments at a time. Other media
+        is downloaded with the named external downloader over downloader_connections
+        connections if it is installed, otherwise with the native downloader.
     '''
+    progress = DownloadProgress(progress_key) if progress_key else None
+    # Bytes downloaded of each file and when downloading started and last progressed
+    transfer = {'bytes': {}, 'start': None, 'end': None}
 
     def hook(event):
         filename = os.path.basename(event['filename'])
 
+        if event['status'] in ('downloading', 'finished'):
+            now = time.monotonic()
+            if transfer['start'] is None:
+                transfer['start'] = now
+            transfer['end'] = now
+            downloaded_bytes = (event.get('downloaded_bytes') or
+                                event.get('total_bytes') or 0)
+            transfer['bytes'][filename] = downloaded_bytes
+
+        if progress and event['status'] == 'downloading':
+            progress.update(
+                'download',
+                downloaded_bytes=event.get('downloaded_bytes'),
+                total_bytes=(event.get('total_bytes') or
+                             event.get('total_bytes_estimate')),
+                speed=event.get('speed'),
+                eta=event.get('eta'),
+                filename=filename,
+            )
+
         if event.get('downloaded_bytes') is None or event.get('total_bytes') is None:
             return None
 
@@ -147,6 +801,15 @@ def download_media(url, media_format, extension, output_file, info_json,
             log.warn(f'[youtube-dl] unknown event: {str(event)}')
 
     hook.download_progress = 0
+
+    def postprocessor_hook(event):
+        if not progress or event.get('status') != 'started':
+            return
+        phase = 'merge' if event.get('postprocessor') == 'Merger' else 'postprocess'
+        info = event.get('info_dict') or {}
+        filename = os.path.basename(info.get('filepath') or '')
+        progress.update(phase, filename=filename)
+
     ytopts = {
         'format': media_format,
         'merge_output_format': extension,
@@ -154,11 +817,16 @@ def download_media(url, media_format, extension, output_file, info_json,
         'quiet': False if settings.DEBUG else True,
         'verbose': True if settings.DEBUG else False,
         'progress_hooks': [hook],
+        'postprocessor_hooks': [postprocessor_hook],
         'writeinfojson': info_json,
         'postprocessors': [],
         'writesubtitles': write_subtitles,
         'writeautomaticsub': auto_subtitles,
         'subtitleslangs': sub_langs.split(','),
+        # Resume partial files and fragments left by an earlier attempt
+        'continuedl': True,
+        'nopart': False,
+        'concurrent_fragment_downloads': max(1, concurrent_fragments),
     }
     if not sponsor_categories:
         sponsor_categories = []
@@ -172,10 +840,26 @@ def download_media(url, media_format, extension, output_file, info_json,
         'add_metadata': embed_metadata
     }
     opts = get_yt_opts()
-    ytopts['paths'] = opts.get('paths', {})
+    # Copy the paths so the shared defaults aren't changed for every download
+    ytopts['paths'] = dict(opts.get('paths', {}))
     ytopts['paths'].update({
         'home': os.path.dirname(output_file),
     })
+    if partial_dir:
+        os.makedirs(partial_dir, exist_ok=True)
+        ytopts['paths']['temp'] = str(partial_dir)
+    external_downloader = get_external_downloader(downloader)
+    if external_downloader:
+        connections = min(max(1, downloader_connections), 16)
+        ytopts['external_downloader'] = {'http': external_downloader}
+        # Save the control file every second so progress can be read from it
+        ytopts['external_downloader_args'] = {'aria2c': [
+            f'--max-connection-per-server={connections}',
+            f'--split={connections}',
+            '--auto-save-interval=1',
+        ]}
+    else:
+        downloader = 'native'
     if embed_thumbnail:
         ytopts['postprocessors'].append({'key': 'EmbedThumbnail'})
     if skip_sponsors:
@@ -183,9 +867,39 @@ def download_media(url, media_format, extension, output_file, info_json,
     ytopts['postprocessors'].append(ffmdopt)
     opts.update(ytopts)
 
-    with yt_dlp.YoutubeDL(opts) as y:
-        try:
-            return y.download([url])
-        except yt_dlp.utils.DownloadError as e:
-            raise YouTubeError(f'Failed to download for "{url}": {e}') from e
-    return False
+    circuit_breaker.check()
+    if progress:
+        progress.update('starting')
+    monitor = None
+    if external_downloader:
+        # Files of this download are named after the output file with the format
+        # and extension replaced, e.g. "name.f137.mp4.part.aria2"
+        output_name = os.path.splitext(os.path.basename(output_file))[0]
+        monitor = ExternalDownloadMonitor(
+            ytopts['paths'].get('temp', ytopts['paths']['home']), hook,
+            getattr(settings, 'DOWNLOAD_PROGRESS_INTERVAL', 2), f'{output_name}.')
+        monitor.start()
+    try:
+        with yt_dlp.YoutubeDL(opts) as y:
+            try:
+                retcode = y.download([url])
+            except yt_dlp.utils.DownloadError as e:
+                raise get_youtube_error(f'Failed to download for "{url}": {e}',
+                                        e) from e
+            circuit_breaker.record_success()
+    finally:
+        if monitor:
+            monitor.stop()
+        if progress:
+            progress.finish()
+    if transfer['start'] is not None:
+        downloaded_bytes = sum(transfer['bytes'].values())
+        seconds = transfer['end'] - transfer['start']
+        record_download_throughput(downloaded_bytes, seconds, concurrent_fragments,
+                                   downloader)
+        if seconds > 0:
+            log.info(f'[youtube-dl] downloaded {downloaded_bytes} bytes in '
+                     f'{seconds:.1f} seconds ({downloaded_bytes / seconds:.0f} bytes/s) '
+                     f'with the {downloader} downloader and {concurrent_fragments} '
+                     f'concurrent fragments')
+    return retcode
@@ -77,6 +77,16 @@ WSGI_APPLICATION = 'tubesync.wsgi.application'
 DATABASES = {}
 
 
+CACHES = {
+    'default': {
+        # Stored in the database so the web server and task workers share the cache,
+        # create the table with: ./manage.py createcachetable
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'sync_cache',
+    }
+}
+
+
 DEFAULT_AUTO_FIELD = 'django.db.models.AutoField'
 
 
@@ -139,7 +149,33 @@ BACKGROUND_TASK_ASYNC_THREADS = 1           # Number of async tasks to run at on
 MAX_BACKGROUND_TASK_ASYNC_THREADS = 8       # For sanity reasons
 BACKGROUND_TASK_PRIORITY_ORDERING = 'ASC'   # Use 'niceness' task priority ordering
 COMPLETED_TASKS_DAYS_TO_KEEP = 7            # Number of days to keep completed tasks
+PARTIAL_DOWNLOAD_MAX_AGE_HOURS = 72          # Hours to keep partial media downloads which are not resumed
+DOWNLOAD_PROGRESS_INTERVAL = 2              # Minimum seconds between storing progress snapshots of each media download
+DOWNLOAD_CONCURRENT_FRAGMENTS = 1           # Fragments of DASH/HLS media downloaded at once, unless set on the source
+DOWNLOAD_DOWNLOADER = 'native'              # Downloader for media not split into fragments, 'native' or 'aria2c', unless set on the source
+DOWNLOAD_DOWNLOADER_CONNECTIONS = 8         # Connections per file for external downloaders, unless set on the source
+TASK_POOL_WORKERS = {                       # Number of tasks of each class run at once by process-task-pools
+    'index': 1,
+    'metadata': 1,
+    'thumbnail': 2,
+    'download': 1,
+    'mediaserver': 1,
+}
+HOUSEKEEPING_INTERVAL = 3600                # Seconds between cleanups of completed tasks and expired media
 MAX_ENTRIES_PROCESSING = 0                  # Number of videos to process on source refresh (0 for no limit)
+METADATA_BATCH_SIZE = 20                    # Number of new media to download metadata for in each task
+METADATA_FETCH_WORKERS = 2                  # Number of metadata downloads to run at once in each task
+METADATA_FETCH_RATE = 1.0                   # Metadata downloads started per second by all workers (0 for no limit)
+METADATA_FETCH_BURST = 5                    # Metadata downloads which can start at once before the rate limit applies
+METADATA_REFRESH_TTL_HOURS = 72             # Hours before metadata for media still to be downloaded is refreshed (0 to never refresh)
+METADATA_REFRESH_LIMIT = 200                # Maximum number of media to refresh metadata for in each housekeeping run
+THROTTLE_BACKOFF_BASE = 60                  # Seconds to pause YouTube requests for after YouTube first throttles them
+THROTTLE_BACKOFF_MAX = 3600                 # Maximum seconds to pause YouTube requests for when throttled repeatedly
+MEDIA_METADATA_EXTRA_FIELDS = ()            # Extra metadata keys to keep when pruning metadata ('*' for all)
+INDEX_INCREMENTAL_KNOWN_LIMIT = 50          # Stop indexing a channel after this many known media in a row (0 to always index fully)
+INDEX_FULL_INTERVAL_HOURS = 24              # Hours between full indexes of channels indexed incrementally
+INDEX_TAB_WORKERS = 2                       # Number of tabs of a source (videos, streams) indexed at once
+MAX_REMOVED_MEDIA_FRACTION = 0.5            # Skip deleting media no longer in a source if more than this fraction would go (0 for no limit)
 
 SOURCES_PER_PAGE = 100
 MEDIA_PER_PAGE = 144
@@ -177,5 +213,14 @@ except ImportError as e:
     sys.exit(1)
 
 
+# Download progress is written every few seconds while media downloads, it is kept
+# in files in the config directory shared by the web server and workers rather
+# than in the database
+CACHES.setdefault('progress', {
+    'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+    'LOCATION': str(CONFIG_BASE_DIR / 'cache' / 'progress'),
+})
+
+
 from .dbutils import patch_ensure_connection
 patch_ensure_connection()